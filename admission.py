@@ -0,0 +1,388 @@
+import os
+import json
+import math
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+from metrics import metrics
+from profiling import span
+
+try:
+    import fcntl
+except ImportError:  # Windows: limites propres à chaque processus
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Intervalle de vérification des places libres par les demandes en attente (secondes)
+POLL_INTERVAL = 0.1
+
+# Délai suggéré (en-tête Retry-After) lorsque la file d'attente est pleine
+QUEUE_FULL_RETRY_AFTER = 5
+
+# Nombre de vérifications de la limite de débit entre deux nettoyages des compteurs inactifs
+PRUNE_EVERY = 100
+
+
+class AdmissionRejected(Exception):
+    """Demande refusée: file d'attente pleine ou attente trop longue, limite de débit du client atteinte"""
+
+    def __init__(self, message: str, status: int = 429, retry_after: int = QUEUE_FULL_RETRY_AFTER):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Slots:
+    """Places numérotées partagées entre processus: verrous fcntl.flock sur <préfixe>-<n>.lock
+
+    Un verrou est libéré par le système si le processus qui le détient
+    s'arrête: une place ne peut pas rester occupée par un worker disparu.
+    Sans fcntl, les places sont comptées dans le processus.
+    """
+
+    def __init__(self, directory: str, prefix: str, size: int):
+        self.directory = directory
+        self.prefix = prefix
+        self.size = size
+        self._lock = threading.Lock()
+        self._held = set()
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{index}.lock")
+
+    def try_acquire(self) -> Optional[Any]:
+        """Occupe une place libre et retourne son jeton, ou None si toutes sont occupées"""
+        if fcntl is None:
+            with self._lock:
+                for index in range(self.size):
+                    if index not in self._held:
+                        self._held.add(index)
+                        return index
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        for index in range(self.size):
+            handle = open(self._path(index), "a+b")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return handle
+            except BlockingIOError:
+                handle.close()
+        return None
+
+    def release(self, token: Any) -> None:
+        if fcntl is None:
+            with self._lock:
+                self._held.discard(token)
+            return
+        fcntl.flock(token, fcntl.LOCK_UN)
+        token.close()
+
+    def count(self) -> int:
+        """Nombre de places occupées, tous processus confondus"""
+        if fcntl is None:
+            with self._lock:
+                return len(self._held)
+
+        held = 0
+        for index in range(self.size):
+            try:
+                with open(self._path(index), "rb") as handle:
+                    # Verrou partagé: n'empêche pas une autre demande d'évaluer la place
+                    fcntl.flock(handle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                held += 1
+            except OSError:
+                continue  # Place jamais utilisée
+        return held
+
+
+class AdmissionController:
+    """Limite les générations simultanées envoyées à chaque backend LLM, tous workers confondus
+
+    Au-delà de la limite d'un backend, les demandes attendent une place
+    dans une file bornée (max_waiting); si la file est pleine, la demande
+    est refusée immédiatement (429). Une demande qui attend plus de
+    queue_timeout secondes est refusée (503). Les tâches de fond (tâches
+    asynchrones, lots), que personne n'attend devant une page, attendent
+    jusqu'à job_queue_timeout secondes et ne sont pas refusées quand la
+    file est pleine. Les backends sans limite (mode hors ligne) ne sont pas
+    contrôlés.
+    """
+
+    def __init__(self, state_dir: Optional[str] = None, concurrency: Optional[Dict[str, int]] = None,
+                 max_waiting: int = 20, queue_timeout: float = 60.0, job_queue_timeout: float = 3600.0):
+        self.state_dir = state_dir or os.path.join(tempfile.gettempdir(), "chatmd_admission")
+        self.concurrency = concurrency or {"local": 1, "online": 4}
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.job_queue_timeout = job_queue_timeout
+        self._slots: Dict[str, Dict[str, _Slots]] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, state_dir: Optional[str] = None, concurrency: Optional[Dict[str, int]] = None,
+                  max_waiting: Optional[int] = None, queue_timeout: Optional[float] = None,
+                  job_queue_timeout: Optional[float] = None) -> None:
+        """Change le répertoire partagé et les limites (configuration de l'application)"""
+        with self._lock:
+            if state_dir:
+                self.state_dir = state_dir
+            if concurrency:
+                self.concurrency = dict(concurrency)
+            if max_waiting is not None:
+                self.max_waiting = max_waiting
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+            if job_queue_timeout is not None:
+                self.job_queue_timeout = job_queue_timeout
+            self._slots = {}
+
+    def _backend_slots(self, backend: str) -> Optional[Dict[str, _Slots]]:
+        limit = self.concurrency.get(backend)
+        if not limit:
+            return None
+        with self._lock:
+            slots = self._slots.get(backend)
+            if slots is None:
+                slots = self._slots[backend] = {
+                    "active": _Slots(self.state_dir, f"{backend}-active", limit),
+                    "waiting": _Slots(self.state_dir, f"{backend}-waiting", self.max_waiting),
+                }
+            return slots
+
+    def _reject(self, backend: str, result: str, message: str, status: int) -> AdmissionRejected:
+        metrics.inc("chatmd_llm_admissions_total", backend=backend, result=result)
+        logger.warning(f"Demande refusée pour {backend}: {message}")
+        return AdmissionRejected(message, status)
+
+    def _queue_full(self, backend: str) -> AdmissionRejected:
+        return self._reject(backend, "rejected", "Trop de demandes en cours, veuillez réessayer plus tard", 429)
+
+    def _timed_out(self, backend: str) -> AdmissionRejected:
+        return self._reject(backend, "timeout", "Le LLM est saturé, veuillez réessayer plus tard", 503)
+
+    def _admitted(self, backend: str, started: float) -> None:
+        metrics.inc("chatmd_llm_admissions_total", backend=backend, result="admitted")
+        metrics.observe("chatmd_llm_queue_wait_seconds", time.perf_counter() - started, backend=backend)
+
+    def check(self, backend: str) -> None:
+        """Refuse immédiatement (429) si le backend est saturé et sa file d'attente pleine, sans réserver de place
+
+        Utilisé par les routes en flux avant l'envoi des en-têtes: la place
+        est réservée ensuite par le service LLM.
+        """
+        slots = self._backend_slots(backend)
+        if slots is None:
+            return
+        if slots["active"].count() >= slots["active"].size and slots["waiting"].count() >= slots["waiting"].size:
+            raise self._queue_full(backend)
+
+    def _join_queue(self, backend: str, slots: Dict[str, _Slots], background: bool) -> Tuple[Optional[Any], float]:
+        """Prend une place dans la file d'attente: (ticket, échéance de l'attente)
+
+        Une tâche de fond attend même si la file est pleine (sans ticket):
+        la refuser ferait échouer un travail déjà accepté par la file de tâches.
+        """
+        ticket = slots["waiting"].try_acquire()
+        if ticket is None and not background:
+            raise self._queue_full(backend)
+        timeout = self.job_queue_timeout if background else self.queue_timeout
+        return ticket, time.monotonic() + timeout
+
+    @contextmanager
+    def slot(self, backend: str, background: bool = False) -> Iterator[None]:
+        """Occupe une place du backend pendant le bloc, après une attente éventuelle dans la file
+
+        background: tâche de fond (tâche asynchrone, document d'un lot), soumise
+        à job_queue_timeout au lieu du délai des requêtes interactives.
+        """
+        slots = self._backend_slots(backend)
+        if slots is None:
+            yield
+            return
+
+        started = time.perf_counter()
+        token = slots["active"].try_acquire()
+        if token is None:
+            ticket, deadline = self._join_queue(backend, slots, background)
+            try:
+                with span("admission"):
+                    while token is None:
+                        if time.monotonic() >= deadline:
+                            raise self._timed_out(backend)
+                        time.sleep(POLL_INTERVAL)
+                        if ticket is None:
+                            ticket = slots["waiting"].try_acquire()
+                        token = slots["active"].try_acquire()
+            finally:
+                if ticket is not None:
+                    slots["waiting"].release(ticket)
+
+        self._admitted(backend, started)
+        try:
+            yield
+        finally:
+            slots["active"].release(token)
+
+    @asynccontextmanager
+    async def slot_async(self, backend: str, background: bool = False) -> AsyncIterator[None]:
+        """Version asyncio de slot(): l'attente ne bloque pas la boucle d'événements"""
+        slots = self._backend_slots(backend)
+        if slots is None:
+            yield
+            return
+
+        started = time.perf_counter()
+        token = slots["active"].try_acquire()
+        if token is None:
+            ticket, deadline = self._join_queue(backend, slots, background)
+            try:
+                while token is None:
+                    if time.monotonic() >= deadline:
+                        raise self._timed_out(backend)
+                    await asyncio.sleep(POLL_INTERVAL)
+                    if ticket is None:
+                        ticket = slots["waiting"].try_acquire()
+                    token = slots["active"].try_acquire()
+            finally:
+                if ticket is not None:
+                    slots["waiting"].release(ticket)
+
+        self._admitted(backend, started)
+        try:
+            yield
+        finally:
+            slots["active"].release(token)
+
+    def limit(self, backend: str) -> Optional[int]:
+        """Nombre maximal de générations simultanées du backend (None: sans limite)"""
+        return self.concurrency.get(backend) or None
+
+    def queue_length(self, backend: str) -> int:
+        """Nombre de demandes en attente d'une place pour le backend"""
+        slots = self._backend_slots(backend)
+        return slots["waiting"].count() if slots else 0
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """Places occupées et demandes en attente par backend"""
+        snapshot = {}
+        for backend in self.concurrency:
+            slots = self._backend_slots(backend)
+            if slots is None:
+                continue
+            snapshot[backend] = {
+                "limit": slots["active"].size,
+                "active": slots["active"].count(),
+                "waiting": slots["waiting"].count(),
+                "max_waiting": slots["waiting"].size,
+            }
+        return snapshot
+
+
+class RateLimiter:
+    """Limite de débit par client (seau de jetons), partagée entre les workers gunicorn
+
+    Chaque client dispose de burst jetons, regagnés au rythme de
+    per_minute par minute; une demande consomme un jeton. L'état d'un
+    client est un petit fichier JSON, modifié sous verrou fcntl.flock.
+    per_minute = 0 désactive la limite.
+    """
+
+    def __init__(self, state_dir: Optional[str] = None, per_minute: float = 0, burst: int = 1):
+        self.state_dir = state_dir or os.path.join(tempfile.gettempdir(), "chatmd_admission")
+        self.per_minute = per_minute
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict[str, float]] = {}
+        self._checks = 0
+
+    def configure(self, state_dir: Optional[str] = None, per_minute: Optional[float] = None,
+                  burst: Optional[int] = None) -> None:
+        """Change le répertoire partagé et la limite (configuration de l'application)"""
+        if state_dir:
+            self.state_dir = state_dir
+        if per_minute is not None:
+            self.per_minute = per_minute
+        if burst is not None:
+            self.burst = burst
+
+    @property
+    def _clients_dir(self) -> str:
+        return os.path.join(self.state_dir, "clients")
+
+    def _take(self, bucket: Dict[str, float], now: float) -> Optional[int]:
+        """Consomme un jeton du seau; retourne None, ou le délai en secondes avant le prochain jeton"""
+        rate = self.per_minute / 60.0
+        capacity = max(1, self.burst)
+        tokens = min(capacity, bucket.get("tokens", capacity) + (now - bucket.get("updated", now)) * rate)
+        bucket["updated"] = now
+        if tokens < 1:
+            bucket["tokens"] = tokens
+            return max(1, math.ceil((1 - tokens) / rate))
+        bucket["tokens"] = tokens - 1
+        return None
+
+    def check(self, client: str) -> None:
+        """Consomme un jeton pour le client, ou lève AdmissionRejected (429) si son seau est vide"""
+        if not self.per_minute or self.per_minute <= 0:
+            return
+
+        now = time.time()
+        if fcntl is None:
+            with self._lock:
+                retry_after = self._take(self._buckets.setdefault(client, {}), now)
+        else:
+            os.makedirs(self._clients_dir, exist_ok=True)
+            # Nom de fichier dérivé du client: adresse IP ou identifiant de session
+            name = hashlib.sha256(client.encode("utf-8")).hexdigest()[:32]
+            with open(os.path.join(self._clients_dir, f"{name}.json"), "a+", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    bucket = json.loads(f.read() or "{}")
+                except ValueError:
+                    bucket = {}
+                retry_after = self._take(bucket, now)
+                f.seek(0)
+                f.truncate()
+                json.dump(bucket, f)
+
+        self._checks += 1
+        if self._checks % PRUNE_EVERY == 0:
+            self._prune(now)
+
+        if retry_after is not None:
+            metrics.inc("chatmd_rate_limited_total")
+            logger.warning(f"Limite de débit atteinte pour {client}")
+            raise AdmissionRejected("Trop de demandes, veuillez patienter avant de réessayer", 429, retry_after)
+
+    def _prune(self, now: float) -> None:
+        """Oublie les clients dont le seau est plein depuis longtemps (équivalent à un client inconnu)"""
+        idle = max(1, self.burst) * 60.0 / self.per_minute
+        if fcntl is None:
+            with self._lock:
+                for client in [c for c, bucket in self._buckets.items() if now - bucket["updated"] > idle]:
+                    del self._buckets[client]
+            return
+
+        try:
+            names = os.listdir(self._clients_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self._clients_dir, name)
+            try:
+                if now - os.path.getmtime(path) > idle:
+                    os.remove(path)
+            except OSError:
+                continue
+
+
+admission = AdmissionController()
+rate_limiter = RateLimiter()
@@ -0,0 +1,278 @@
+import io
+import json
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, Optional, Tuple, Union
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.wrappers import Request
+from werkzeug.utils import secure_filename
+import wsgi
+from async_llm_service import AsyncLLMService
+from admission import AdmissionRejected, admission, rate_limiter
+from http_pool import close_async_clients
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# httpx journalise chaque requête au niveau INFO: les appels au LLM sont déjà suivis par llm_service.usage
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Application Flask (toutes les routes), exécutée dans des threads
+flask_application = WsgiToAsgi(wsgi.app)
+
+# Services asynchrones par mode (local, online, offline), qui suivent le mode choisi dans l'application Flask
+_async_services: Dict[str, AsyncLLMService] = {}
+
+# Réponse d'une route: (code, JSON), (code, JSON, en-têtes) ou flux d'événements SSE
+RouteResult = Union[Tuple[int, Dict[str, Any]], Tuple[int, Dict[str, Any], Dict[str, str]], AsyncIterator[str]]
+
+
+def async_llm_service() -> AsyncLLMService:
+    """Service asynchrone correspondant au mode LLM courant (/api/toggle-llm-mode)"""
+    mode = wsgi.llm_service.mode
+    service = _async_services.get(mode)
+    if service is None:
+        service = _async_services[mode] = AsyncLLMService(use_online=mode == 'online', cache=wsgi.generation_cache,
+                                                          use_offline=mode == 'offline')
+    return service
+
+
+async def read_request(scope: Dict[str, Any], receive) -> Request:
+    """Lit le corps de la requête et le présente comme une requête Werkzeug (formulaires, fichiers, JSON)"""
+    body = io.BytesIO()
+    more_body = True
+    while more_body:
+        message = await receive()
+        body.write(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    body.seek(0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+        'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(body.getbuffer().nbytes),
+        'wsgi.input': body,
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value.decode('latin-1')
+        elif name != 'CONTENT_LENGTH':
+            environ[f'HTTP_{name}'] = value.decode('latin-1')
+    return Request(environ)
+
+
+async def send_json(send, status: int, data: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+    body = json.dumps(data).encode('utf-8')
+    extra_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()]
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                + extra_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_sse(send, events: AsyncIterator[str]) -> None:
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),  # Désactiver la mise en tampon de Nginx
+    ]})
+    try:
+        async for event in events:
+            await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+    finally:
+        # Client déconnecté ou fin du flux: fermer le générateur ferme la connexion au LLM
+        await events.aclose()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def admission_error(error: AdmissionRejected) -> RouteResult:
+    """Réponse d'une demande refusée par le contrôle d'admission ou la limite de débit"""
+    return error.status, {'error': str(error)}, {'Retry-After': str(error.retry_after)}
+
+
+def check_rate_limit(request: Request) -> None:
+    """Consomme un jeton du client (voir wsgi.limit_llm_requests); la session est lue sans être créée"""
+    client_session = wsgi.app.session_interface.open_session(wsgi.app, request) or {}
+    rate_limiter.check(wsgi.rate_limit_client(request, client_session))
+
+
+async def process_document(request: Request) -> Tuple[Optional[Tuple[int, Dict[str, Any]]], Optional[str], Dict[str, Any]]:
+    """Extrait le texte du document uploadé: (erreur, contenu, paramètres)"""
+    if 'document' not in request.files:
+        return (400, {'error': 'Aucun fichier fourni'}), None, {}
+
+    file = request.files['document']
+    if file.filename == '':
+        return (400, {'error': 'Aucun fichier sélectionné'}), None, {}
+
+    params = wsgi.get_generation_params(request.form)
+    content = await asyncio.to_thread(wsgi.document_processor.process_bytes, file.read(),
+                                      secure_filename(file.filename), params)
+    if not content:
+        return (400, {'error': 'Impossible de traiter le document'}), None, params
+    return None, content, params
+
+
+async def generate_from_document(request: Request) -> RouteResult:
+    """Génère un chatbot à partir d'un document uploadé"""
+    try:
+        error, content, params = await process_document(request)
+        if error:
+            return error
+
+        markdown = await async_llm_service().generate_chatmd(content, params, use_cache=wsgi.use_cache_requested(request.form))
+        if not markdown:
+            return 500, {'error': 'Erreur: Erreur lors de la génération du chatbot'}
+
+        validation = await asyncio.to_thread(wsgi.validate_generated_chatmd, markdown, params)
+        return 200, {'markdown': markdown, 'validation': validation, 'status': 'success'}
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except Exception as e:
+        logger.error(f"Erreur lors de la génération du chatbot: {str(e)}")
+        return 500, {'error': f'Erreur: {str(e)}'}
+
+
+async def suggest_improvements(request: Request) -> RouteResult:
+    """Suggère des améliorations pour un chatbot existant"""
+    data = request.get_json(silent=True)
+    if not data or 'markdown' not in data:
+        return 400, {'error': 'Aucun contenu fourni'}
+
+    try:
+        suggestions = await async_llm_service().suggest_improvements(data.get('markdown'), data.get('section'))
+        if not suggestions:
+            return 500, {'error': 'Erreur lors de la génération des suggestions'}
+        return 200, {'suggestions': suggestions, 'status': 'success'}
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except Exception as e:
+        logger.error(f"Erreur lors de la génération des suggestions: {str(e)}")
+        return 500, {'error': f'Erreur: {str(e)}'}
+
+
+async def stream_suggest_improvements(request: Request) -> RouteResult:
+    """Suggère des améliorations en relayant les tokens du LLM au fil de l'eau (SSE)"""
+    data = request.get_json(silent=True)
+    if not data or 'markdown' not in data:
+        return 400, {'error': 'Aucun contenu fourni'}
+
+    service = async_llm_service()
+    try:
+        await asyncio.to_thread(admission.check, service.mode)
+    except AdmissionRejected as e:
+        return admission_error(e)
+
+    async def events():
+        stream = service.stream_suggestions(data.get('markdown'), data.get('section'))
+        try:
+            async for fragment in stream:
+                yield wsgi.sse_event('token', {'content': fragment})
+            yield wsgi.sse_event('done', {'status': 'success'})
+        except Exception as e:
+            logger.error(f"Erreur lors du streaming des suggestions: {str(e)}")
+            yield wsgi.sse_event('error', {'error': f'Erreur: {str(e)}'})
+        finally:
+            await stream.aclose()
+
+    return events()
+
+
+async def stream_generate_from_document(request: Request) -> RouteResult:
+    """Génère un chatbot en relayant les tokens du LLM au fil de l'eau (SSE)"""
+    try:
+        error, content, params = await process_document(request)
+        if error:
+            return error
+    except Exception as e:
+        logger.error(f"Erreur lors du traitement du document: {str(e)}")
+        return 500, {'error': f'Erreur: {str(e)}'}
+
+    service = async_llm_service()
+    use_cache = wsgi.use_cache_requested(request.form)
+    try:
+        await asyncio.to_thread(admission.check, service.mode)
+    except AdmissionRejected as e:
+        return admission_error(e)
+
+    async def events():
+        stream = service.stream_chatmd(content, params, use_cache=use_cache)
+        try:
+            async for event, payload in stream:
+                if event == 'token':
+                    yield wsgi.sse_event('token', {'content': payload})
+                elif event == 'response':
+                    yield wsgi.sse_event('response', {'title': payload})
+                elif payload:
+                    yield wsgi.sse_event('result', {
+                        'markdown': payload,
+                        'validation': await asyncio.to_thread(wsgi.validate_generated_chatmd, payload, params),
+                        'status': 'success'
+                    })
+                else:
+                    yield wsgi.sse_event('error', {'error': 'Erreur lors de la génération du chatbot'})
+            yield wsgi.sse_event('done', {'status': 'success'})
+        except Exception as e:
+            logger.error(f"Erreur lors du streaming de la génération: {str(e)}")
+            yield wsgi.sse_event('error', {'error': f'Erreur: {str(e)}'})
+        finally:
+            await stream.aclose()
+
+    return events()
+
+
+# Routes servies en asynchrone (appels au LLM); les autres sont transmises à l'application Flask
+ASYNC_ROUTES = {
+    ('POST', '/api/generate-from-document'): generate_from_document,
+    ('POST', '/api/suggest-improvements'): suggest_improvements,
+    ('POST', '/api/stream/suggest-improvements'): stream_suggest_improvements,
+    ('POST', '/api/stream/generate-from-document'): stream_generate_from_document,
+}
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send) -> None:
+    """Point d'entrée ASGI: routes du LLM en asynchrone, reste de l'application Flask dans des threads"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler = ASYNC_ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        await flask_application(scope, receive, send)
+        return
+
+    started = time.perf_counter()
+    request = await read_request(scope, receive)
+    try:
+        await asyncio.to_thread(check_rate_limit, request)
+        result = await handler(request)
+    except AdmissionRejected as e:
+        result = admission_error(e)
+    # Comme pour Flask, la durée d'un flux SSE est mesurée jusqu'à l'envoi des en-têtes
+    status = result[0] if isinstance(result, tuple) else 200
+    metrics.observe('chatmd_http_request_duration_seconds', time.perf_counter() - started,
+                    route=scope['path'], method=scope['method'], status=status)
+    if isinstance(result, tuple):
+        await send_json(send, status, *result[1:])
+    else:
+        await send_sse(send, result)
@@ -0,0 +1,428 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
+from http_pool import async_post
+from chunking import estimate_tokens, split_into_chunks
+from backend_stats import backend_stats
+from metrics import metrics
+from json_repair import StreamingChatbotParser
+from chatbot_schema import CHATBOT_SCHEMA, RESPONSES_SCHEMA
+from single_flight import single_flight
+from admission import admission
+from token_budget import blocks_completion_tokens
+from llm_service import LLMService, _STREAM_DONE
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLLMService(LLMService):
+    """Variante asynchrone (asyncio, httpx) de LLMService, pour le point d'entrée ASGI
+
+    Mêmes méthodes et même comportement que LLMService (repli du LLM local
+    vers l'API en ligne, requêtes doublées, disjoncteurs, cache, budget de
+    tokens, sortie structurée et tentatives ciblées), mais les appels au LLM
+    sont des coroutines: un processus peut attendre des centaines de
+    générations sans leur consacrer un thread chacune. Les traitements de
+    calcul et les accès au cache restent synchrones et sont exécutés dans un
+    thread pour ne pas bloquer la boucle d'événements.
+    """
+
+    async def _call_api(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                        json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None) -> Optional[str]:
+        """Appelle le LLM du mode courant et retourne la réponse (voir LLMService._call_api)"""
+        if self.use_offline:
+            return None
+        if self.hedge:
+            return await self._call_hedged(messages, temperature, json_schema, max_tokens)
+        if self.use_online:
+            return await self._call_online_api(messages, temperature, json_schema, max_tokens)
+        if not backend_stats.allow("local"):
+            logger.info("LLM local indisponible (disjoncteur ouvert), appel direct à l'API en ligne")
+            return await self._call_online_api(messages, temperature, json_schema, max_tokens)
+
+        try:
+            return await self._call_backend("local", messages, temperature, json_schema, max_tokens)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'appel à l'API LLM locale: {str(e)}")
+            backend_stats.record_failure("local", str(e))
+            # En cas d'erreur avec l'API locale, essayer l'API en ligne comme fallback
+            logger.info("Tentative de fallback vers l'API en ligne...")
+            metrics.inc("chatmd_llm_fallbacks_total", kind="local_to_online")
+            return await self._call_online_api(messages, temperature, json_schema, max_tokens)
+
+    async def _call_online_api(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                               json_schema: Optional[Dict[str, Any]] = None,
+                               max_tokens: Optional[int] = None) -> Optional[str]:
+        """Appelle l'API Mistral en ligne et retourne la réponse"""
+        if not backend_stats.allow("online"):
+            logger.warning("API en ligne indisponible (disjoncteur ouvert)")
+            return None
+
+        try:
+            return await self._call_backend("online", messages, temperature, json_schema, max_tokens)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'appel à l'API Mistral en ligne: {str(e)}")
+            backend_stats.record_failure("online", str(e))
+            return None
+
+    async def _call_backend(self, backend: str, messages: List[Dict[str, str]], temperature: float,
+                            json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None) -> str:
+        """Appel non diffusé à un backend; les erreurs sont levées et enregistrées par l'appelant"""
+        url, headers, payload, limit = self._build_request(backend, messages, temperature, json_schema, max_tokens)
+
+        started = time.perf_counter()
+        response = await async_post(backend, url, headers, payload)
+        if self._rejects_response_format(backend, response, payload):
+            response = await async_post(backend, url, headers, payload)
+        response.raise_for_status()
+
+        result = response.json()
+        content = result["choices"][0]["message"]["content"]
+        backend_stats.record_success(backend, time.perf_counter() - started)
+        self._record_usage(backend, payload["messages"], content, result.get("usage"), limit,
+                           time.perf_counter() - started)
+        return content
+
+    async def _call_hedged(self, messages: List[Dict[str, str]], temperature: float,
+                           json_schema: Optional[Dict[str, Any]] = None,
+                           max_tokens: Optional[int] = None) -> Optional[str]:
+        """Appelle le backend principal puis, s'il tarde ou échoue, le second en parallèle
+
+        Même logique que LLMService._call_hedged, avec des tâches asyncio:
+        la tâche perdante est annulée, ce qui ferme sa connexion.
+        """
+        # Les backends dont le disjoncteur est ouvert ne sont pas interrogés
+        backends = [backend for backend in (("online", "local") if self.use_online else ("local", "online"))
+                    if backend_stats.allow(backend)]
+        if not backends:
+            logger.error("Aucun backend disponible (disjoncteurs ouverts)")
+            backend_stats.record_hedge(None, {}, False, [])
+            return None
+        primary = backends[0]
+        secondary = backends[1] if len(backends) > 1 else None
+        delay = backend_stats.latency_percentile(primary, self.hedge_percentile, self.hedge_min_samples)
+        if delay is None:
+            delay = self.hedge_delay
+
+        started_at = {}
+        latencies = {}
+        winner = None
+        result = None
+        hedged = False
+        pending: Dict[asyncio.Task, str] = {}
+
+        def launch(backend: str) -> None:
+            started_at[backend] = time.perf_counter()
+            task = asyncio.ensure_future(self._collect_backend(backend, messages, temperature, json_schema, max_tokens))
+            pending[task] = backend
+
+        try:
+            launch(primary)
+            while pending and winner is None:
+                done, _ = await asyncio.wait(pending, timeout=None if hedged or not secondary else delay,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"Pas de réponse de {primary} après {delay:.1f}s, requête doublée vers {secondary}")
+                    hedged = True
+                    launch(secondary)
+                    continue
+
+                for task in done:
+                    backend = pending.pop(task)
+                    text, latencies[backend] = task.result()
+                    if text and winner is None:
+                        winner, result = backend, text
+                    elif not text and not hedged and secondary:
+                        # Échec du principal avant le délai: interroger le second sans attendre
+                        hedged = True
+                        launch(secondary)
+        finally:
+            cancelled = []
+            for task, backend in pending.items():
+                task.cancel()
+                latencies[backend] = time.perf_counter() - started_at[backend]
+                cancelled.append(backend)
+
+        latencies = {backend: round(seconds, 3) for backend, seconds in latencies.items()}
+        backend_stats.record_hedge(winner, latencies, hedged, cancelled)
+        if winner:
+            logger.info(f"Réponse de {winner} (latences: {latencies}, annulés: {cancelled})")
+        else:
+            logger.error(f"Aucun backend n'a répondu (latences: {latencies})")
+        return result
+
+    async def _collect_backend(self, backend: str, messages: List[Dict[str, str]], temperature: float,
+                               json_schema: Optional[Dict[str, Any]] = None,
+                               max_tokens: Optional[int] = None) -> Tuple[Optional[str], float]:
+        """Lit la réponse complète d'un backend en streaming; l'annulation de la tâche ferme la connexion"""
+        started = time.perf_counter()
+        fragments = []
+        stream = self._stream_backend(backend, messages, temperature, json_schema, max_tokens)
+        try:
+            async for fragment in stream:
+                fragments.append(fragment)
+        except asyncio.CancelledError:
+            logger.info(f"Requête vers {backend} annulée: l'autre backend a répondu")
+            raise
+        except Exception as e:
+            logger.error(f"Erreur lors de l'appel au backend {backend}: {str(e)}")
+            return None, time.perf_counter() - started
+        finally:
+            await stream.aclose()
+
+        text = "".join(fragments)
+        return text or None, time.perf_counter() - started
+
+    async def _stream_api(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                          json_schema: Optional[Dict[str, Any]] = None,
+                          max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        """Appelle le LLM en mode streaming et produit les fragments de texte au fil de l'eau"""
+        if self.use_offline:
+            return
+        if not self.use_online and not backend_stats.allow("local"):
+            logger.info("LLM local indisponible (disjoncteur ouvert), appel direct à l'API en ligne")
+        elif not self.use_online:
+            started = False
+            try:
+                async for chunk in self._stream_backend("local", messages, temperature, json_schema, max_tokens):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                logger.error(f"Erreur lors de l'appel en streaming à l'API LLM locale: {str(e)}")
+                # Impossible de basculer si des fragments ont déjà été envoyés au client
+                if started:
+                    raise
+                logger.info("Tentative de fallback vers l'API en ligne...")
+                metrics.inc("chatmd_llm_fallbacks_total", kind="local_to_online")
+
+        if not backend_stats.allow("online"):
+            raise RuntimeError("API en ligne indisponible (disjoncteur ouvert)")
+
+        try:
+            async for chunk in self._stream_backend("online", messages, temperature, json_schema, max_tokens):
+                yield chunk
+        except Exception as e:
+            logger.error(f"Erreur lors de l'appel en streaming à l'API Mistral en ligne: {str(e)}")
+            raise
+
+    async def _stream_backend(self, backend: str, messages: List[Dict[str, str]], temperature: float,
+                              json_schema: Optional[Dict[str, Any]] = None,
+                              max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        """Lit le flux SSE compatible OpenAI (stream: true) d'un backend et produit le texte des deltas"""
+        url, headers, payload, limit = self._build_request(backend, messages, temperature, json_schema, max_tokens,
+                                                           stream=True)
+
+        # Un flux annulé ou abandonné (CancelledError, GeneratorExit) n'est compté ni comme succès ni comme échec
+        started = time.perf_counter()
+        fragments = []
+        usage = None
+        try:
+            response = await async_post(backend, url, headers, payload, stream=True)
+            if response.status_code in (400, 422):
+                await response.aread()  # Message d'erreur examiné par _rejects_response_format
+            if self._rejects_response_format(backend, response, payload):
+                await response.aclose()
+                response = await async_post(backend, url, headers, payload, stream=True)
+            try:
+                response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    chunk = self._parse_stream_line(line)
+                    if chunk is None:
+                        continue
+                    if chunk is _STREAM_DONE:
+                        break
+
+                    # Certains serveurs joignent le décompte des tokens au dernier fragment
+                    usage = chunk.get("usage") or usage
+                    choices = chunk.get("choices") or [{}]
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        fragments.append(content)
+                        yield content
+            finally:
+                await response.aclose()
+        except Exception as e:
+            backend_stats.record_failure(backend, str(e))
+            raise
+        backend_stats.record_success(backend, time.perf_counter() - started)
+        self._record_usage(backend, payload["messages"], "".join(fragments), usage, limit, time.perf_counter() - started)
+
+    async def _condense_document(self, content: str, max_tokens: Optional[int] = None) -> str:
+        """Réduit un document trop long en plans résumés par morceaux, au plus _map_concurrency() appels simultanés"""
+        budget = min(self.chunk_tokens, max_tokens) if max_tokens else self.chunk_tokens
+        # Plusieurs passes au maximum si les plans concaténés dépassent encore le budget
+        for _ in range(3):
+            if estimate_tokens(content) <= budget:
+                break
+
+            chunks = split_into_chunks(content, budget)
+            logger.info(f"Document trop long ({estimate_tokens(content)} tokens estimés), découpage en {len(chunks)} morceaux")
+
+            semaphore = asyncio.Semaphore(self._map_concurrency())
+
+            async def outline(index: int, chunk: str) -> Optional[str]:
+                async with semaphore:
+                    return await self._outline_chunk(chunk, index, len(chunks))
+
+            outlines = await asyncio.gather(*(outline(index, chunk) for index, chunk in enumerate(chunks, 1)))
+            content = self._join_outlines(chunks, outlines, budget)
+
+        return content
+
+    async def _outline_chunk(self, chunk: str, index: int, total: int) -> Optional[str]:
+        """Résume un morceau de document sous forme de plan structuré"""
+        return await self._call_api(self._outline_messages(chunk, index, total), temperature=0.3)
+
+    async def _build_chatmd_messages(self, content: str, params: Dict[str, Any]) -> List[Dict[str, str]]:
+        """Construit les messages envoyés au LLM pour la génération d'un chatbot"""
+        condensed = await self._condense_document(content, self._document_budget(params))
+        return self._chatmd_messages(content, condensed, params)
+
+    async def _generate_offline(self, content: str, params: Dict[str, Any]) -> str:
+        """Génère un chatbot sans LLM (dans un thread: l'extraction est un calcul)"""
+        return await asyncio.to_thread(super()._generate_offline, content, params)
+
+    async def generate_chatmd(self, content: str, params: Dict[str, Any], use_cache: bool = True,
+                              background: bool = False) -> Optional[str]:
+        """Génère un chatbot au format ChatMD à partir du contenu"""
+        if self.use_offline:
+            return await self._generate_offline(content, params)
+
+        cache_key, cached = await asyncio.to_thread(self._get_cached_chatmd, content, params, use_cache)
+        if cached:
+            return cached
+
+        return await single_flight.do_async(self._cache_key(content, params), self._generate_chatmd,
+                                            content, params, cache_key, background)
+
+    async def _generate_chatmd(self, content: str, params: Dict[str, Any], cache_key: Optional[str],
+                               background: bool = False) -> Optional[str]:
+        async with admission.slot_async(self.mode, background):
+            return await self._generate_admitted_chatmd(content, params, cache_key)
+
+    async def _generate_admitted_chatmd(self, content: str, params: Dict[str, Any],
+                                        cache_key: Optional[str]) -> Optional[str]:
+        messages = await self._build_chatmd_messages(content, params)
+
+        # Obtenir la réponse JSON du LLM
+        json_response = await self._call_api(messages, temperature=0.7, json_schema=CHATBOT_SCHEMA,
+                                             max_tokens=self._chatbot_max_tokens(params))
+        if not json_response:
+            # Mode dégradé, non mis en cache: le LLM pourra être utilisé dès son retour
+            logger.error("Aucune réponse reçue du LLM, génération extractive hors ligne")
+            metrics.inc("chatmd_llm_fallbacks_total", kind="llm_to_offline")
+            return await self._generate_offline(content, params)
+
+        markdown = await self._chatmd_from_response(json_response, content, params, messages)
+        if markdown and cache_key:
+            await asyncio.to_thread(self.cache.set, cache_key, markdown)
+        return markdown
+
+    async def stream_chatmd(self, content: str, params: Dict[str, Any],
+                            use_cache: bool = True) -> AsyncIterator[Tuple[str, str]]:
+        """Génère un chatbot en streaming: mêmes couples que LLMService.stream_chatmd"""
+        if self.use_offline:
+            yield "result", await self._generate_offline(content, params)
+            return
+
+        cache_key, cached = await asyncio.to_thread(self._get_cached_chatmd, content, params, use_cache)
+        if cached:
+            yield "result", cached
+            return
+
+        async with admission.slot_async(self.mode):
+            stream = self._stream_admitted_chatmd(content, params, cache_key)
+            try:
+                async for item in stream:
+                    yield item
+            finally:
+                await stream.aclose()
+
+    async def _stream_admitted_chatmd(self, content: str, params: Dict[str, Any],
+                                      cache_key: Optional[str]) -> AsyncIterator[Tuple[str, str]]:
+        messages = await self._build_chatmd_messages(content, params)
+
+        fragments = []
+        parser = StreamingChatbotParser()
+        interrupted = False
+        stream = self._stream_api(messages, temperature=0.7, json_schema=CHATBOT_SCHEMA,
+                                  max_tokens=self._chatbot_max_tokens(params))
+        try:
+            async for fragment in stream:
+                fragments.append(fragment)
+                yield "token", fragment
+                for title, _ in parser.feed(fragment):
+                    yield "response", title
+        except Exception as e:
+            # Aucun backend disponible: mode dégradé; flux coupé: récupération des réponses complètes
+            if fragments:
+                logger.error(f"Flux interrompu après {len(parser.completed)} réponse(s) complète(s): {str(e)}")
+                interrupted = True
+        finally:
+            await stream.aclose()
+
+        json_response = "".join(fragments)
+        if not json_response:
+            logger.error("Aucune réponse reçue du LLM, génération extractive hors ligne")
+            metrics.inc("chatmd_llm_fallbacks_total", kind="llm_to_offline")
+            yield "result", await self._generate_offline(content, params)
+            return
+
+        markdown = await self._chatmd_from_response(json_response, content, params, messages)
+        if markdown and cache_key and not interrupted:
+            await asyncio.to_thread(self.cache.set, cache_key, markdown)
+        yield "result", markdown
+
+    async def _chatmd_from_response(self, json_response: str, content: str, params: Dict[str, Any],
+                                    messages: Optional[List[Dict[str, str]]] = None) -> Optional[str]:
+        """Convertit la réponse JSON du LLM en ChatMD, avec repli sur la méthode directe"""
+        logger.info(f"Réponse brute du LLM: {json_response[:100]}...")
+
+        try:
+            chatbot_data = self._parse_chatbot_response(json_response)
+            if chatbot_data is None:
+                return await asyncio.to_thread(self._generate_chatmd_direct, content, params)
+
+            if messages:
+                chatbot_data = await self._complete_chatbot(chatbot_data, messages)
+
+            return self._json_to_chatmd(chatbot_data)
+        except Exception as e:
+            logger.error(f"Erreur lors de la conversion JSON vers ChatMD: {str(e)}")
+            return await asyncio.to_thread(self._generate_chatmd_direct, content, params)
+
+    async def _complete_chatbot(self, chatbot_data: Dict[str, Any], messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """Redemande au LLM uniquement les blocs manquants ou invalides (voir LLMService._complete_chatbot)"""
+        for attempt in range(1, self.repair_rounds + 1):
+            wanted = self._repair_targets(chatbot_data, attempt)
+            if not wanted:
+                break
+
+            response = await self._call_api(self._build_repair_messages(chatbot_data, messages, wanted),
+                                            temperature=0.5, json_schema=RESPONSES_SCHEMA,
+                                            max_tokens=blocks_completion_tokens(len(wanted)))
+            if not self._apply_repair_blocks(chatbot_data, wanted, response):
+                break
+
+        self._warn_incomplete(chatbot_data)
+        return chatbot_data
+
+    async def suggest_improvements(self, current_markdown: str, section: str = None) -> Optional[str]:
+        """Suggère des améliorations pour le markdown actuel"""
+        messages = self._build_suggestion_messages(current_markdown, section)
+        async with admission.slot_async(self.mode):
+            return await self._call_api(messages, temperature=0.8)
+
+    async def stream_suggestions(self, current_markdown: str, section: str = None) -> AsyncIterator[str]:
+        """Suggère des améliorations en produisant le texte au fil de la génération"""
+        messages = self._build_suggestion_messages(current_markdown, section)
+        async with admission.slot_async(self.mode):
+            stream = self._stream_api(messages, temperature=0.8)
+            try:
+                async for fragment in stream:
+                    yield fragment
+            finally:
+                await stream.aclose()
@@ -0,0 +1,173 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, Deque, List, Optional
+from dotenv import load_dotenv
+from metrics import metrics
+
+# Charger les variables d'environnement depuis le fichier .env (seuils du disjoncteur)
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Bornes supérieures (en secondes) des classes de l'histogramme des latences
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+
+# États du disjoncteur
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class _BackendHealth:
+    """État de santé d'un backend: résultats récents, latences et disjoncteur"""
+
+    def __init__(self, window: int):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.requests = 0
+        self.errors = 0
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[Dict[str, Any]] = None
+        self.last_success_at: Optional[str] = None
+
+
+class BackendStats:
+    """Santé, latences et résultats des requêtes doublées, par backend LLM
+
+    Après failure_threshold échecs consécutifs, le disjoncteur d'un backend
+    s'ouvre: les appels vont directement à l'autre backend. Au bout de
+    reset_seconds, il passe en semi-ouvert et laisse passer des appels
+    d'essai; le premier succès le referme, le premier échec le rouvre.
+
+    Les statistiques sont partagées au niveau du module (backend_stats) pour
+    survivre au remplacement de l'instance LLMService lors d'un changement
+    de mode; elles sont propres à chaque processus.
+    """
+
+    def __init__(self, window: int = 200, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._backends: Dict[str, _BackendHealth] = {}
+        self._hedges = {"calls": 0, "hedged": 0, "wins": {}, "failures": 0, "last": None}
+        self._lock = threading.Lock()
+
+    def _health(self, backend: str) -> _BackendHealth:
+        health = self._backends.get(backend)
+        if health is None:
+            health = self._backends[backend] = _BackendHealth(self.window)
+        return health
+
+    def allow(self, backend: str) -> bool:
+        """Indique si un appel peut être envoyé au backend (disjoncteur fermé ou semi-ouvert)"""
+        with self._lock:
+            health = self._health(backend)
+            if health.state == OPEN and time.monotonic() - health.opened_at >= self.reset_seconds:
+                health.state = HALF_OPEN
+                logger.info(f"Disjoncteur semi-ouvert pour {backend}: appels d'essai autorisés")
+            return health.state != OPEN
+
+    def record_success(self, backend: str, seconds: float) -> None:
+        """Enregistre une réponse complète d'un backend et sa durée"""
+        metrics.observe("chatmd_llm_request_duration_seconds", seconds, backend=backend)
+        with self._lock:
+            health = self._health(backend)
+            health.requests += 1
+            health.outcomes.append(True)
+            health.latencies.append(seconds)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    health.histogram[index] += 1
+                    break
+            health.consecutive_failures = 0
+            health.last_success_at = datetime.now().isoformat(timespec="seconds")
+            if health.state != CLOSED:
+                logger.info(f"Disjoncteur refermé pour {backend}")
+                health.state = CLOSED
+                health.opened_at = None
+
+    def record_failure(self, backend: str, error: str) -> None:
+        """Enregistre un échec d'appel à un backend, et ouvre le disjoncteur si nécessaire"""
+        metrics.inc("chatmd_llm_errors_total", backend=backend)
+        with self._lock:
+            health = self._health(backend)
+            health.requests += 1
+            health.errors += 1
+            health.outcomes.append(False)
+            health.consecutive_failures += 1
+            health.last_error = {"message": error, "at": datetime.now().isoformat(timespec="seconds")}
+            if health.state == HALF_OPEN or (health.state == CLOSED and
+                                             health.consecutive_failures >= self.failure_threshold):
+                logger.warning(f"Disjoncteur ouvert pour {backend} après {health.consecutive_failures} échec(s): {error}")
+                health.state = OPEN
+                health.opened_at = time.monotonic()
+
+    def latency_percentile(self, backend: str, percentile: float, min_samples: int = 1) -> Optional[float]:
+        """Percentile des latences récentes d'un backend, ou None s'il y a moins de min_samples mesures"""
+        with self._lock:
+            samples = sorted(self._health(backend).latencies)
+        if not samples or len(samples) < min_samples:
+            return None
+        rank = max(0, math.ceil(percentile / 100 * len(samples)) - 1)
+        return samples[min(rank, len(samples) - 1)]
+
+    def record_hedge(self, winner: Optional[str], latencies: Dict[str, float], hedged: bool,
+                     cancelled: List[str]) -> None:
+        """Enregistre le résultat d'un appel doublé
+
+        latencies donne la durée de chaque backend lancé, jusqu'à l'annulation
+        pour les backends perdants (listés dans cancelled).
+        """
+        with self._lock:
+            self._hedges["calls"] += 1
+            self._hedges["hedged"] += hedged
+            if winner is None:
+                self._hedges["failures"] += 1
+            else:
+                self._hedges["wins"][winner] = self._hedges["wins"].get(winner, 0) + 1
+            self._hedges["last"] = {"winner": winner, "latencies": latencies, "hedged": hedged, "cancelled": cancelled}
+
+    def backend_snapshot(self, backend: str) -> Dict[str, Any]:
+        """État de santé d'un backend: disjoncteur, taux d'erreur récent, latences et dernière erreur"""
+        with self._lock:
+            health = self._health(backend)
+            outcomes = list(health.outcomes)
+            retry_in = None
+            if health.state == OPEN:
+                retry_in = round(max(0.0, self.reset_seconds - (time.monotonic() - health.opened_at)), 1)
+            snapshot = {
+                "state": health.state,
+                "consecutive_failures": health.consecutive_failures,
+                "retry_in": retry_in,
+                "requests": health.requests,
+                "errors": health.errors,
+                "error_rate": round(outcomes.count(False) / len(outcomes), 3) if outcomes else None,
+                "samples": len(health.latencies),
+                "histogram": {("+Inf" if math.isinf(bound) else str(bound)): count
+                              for bound, count in zip(LATENCY_BUCKETS, health.histogram)},
+                "last_error": health.last_error,
+                "last_success_at": health.last_success_at,
+            }
+        snapshot["p50"] = self.latency_percentile(backend, 50)
+        snapshot["p95"] = self.latency_percentile(backend, 95)
+        return snapshot
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            backends = list(self._backends)
+            hedges = {**self._hedges, "wins": dict(self._hedges["wins"])}
+        return {"backends": {backend: self.backend_snapshot(backend) for backend in backends}, "hedging": hedges}
+
+
+backend_stats = BackendStats(
+    failure_threshold=int(os.getenv("LLM_CIRCUIT_FAILURES", "5")),
+    reset_seconds=float(os.getenv("LLM_CIRCUIT_RESET_SECONDS", "30")),
+)
@@ -0,0 +1,141 @@
+import io
+import os
+import json
+import time
+import zipfile
+import logging
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from document_processor import DocumentProcessor
+from llm_service import LLMService
+from chatmd_parser import parse_chatmd
+from chatmd_graph import analyze_links
+
+logger = logging.getLogger(__name__)
+
+
+class BatchGenerator:
+    """Génère des chatbots pour plusieurs documents en parallèle
+
+    L'extraction et les appels au LLM sont bornés séparément: les
+    sémaphores par backend limitent le nombre de générations simultanées
+    envoyées au LLM local ou à l'API en ligne, tous lots confondus.
+    """
+
+    def __init__(self, document_processor: DocumentProcessor, llm_service: LLMService,
+                 extraction_workers: int = 4, backend_concurrency: Optional[Dict[str, int]] = None):
+        self.document_processor = document_processor
+        self.llm_service = llm_service
+        self.extraction_workers = extraction_workers
+
+        backend_concurrency = backend_concurrency or {"local": 1, "online": 4}
+        self._extraction_semaphore = threading.BoundedSemaphore(extraction_workers)
+        self._backend_semaphores = {
+            backend: threading.BoundedSemaphore(limit) for backend, limit in backend_concurrency.items()
+        }
+        self._max_threads = extraction_workers + sum(backend_concurrency.values())
+
+    def generate(self, documents: List[Tuple[str, bytes]], params: Dict[str, Any],
+                 use_cache: bool = True, llm_service: Optional[LLMService] = None) -> List[Dict[str, Any]]:
+        """Génère un chatbot par document (nom de fichier, contenu) et retourne un rapport par document
+
+        llm_service remplace ponctuellement le service courant (ex: mode hors ligne pour un lot).
+        """
+        if not documents:
+            return []
+
+        # Le service peut être remplacé pendant le lot (changement de mode): figer celui du début
+        llm_service = llm_service or self.llm_service
+        backend = llm_service.mode
+        output_names = self._output_names([filename for filename, _ in documents])
+
+        def run(index: int) -> Dict[str, Any]:
+            filename, data = documents[index]
+            return self._generate_one(llm_service, backend, filename, output_names[index], data, params, use_cache)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(len(documents), self._max_threads),
+                                thread_name_prefix="chatmd-batch") as executor:
+            results = list(executor.map(run, range(len(documents))))
+
+        logger.info(f"Lot de {len(documents)} documents traité en {time.perf_counter() - started:.2f}s")
+        return results
+
+    def _generate_one(self, llm_service: LLMService, backend: str, filename: str, output_name: str,
+                      data: bytes, params: Dict[str, Any], use_cache: bool) -> Dict[str, Any]:
+        report = {
+            "filename": filename,
+            "output": output_name,
+            "status": "error",
+            "error": None,
+            "extraction_time": None,
+            "generation_time": None,
+            "total_time": None,
+            "validation": None,
+            "markdown": None,
+        }
+        started = time.perf_counter()
+
+        try:
+            with self._extraction_semaphore:
+                extraction_started = time.perf_counter()
+                content = self.document_processor.process_bytes(data, filename, params)
+                report["extraction_time"] = time.perf_counter() - extraction_started
+
+            if not content:
+                report["error"] = "Impossible de traiter le document"
+                return report
+
+            with self._backend_semaphores.get(backend) or contextlib.nullcontext():
+                generation_started = time.perf_counter()
+                try:
+                    # Lot exécuté en tâche de fond: attente de la file du LLM sans le délai interactif
+                    markdown = llm_service.generate_chatmd(content, params, use_cache=use_cache, background=True)
+                finally:
+                    report["generation_time"] = time.perf_counter() - generation_started
+
+            if not markdown:
+                report["error"] = "Erreur lors de la génération du chatbot"
+                return report
+
+            report["markdown"] = markdown
+            report["validation"] = analyze_links(parse_chatmd(markdown), params.get("max_depth"))["summary"]
+            report["status"] = "success"
+            return report
+        except Exception as e:
+            logger.error(f"Erreur lors de la génération du chatbot pour {filename}: {str(e)}")
+            report["error"] = str(e)
+            return report
+        finally:
+            report["total_time"] = time.perf_counter() - started
+
+    @staticmethod
+    def _output_names(filenames: List[str]) -> List[str]:
+        """Calcule un nom de fichier .md unique par document"""
+        names = []
+        used = set()
+        for filename in filenames:
+            base = os.path.splitext(os.path.basename(filename))[0] or "chatbot"
+            name = f"{base}.md"
+            suffix = 2
+            while name in used:
+                name = f"{base}-{suffix}.md"
+                suffix += 1
+            used.add(name)
+            names.append(name)
+        return names
+
+    @staticmethod
+    def to_zip(results: List[Dict[str, Any]]) -> bytes:
+        """Construit une archive zip contenant les chatbots générés et le rapport de temps (rapport.json)"""
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for result in results:
+                if result["markdown"]:
+                    archive.writestr(result["output"], result["markdown"])
+
+            report = [{key: value for key, value in result.items() if key != "markdown"} for result in results]
+            archive.writestr("rapport.json", json.dumps(report, ensure_ascii=False, indent=2))
+        return buffer.getvalue()
@@ -0,0 +1,119 @@
+import logging
+from typing import Dict, Any, List
+from chatmd_graph import is_external_target
+
+logger = logging.getLogger(__name__)
+
+# Schéma JSON de la structure demandée au LLM (voir chatmd_prompts.BASE_PROMPT)
+CHOICE_SCHEMA = {
+    "type": "object",
+    "required": ["text", "target"],
+    "properties": {
+        "text": {"type": "string", "minLength": 1},
+        "target": {"type": "string", "minLength": 1},
+    },
+}
+
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["triggers", "content", "choices"],
+    "properties": {
+        "triggers": {"type": "array", "minItems": 1, "items": {"type": "string", "minLength": 1}},
+        "content": {"type": "string", "minLength": 1},
+        "choices": {"type": "array", "items": CHOICE_SCHEMA},
+    },
+}
+
+CHATBOT_SCHEMA = {
+    "type": "object",
+    "required": ["title", "welcome_message", "welcome_choices", "responses"],
+    "properties": {
+        "title": {"type": "string", "minLength": 1},
+        "welcome_message": {"type": "string", "minLength": 1},
+        "welcome_choices": {"type": "array", "minItems": 1, "items": CHOICE_SCHEMA},
+        "responses": {"type": "object", "minProperties": 1, "additionalProperties": RESPONSE_SCHEMA},
+    },
+}
+
+# Blocs de réponse seuls, demandés lors d'une nouvelle tentative ciblée
+RESPONSES_SCHEMA = {
+    "type": "object",
+    "required": ["responses"],
+    "properties": {
+        "responses": {"type": "object", "additionalProperties": RESPONSE_SCHEMA},
+    },
+}
+
+_TYPES = {"object": dict, "array": list, "string": str}
+
+
+def _validate(value: Any, schema: Dict[str, Any], path: str, errors: List[Dict[str, str]]) -> None:
+    """Valide une valeur contre le sous-ensemble de JSON Schema utilisé ci-dessus"""
+    expected = _TYPES[schema["type"]]
+    if not isinstance(value, expected):
+        errors.append({"path": path, "message": f"type {schema['type']} attendu"})
+        return
+
+    if expected is str:
+        if len(value.strip()) < schema.get("minLength", 0):
+            errors.append({"path": path, "message": "texte vide"})
+    elif expected is list:
+        if len(value) < schema.get("minItems", 0):
+            errors.append({"path": path, "message": f"au moins {schema['minItems']} élément(s) attendu(s)"})
+        for index, item in enumerate(value):
+            _validate(item, schema["items"], f"{path}[{index}]", errors)
+    else:
+        for key in schema.get("required", ()):
+            if key not in value:
+                errors.append({"path": f"{path}.{key}", "message": "champ manquant"})
+        if len(value) < schema.get("minProperties", 0):
+            errors.append({"path": path, "message": f"au moins {schema['minProperties']} entrée(s) attendue(s)"})
+        properties = schema.get("properties", {})
+        for key, item in value.items():
+            item_schema = properties.get(key, schema.get("additionalProperties"))
+            if item_schema is not None:
+                _validate(item, item_schema, f"{path}.{key}", errors)
+
+
+def validate_chatbot(data: Any) -> Dict[str, Any]:
+    """Valide la structure JSON d'un chatbot: schéma et cibles des choix
+
+    Retourne les erreurs de schéma (chemin et message), les blocs de réponse
+    non conformes au schéma (invalid), les cibles de choix qui ne
+    correspondent à aucun bloc (missing) et valid.
+    """
+    errors: List[Dict[str, str]] = []
+    _validate(data, CHATBOT_SCHEMA, "$", errors)
+    if not isinstance(data, dict):
+        return {"errors": errors, "invalid": [], "missing": [], "valid": False}
+
+    responses = data.get("responses") if isinstance(data.get("responses"), dict) else {}
+    invalid = [response_id for response_id, entry in responses.items()
+               if _errors_for(entry, RESPONSE_SCHEMA)]
+
+    # Cibles inexistantes (comparaison exacte, comme l'analyse des liens du chatbot converti);
+    # les liens externes (URL, ancres, chemins) ne désignent pas un bloc
+    known = {response_id.strip() for response_id in responses}
+    missing = []
+    seen = set()
+    choice_lists = [data.get("welcome_choices")] + [entry.get("choices") for entry in responses.values()
+                                                    if isinstance(entry, dict)]
+    for choices in choice_lists:
+        for choice in choices if isinstance(choices, list) else ():
+            target = choice.get("target") if isinstance(choice, dict) else None
+            if not isinstance(target, str) or not target.strip():
+                continue
+            target = target.strip()
+            if is_external_target(target):
+                continue
+            if target not in known and target not in seen:
+                seen.add(target)
+                missing.append(target)
+
+    return {"errors": errors, "invalid": invalid, "missing": missing, "valid": not errors and not missing}
+
+
+def _errors_for(value: Any, schema: Dict[str, Any]) -> List[Dict[str, str]]:
+    errors: List[Dict[str, str]] = []
+    _validate(value, schema, "$", errors)
+    return errors
@@ -0,0 +1,142 @@
+import logging
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+from chatmd_parser import ChatMDDocument
+
+logger = logging.getLogger(__name__)
+
+# Nom du nœud représentant le bloc d'accueil dans le graphe
+WELCOME_NODE = "#accueil"
+
+
+def is_external_target(target: str) -> bool:
+    """Indique si la cible d'un choix est un lien externe et non un bloc de réponse"""
+    return "://" in target or target.startswith(("mailto:", "#", "/"))
+
+
+def _find_cycles(graph: Dict[str, List[str]]) -> List[List[str]]:
+    """Retourne les composantes fortement connexes contenant un cycle (Tarjan itératif, linéaire)"""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    cycles = []
+    counter = 0
+
+    for root in graph:
+        if root in index:
+            continue
+
+        work = [(root, iter(graph[root]))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, neighbours = work[-1]
+            advanced = False
+            for neighbour in neighbours:
+                if neighbour not in index:
+                    index[neighbour] = lowlink[neighbour] = counter
+                    counter += 1
+                    stack.append(neighbour)
+                    on_stack.add(neighbour)
+                    work.append((neighbour, iter(graph[neighbour])))
+                    advanced = True
+                    break
+                if neighbour in on_stack:
+                    lowlink[node] = min(lowlink[node], index[neighbour])
+            if advanced:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1 or node in graph[node]:
+                    cycles.append(list(reversed(component)))
+
+    return cycles
+
+
+def analyze_links(document: ChatMDDocument, max_depth: Optional[int] = None) -> Dict[str, Any]:
+    """Analyse le graphe des choix d'un chatbot ChatMD
+
+    Retourne les liens vers des blocs inexistants, les blocs inaccessibles
+    depuis le message d'accueil, la profondeur de chaque bloc (comparée à
+    max_depth si fourni), les blocs sans issue et les cycles.
+    """
+    graph: Dict[str, List[str]] = {}
+    dangling = []
+
+    sources = []
+    welcome = document.welcome
+    if welcome is not None:
+        sources.append((WELCOME_NODE, welcome))
+    sources.extend(document.responses.items())
+
+    for node, block in sources:
+        targets = []
+        for choice in block.choices:
+            target = choice["target"]
+            if is_external_target(target):
+                continue
+            if target not in document.responses:
+                dangling.append({"source": node, "target": target, "text": choice["text"],
+                                 "block_line": block.start_line})
+                continue
+            targets.append(target)
+        graph[node] = targets
+
+    # Parcours en largeur depuis l'accueil: profondeur de chaque bloc accessible
+    depths = {}
+    if welcome is not None:
+        depths[WELCOME_NODE] = 0
+        queue = deque([WELCOME_NODE])
+        while queue:
+            node = queue.popleft()
+            for target in graph[node]:
+                if target not in depths:
+                    depths[target] = depths[node] + 1
+                    queue.append(target)
+    depths.pop(WELCOME_NODE, None)
+
+    unreachable = [title for title in document.responses if title not in depths]
+    dead_ends = [title for title in document.responses if not graph[title]]
+    too_deep = []
+    if max_depth is not None:
+        too_deep = [title for title, depth in depths.items() if depth > max_depth]
+    cycles = _find_cycles(graph)
+
+    report = {
+        "dangling": dangling,
+        "unreachable": unreachable,
+        "dead_ends": dead_ends,
+        "depths": depths,
+        "max_depth": max(depths.values()) if depths else 0,
+        "too_deep": too_deep,
+        "cycles": cycles,
+        "duplicates": document.duplicates,
+    }
+    report["summary"] = {
+        "responses": len(document.responses),
+        "dangling": len(dangling),
+        "unreachable": len(unreachable),
+        "dead_ends": len(dead_ends),
+        "too_deep": len(too_deep),
+        "cycles": len(cycles),
+        "duplicates": len(document.duplicates),
+    }
+    report["valid"] = not (dangling or unreachable or too_deep or document.duplicates)
+    return report
@@ -0,0 +1,219 @@
+import re
+import sys
+import json
+import math
+import time
+import logging
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Union
+
+from chatmd_parser import ChatMDDocument, parse_chatmd
+
+logger = logging.getLogger(__name__)
+
+# Poids des mots selon leur origine dans le bloc de réponse
+TRIGGER_WEIGHT = 1.0
+TITLE_WEIGHT = 0.5
+# Bonus lorsqu'un déclencheur de plusieurs mots apparaît tel quel dans le message
+PHRASE_BONUS = 1.0
+# Un mot présent dans plus de COMMON_RATIO des réponses (et au moins COMMON_MIN_POSTINGS)
+# ne sert pas à chercher les candidates, seulement à les départager
+COMMON_RATIO = 0.05
+COMMON_MIN_POSTINGS = 100
+
+# Mots vides ignorés lors de l'indexation et de la recherche (forme normalisée)
+STOP_WORDS = frozenset("""
+a au aux avec ce ces c d dans de des du elle en et est il ils j je l la le les leur lui m ma mais me mes
+moi mon n ne nous on ou par pas pour qu que qui s sa se ses son sur t ta te tes toi ton tu un une vos votre vous y
+""".split())
+
+# Gros mots détectés lorsque "gestionGrosMots" est activé dans l'en-tête YAML (forme normalisée)
+BAD_WORDS = frozenset("""
+batard bordel chier con conne connard connasse couille couilles crevure encule enculer enfoire fdp foutre
+merde merdique nique niquer ntm pd pute putain salaud salop salope tg
+""".split())
+
+_NON_WORD_RE = re.compile(r"[^a-z0-9]+")
+
+Utterance = Union[str, Dict[str, Any]]
+
+
+def normalize(text: str) -> str:
+    """Met le texte en minuscules, supprime les accents et la ponctuation"""
+    text = unicodedata.normalize("NFD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _NON_WORD_RE.sub(" ", text).strip()
+
+
+def tokenize(text: str) -> List[str]:
+    """Retourne les mots significatifs d'un texte normalisé"""
+    return [word for word in normalize(text).split() if word not in STOP_WORDS]
+
+
+class TriggerMatcher:
+    """Sélection des réponses d'un chatbot ChatMD à partir du message de l'utilisateur
+
+    Les déclencheurs ("- déclencheur" sous chaque titre "## ") et les titres
+    sont normalisés puis rangés dans un index inversé mot -> réponses. Un
+    message n'est comparé qu'aux réponses qui partagent au moins un mot peu
+    fréquent avec lui, sans parcourir tout le chatbot. Les déclencheurs
+    "! mot" excluent la réponse si le message contient ce mot.
+    """
+
+    def __init__(self, document: ChatMDDocument):
+        self.titles = list(document.responses)
+        self.bad_words_enabled = bool((document.front_matter or {}).get("gestionGrosMots"))
+
+        self._postings: Dict[str, Dict[int, float]] = defaultdict(dict)
+        self._phrases: Dict[int, List[str]] = {}
+        self._exclusions: Dict[int, List[str]] = {}
+
+        for index, title in enumerate(self.titles):
+            block = document.responses[title]
+            phrases = []
+            exclusions = []
+            for trigger in block.triggers:
+                if trigger.startswith("!"):
+                    exclusions.extend(tokenize(trigger[1:]))
+                    continue
+                words = tokenize(trigger)
+                self._add_words(index, words, TRIGGER_WEIGHT)
+                if len(words) > 1:
+                    phrases.append(" ".join(words))
+            self._add_words(index, tokenize(title), TITLE_WEIGHT)
+            if phrases:
+                self._phrases[index] = phrases
+            if exclusions:
+                self._exclusions[index] = exclusions
+
+        # Pondération IDF: un mot présent dans beaucoup de réponses discrimine peu
+        count = max(1, len(self.titles))
+        self._idf = {word: math.log(1 + count / len(postings)) for word, postings in self._postings.items()}
+        self._common_threshold = max(COMMON_MIN_POSTINGS, int(count * COMMON_RATIO))
+
+    def _add_words(self, index: int, words: List[str], weight: float) -> None:
+        for word in words:
+            postings = self._postings[word]
+            postings[index] = max(postings.get(index, 0.0), weight)
+
+    def match(self, text: str, top_k: int = 5) -> Dict[str, Any]:
+        """Retourne les réponses correspondant au message, de la plus pertinente à la moins pertinente"""
+        words = tokenize(text)
+        unique_words = set(words)
+
+        if self.bad_words_enabled and not unique_words.isdisjoint(BAD_WORDS):
+            return {"input": text, "bad_words": True, "matches": []}
+
+        # Les mots rares désignent les réponses candidates; les mots fréquents ne font
+        # que compléter leur score, sauf si le message ne contient aucun mot rare
+        known = sorted((word for word in unique_words if word in self._postings),
+                       key=lambda word: len(self._postings[word]))
+        rare = [word for word in known if len(self._postings[word]) <= self._common_threshold]
+        common = known[len(rare):]
+
+        scores: Dict[int, float] = defaultdict(float)
+        for word in (rare or common):
+            idf = self._idf[word]
+            for index, weight in self._postings[word].items():
+                scores[index] += idf * weight
+        if rare:
+            for word in common:
+                postings = self._postings[word]
+                idf = self._idf[word]
+                for index in scores:
+                    if index in postings:
+                        scores[index] += idf * postings[index]
+
+        # Seules les réponses candidates sont examinées pour les expressions et les exclusions
+        padded = f" {' '.join(words)} "
+        for index in list(scores):
+            if any(word in unique_words for word in self._exclusions.get(index, ())):
+                del scores[index]
+                continue
+            for phrase in self._phrases.get(index, ()):
+                if f" {phrase} " in padded:
+                    scores[index] += PHRASE_BONUS * sum(self._idf[word] for word in phrase.split())
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        return {
+            "input": text,
+            "bad_words": False,
+            "matches": [{"title": self.titles[index], "score": round(score, 4)} for index, score in ranked],
+        }
+
+    def replay(self, utterances: List[Utterance], top_k: int = 1) -> Dict[str, Any]:
+        """Rejoue une série de messages et mesure la qualité de la sélection
+
+        Chaque message est une chaîne ou un dictionnaire {text, expected}; si
+        la réponse attendue est fournie, le résultat indique si la meilleure
+        réponse trouvée est la bonne.
+        """
+        results = []
+        matched = bad_words = checked = correct = 0
+        started = time.perf_counter()
+
+        for utterance in utterances:
+            if isinstance(utterance, dict):
+                text = str(utterance.get("text", ""))
+                expected = utterance.get("expected")
+            else:
+                text, expected = str(utterance), None
+
+            result = self.match(text, top_k)
+            best = result["matches"][0]["title"] if result["matches"] else None
+            result["best"] = best
+            matched += best is not None
+            bad_words += result["bad_words"]
+
+            if expected is not None:
+                result["expected"] = expected
+                result["correct"] = best == expected
+                checked += 1
+                correct += result["correct"]
+            results.append(result)
+
+        elapsed = time.perf_counter() - started
+        summary = {
+            "utterances": len(results),
+            "matched": matched,
+            "unmatched": len(results) - matched - bad_words,
+            "bad_words": bad_words,
+            "checked": checked,
+            "correct": correct,
+            "accuracy": correct / checked if checked else None,
+            "elapsed": elapsed,
+        }
+        return {"summary": summary, "results": results}
+
+
+def _read_utterances(path: str) -> List[Utterance]:
+    """Lit un fichier de messages: une ligne par message, réponse attendue optionnelle après une tabulation"""
+    utterances = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            text, _, expected = line.partition("\t")
+            utterances.append({"text": text, "expected": expected.strip()} if expected.strip() else text)
+    return utterances
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("Usage: python chatmd_matcher.py chatbot.md messages.txt", file=sys.stderr)
+        return 2
+
+    with open(argv[0], "r", encoding="utf-8") as f:
+        matcher = TriggerMatcher(parse_chatmd(f.read()))
+    report = matcher.replay(_read_utterances(argv[1]))
+
+    errors = [result for result in report["results"] if result.get("correct") is False]
+    print(json.dumps({"summary": report["summary"], "errors": errors}, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
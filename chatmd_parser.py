@@ -0,0 +1,263 @@
+import re
+import bisect
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Préfixe des titres de réponses par défaut (surchargé par "titresRéponses" dans le YAML)
+DEFAULT_RESPONSE_PREFIXES = ["## "]
+
+_CHOICE_RE = re.compile(r'^\d+\.\s*\[(.*?)\]\((.*?)\)')
+
+
+class ChatMDBlock:
+    """Bloc d'un chatbot ChatMD: le message d'accueil ou un bloc de réponse "## "
+
+    start_line et end_line délimitent le bloc dans le document (end_line exclu).
+    """
+
+    def __init__(self, kind: str, title: str, triggers: List[str], content: str,
+                 choices: List[Dict[str, str]], start_line: int, end_line: int):
+        self.kind = kind
+        self.title = title
+        self.triggers = triggers
+        self.content = content
+        self.choices = choices
+        self.start_line = start_line
+        self.end_line = end_line
+
+    def shifted(self, offset: int) -> "ChatMDBlock":
+        """Retourne une copie du bloc décalée de offset lignes (après une modification plus haut dans le document)"""
+        return ChatMDBlock(self.kind, self.title, self.triggers, self.content, self.choices,
+                           self.start_line + offset, self.end_line + offset)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "title": self.title,
+            "triggers": self.triggers,
+            "content": self.content,
+            "choices": self.choices,
+            "start_line": self.start_line,
+            "end_line": self.end_line,
+        }
+
+
+class ChatMDDocument:
+    """Modèle indexé d'un document ChatMD: en-tête YAML, bloc d'accueil et blocs de réponse"""
+
+    def __init__(self, lines: List[str], front_matter: Optional[Dict[str, Any]], yaml_error: Optional[str],
+                 yaml_end: int, blocks: List[ChatMDBlock]):
+        self.lines = lines
+        self.front_matter = front_matter
+        self.yaml_error = yaml_error
+        self.yaml_end = yaml_end  # Première ligne après l'en-tête YAML (0 sans en-tête)
+        self.blocks = blocks
+        self._index()
+
+    def _index(self) -> None:
+        self._starts = [block.start_line for block in self.blocks]
+        self.responses: Dict[str, ChatMDBlock] = {}
+        self.duplicates: List[str] = []
+        for block in self.blocks:
+            if block.kind != "response":
+                continue
+            if block.title in self.responses:
+                self.duplicates.append(block.title)
+            else:
+                self.responses[block.title] = block
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.lines)
+
+    @property
+    def welcome(self) -> Optional[ChatMDBlock]:
+        if self.blocks and self.blocks[0].kind == "welcome":
+            return self.blocks[0]
+        return None
+
+    @property
+    def response_prefixes(self) -> List[str]:
+        return _response_prefixes(self.front_matter)
+
+    def block_index_at(self, line: int) -> int:
+        """Retourne l'indice du bloc contenant la ligne donnée"""
+        return max(0, bisect.bisect_right(self._starts, line) - 1)
+
+    def block_at(self, line: int) -> Optional[ChatMDBlock]:
+        """Retourne le bloc contenant la ligne donnée"""
+        if not self.blocks:
+            return None
+        return self.blocks[self.block_index_at(line)]
+
+    def to_dict(self) -> Dict[str, Any]:
+        welcome = self.welcome
+        return {
+            "front_matter": self.front_matter,
+            "yaml_error": self.yaml_error,
+            "welcome": welcome.to_dict() if welcome else None,
+            "responses": {title: block.to_dict() for title, block in self.responses.items()},
+            "duplicates": self.duplicates,
+        }
+
+
+def _response_prefixes(front_matter: Optional[Dict[str, Any]]) -> List[str]:
+    prefixes = (front_matter or {}).get("titresRéponses")
+    if isinstance(prefixes, list) and prefixes and all(isinstance(p, str) and p.strip() for p in prefixes):
+        return prefixes
+    return DEFAULT_RESPONSE_PREFIXES
+
+
+def _parse_front_matter(lines: List[str]) -> Tuple[Optional[Dict[str, Any]], Optional[str], int]:
+    """Analyse l'en-tête YAML et retourne (données, erreur, première ligne après l'en-tête)"""
+    if not lines or lines[0].strip() != "---":
+        return None, None, 0
+
+    for end in range(1, len(lines)):
+        if lines[end].strip() == "---":
+            try:
+                data = yaml.safe_load("\n".join(lines[1:end]))
+            except yaml.YAMLError as e:
+                return None, str(e), end + 1
+            return data if isinstance(data, dict) else {}, None, end + 1
+
+    # En-tête non fermé: le considérer comme du contenu
+    return None, None, 0
+
+
+def _heading_title(line: str, prefixes: List[str]) -> Optional[str]:
+    for prefix in prefixes:
+        if line.startswith(prefix):
+            return line[len(prefix):].strip()
+    return None
+
+
+def _parse_block(lines: List[str], start: int, end: int, kind: str, prefixes: List[str]) -> ChatMDBlock:
+    """Analyse les lignes [start, end[ d'un bloc"""
+    triggers = []
+    choices = []
+    content_lines = []
+
+    if kind == "response":
+        title = _heading_title(lines[start], prefixes) or ""
+        body_start = start + 1
+        in_triggers = True
+    else:
+        title = ""
+        body_start = start
+        in_triggers = False
+
+    for i in range(body_start, end):
+        line = lines[i]
+
+        if kind == "welcome" and not title and line.startswith("# "):
+            title = line[2:].strip()
+            continue
+
+        # Les déclencheurs sont les lignes "- " qui suivent directement le titre
+        if in_triggers:
+            if line.startswith("- "):
+                triggers.append(line[2:].strip())
+                continue
+            in_triggers = False
+
+        match = _CHOICE_RE.match(line)
+        if match:
+            choices.append({"text": match.group(1), "target": match.group(2).strip()})
+            continue
+
+        content_lines.append(line)
+
+    return ChatMDBlock(kind, title, triggers, "\n".join(content_lines).strip(), choices, start, end)
+
+
+def _parse_region(lines: List[str], start: int, end: int, prefixes: List[str], first_kind: str) -> List[ChatMDBlock]:
+    """Découpe les lignes [start, end[ en blocs; les lignes précédant le premier titre forment un bloc first_kind"""
+    blocks = []
+    block_start = start
+    block_kind = first_kind
+
+    for i in range(start, end):
+        if _heading_title(lines[i], prefixes) is None or (i == block_start and block_kind == "response"):
+            continue
+        # Le bloc d'accueil existe toujours, même vide
+        if i > block_start or block_kind == "welcome":
+            blocks.append(_parse_block(lines, block_start, i, block_kind, prefixes))
+        block_start = i
+        block_kind = "response"
+
+    if end > block_start or block_kind == "welcome":
+        blocks.append(_parse_block(lines, block_start, end, block_kind, prefixes))
+    return blocks
+
+
+def parse_chatmd(text: str) -> ChatMDDocument:
+    """Analyse un document ChatMD complet"""
+    lines = text.split("\n")
+    front_matter, yaml_error, yaml_end = _parse_front_matter(lines)
+    prefixes = _response_prefixes(front_matter)
+    blocks = _parse_region(lines, yaml_end, len(lines), prefixes, "welcome")
+    return ChatMDDocument(lines, front_matter, yaml_error, yaml_end, blocks)
+
+
+def apply_line_edit(document: ChatMDDocument, start: int, end: int, new_lines: List[str]) -> ChatMDDocument:
+    """Remplace les lignes [start, end[ par new_lines et ne réanalyse que les blocs touchés
+
+    Les blocs situés avant la modification sont conservés tels quels, ceux
+    situés après sont seulement décalés. Une modification de l'en-tête YAML
+    entraîne une analyse complète (elle peut changer les titres de réponses).
+    """
+    lines = document.lines[:start] + new_lines + document.lines[end:]
+
+    # Sans en-tête fermé, toute modification peut en créer un si le document commence par "---"
+    opens_front_matter = document.yaml_end == 0 and (start == 0 or lines[0].strip() == "---")
+    if start < document.yaml_end or opens_front_matter or not document.blocks:
+        return parse_chatmd("\n".join(lines))
+
+    offset = len(new_lines) - (end - start)
+    blocks = document.blocks
+    first = document.block_index_at(start)
+    last = document.block_index_at(max(start, end - 1))
+
+    # Si le titre d'un bloc est modifié, ses lignes sans titre peuvent rejoindre le bloc précédent
+    if first > 0 and start == blocks[first].start_line:
+        first -= 1
+
+    region_start = blocks[first].start_line
+    region_end = blocks[last].end_line + offset
+    prefixes = document.response_prefixes
+    reparsed = _parse_region(lines, region_start, region_end, prefixes, blocks[first].kind)
+
+    following = [block.shifted(offset) for block in blocks[last + 1:]] if offset else blocks[last + 1:]
+
+    return ChatMDDocument(lines, document.front_matter, document.yaml_error, document.yaml_end,
+                          blocks[:first] + reparsed + following)
+
+
+def reparse(document: Optional[ChatMDDocument], text: str) -> ChatMDDocument:
+    """Réanalyse un document modifié en ne traitant que les lignes qui ont changé"""
+    if document is None:
+        return parse_chatmd(text)
+
+    old_lines = document.lines
+    new_lines = text.split("\n")
+
+    # Plus long préfixe et plus long suffixe communs
+    prefix = 0
+    max_prefix = min(len(old_lines), len(new_lines))
+    while prefix < max_prefix and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+
+    suffix = 0
+    max_suffix = max_prefix - prefix
+    while suffix < max_suffix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+
+    if prefix == len(old_lines) == len(new_lines):
+        return document
+
+    return apply_line_edit(document, prefix, len(old_lines) - suffix, new_lines[prefix:len(new_lines) - suffix])
@@ -0,0 +1,465 @@
+import os
+import sys
+import json
+import time
+import logging
+import statistics
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Valeurs proposées par la page de génération: leurs prompts sont précompilés au chargement du module
+DOC_TYPES = ("company", "biography", "course", "product", "custom")
+TONES = ("formal", "conversational", "educational", "friendly", "professional")
+COMPLEXITIES = ("beginner", "intermediate", "advanced")
+DEPTHS = range(2, 6)
+CHOICES_PER_LEVEL = range(2, 6)
+
+# Début commun à tous les prompts système: rôle et schéma JSON attendu
+BASE_PROMPT = """Tu es un expert en création de chatbots interactifs. Ta tâche est de transformer le document fourni en une structure JSON qui sera ensuite convertie en chatbot interactif.
+
+IMPORTANT: Tu dois ABSOLUMENT générer une structure JSON valide et bien formée selon le schéma ci-dessous. Ne fais PAS une simple analyse de texte.
+
+Schéma JSON requis:
+```json
+{
+  "title": "Titre du chatbot basé sur le document",
+  "welcome_message": "Message d'accueil qui présente le sujet principal du document",
+  "welcome_choices": [
+    {
+      "text": "Premier choix",
+      "target": "Réponse 1"
+    },
+    {
+      "text": "Deuxième choix",
+      "target": "Réponse 2"
+    },
+    {
+      "text": "Troisième choix",
+      "target": "Réponse 3"
+    }
+  ],
+  "responses": {
+    "Réponse 1": {
+      "triggers": ["déclencheur 1", "déclencheur 2"],
+      "content": "Contenu détaillé sur le premier aspect du document",
+      "choices": [
+        {
+          "text": "Sous-option 1.1",
+          "target": "Sous-réponse 1.1"
+        },
+        {
+          "text": "Sous-option 1.2",
+          "target": "Sous-réponse 1.2"
+        }
+      ]
+    },
+    "Réponse 2": {
+      "triggers": ["déclencheur 1", "déclencheur 2"],
+      "content": "Contenu détaillé sur le deuxième aspect du document",
+      "choices": [
+        {
+          "text": "Sous-option 2.1",
+          "target": "Sous-réponse 2.1"
+        },
+        {
+          "text": "Sous-option 2.2",
+          "target": "Sous-réponse 2.2"
+        }
+      ]
+    },
+    "Réponse 3": {
+      "triggers": ["déclencheur 1", "déclencheur 2"],
+      "content": "Contenu détaillé sur le troisième aspect du document",
+      "choices": [
+        {
+          "text": "Sous-option 3.1",
+          "target": "Sous-réponse 3.1"
+        },
+        {
+          "text": "Sous-option 3.2",
+          "target": "Sous-réponse 3.2"
+        }
+      ]
+    },
+    "Sous-réponse 1.1": {
+      "triggers": ["déclencheur spécifique"],
+      "content": "Contenu détaillé sur cet aspect spécifique",
+      "choices": [
+        {
+          "text": "Option pour continuer",
+          "target": "Autre réponse"
+        },
+        {
+          "text": "Revenir en arrière",
+          "target": "Réponse 1"
+        }
+      ]
+    },
+    "Sous-réponse 1.2": {
+      "triggers": ["déclencheur spécifique"],
+      "content": "Contenu détaillé sur cet aspect spécifique",
+      "choices": [
+        {
+          "text": "Option pour continuer",
+          "target": "Autre réponse"
+        },
+        {
+          "text": "Revenir en arrière",
+          "target": "Réponse 1"
+        }
+      ]
+    }
+    // Et ainsi de suite pour toutes les sous-réponses...
+  }
+}
+```
+
+"""
+
+# Consignes identiques pour tous les chatbots
+STATIC_RULES = """- Inclure 2-3 déclencheurs pertinents pour chaque bloc de réponse
+- Créer une structure cohérente et logique basée sur le contenu du document
+- Assurer que TOUS les liens entre les blocs fonctionnent correctement (chaque "target" doit correspondre à une clé existante dans "responses")
+- Générer un JSON valide et bien formé, sans erreurs de syntaxe
+"""
+
+# Consignes qui dépendent des paramètres de génération
+PARAMETER_RULES = """- Ton: {tone}
+- Niveau de complexité: {complexity}
+- Profondeur maximale: {max_depth} niveaux (pas plus!)
+- Nombre de choix par niveau: exactement {choices_per_level} options
+"""
+
+# Structure type ajoutée selon le type de document ("custom": aucune)
+DOC_TYPE_PROMPTS = {
+    "company": """
+STRUCTURE SPÉCIFIQUE POUR UNE DESCRIPTION D'ENTREPRISE:
+
+# [Nom de l'entreprise]
+Bienvenue dans le chatbot de [Nom de l'entreprise]! Découvrez notre entreprise, nos produits et services, et comment nous pouvons répondre à vos besoins.
+
+1. [Produits et Services](Produits et Services)
+2. [Notre Histoire](Notre Histoire)
+3. [Contactez-nous](Contactez-nous)
+
+## Produits et Services
+- produits
+- services
+- offres
+Découvrez notre gamme complète de produits et services:
+
+1. [Produit/Service Phare](Produit/Service Phare)
+2. [Autres Offres](Autres Offres)
+3. [Tarifs et Disponibilité](Tarifs et Disponibilité)
+
+## Notre Histoire
+- histoire
+- fondation
+- évolution
+[Nom de l'entreprise] a été fondée en [année] par [fondateur]. Voici notre parcours:
+
+1. [Débuts et Vision](Débuts et Vision)
+2. [Croissance et Développement](Croissance et Développement)
+3. [Notre Mission et Nos Valeurs](Notre Mission et Nos Valeurs)
+
+## Contactez-nous
+- contact
+- adresse
+- téléphone
+Vous souhaitez nous contacter? Voici toutes les informations nécessaires:
+
+1. [Nos Bureaux et Points de Vente](Nos Bureaux et Points de Vente)
+2. [Service Client](Service Client)
+3. [Opportunités de Carrière](Opportunités de Carrière)
+
+[Et continuer avec toutes les sous-sections...]
+""",
+    "biography": """
+STRUCTURE SPÉCIFIQUE POUR UNE BIOGRAPHIE:
+
+# [Nom de la Personne]
+Découvrez la vie et l'œuvre de [Nom de la Personne], [brève description de sa notoriété ou de son domaine].
+
+1. [Jeunesse et Formation](Jeunesse et Formation)
+2. [Carrière et Réalisations](Carrière et Réalisations)
+3. [Vie Personnelle](Vie Personnelle)
+
+## Jeunesse et Formation
+- enfance
+- éducation
+- formation
+[Nom] est né(e) le [date] à [lieu]. Voici les moments clés de sa jeunesse:
+
+1. [Origines Familiales](Origines Familiales)
+2. [Éducation et Influences](Éducation et Influences)
+3. [Premiers Pas](Premiers Pas)
+
+## Carrière et Réalisations
+- carrière
+- travail
+- accomplissements
+Découvrez le parcours professionnel remarquable de [Nom]:
+
+1. [Débuts Professionnels](Débuts Professionnels)
+2. [Principales Œuvres/Réalisations](Principales Œuvres/Réalisations)
+3. [Reconnaissance et Prix](Reconnaissance et Prix)
+
+## Vie Personnelle
+- famille
+- loisirs
+- vie privée
+En dehors de sa carrière, [Nom] a mené une vie personnelle riche:
+
+1. [Famille et Relations](Famille et Relations)
+2. [Passions et Intérêts](Passions et Intérêts)
+3. [Philosophie et Valeurs](Philosophie et Valeurs)
+
+[Et continuer avec toutes les sous-sections...]
+""",
+    "course": """
+STRUCTURE SPÉCIFIQUE POUR UN COURS:
+
+# [Titre du Cours]
+Bienvenue dans ce cours sur [Sujet]. Vous allez découvrir les concepts fondamentaux et développer vos compétences dans ce domaine.
+
+1. [Introduction et Concepts de Base](Introduction et Concepts de Base)
+2. [Modules Principaux](Modules Principaux)
+3. [Exercices Pratiques](Exercices Pratiques)
+
+## Introduction et Concepts de Base
+- introduction
+- concepts
+- fondamentaux
+Commençons par comprendre les bases essentielles de [Sujet]:
+
+1. [Définitions Clés](Définitions Clés)
+2. [Contexte Historique](Contexte Historique)
+3. [Pourquoi Étudier Ce Sujet](Pourquoi Étudier Ce Sujet)
+
+## Modules Principaux
+- modules
+- chapitres
+- leçons
+Le cours est divisé en plusieurs modules thématiques:
+
+1. [Module 1: Titre](Module 1)
+2. [Module 2: Titre](Module 2)
+3. [Module 3: Titre](Module 3)
+
+## Exercices Pratiques
+- exercices
+- pratique
+- applications
+Mettez en pratique vos connaissances avec ces exercices:
+
+1. [Exercices de Niveau Débutant](Exercices Débutant)
+2. [Exercices de Niveau Intermédiaire](Exercices Intermédiaire)
+3. [Projets Pratiques](Projets Pratiques)
+
+[Et continuer avec toutes les sous-sections, incluant des quiz à la fin de chaque module...]
+""",
+    "product": """
+STRUCTURE SPÉCIFIQUE POUR UNE DESCRIPTION DE PRODUIT:
+
+# [Nom du Produit]
+Découvrez [Nom du Produit], [brève description du produit et de sa valeur principale].
+
+1. [Caractéristiques et Avantages](Caractéristiques et Avantages)
+2. [Utilisation et Applications](Utilisation et Applications)
+3. [Prix et Disponibilité](Prix et Disponibilité)
+
+## Caractéristiques et Avantages
+- caractéristiques
+- spécifications
+- avantages
+Voici ce qui rend [Nom du Produit] unique:
+
+1. [Caractéristiques Techniques](Caractéristiques Techniques)
+2. [Avantages Principaux](Avantages Principaux)
+3. [Comparaison avec d'Autres Produits](Comparaison)
+
+## Utilisation et Applications
+- utilisation
+- mode d'emploi
+- applications
+Comment tirer le meilleur parti de [Nom du Produit]:
+
+1. [Guide de Démarrage Rapide](Guide de Démarrage)
+2. [Cas d'Utilisation Courants](Cas d'Utilisation)
+3. [Conseils et Astuces](Conseils et Astuces)
+
+## Prix et Disponibilité
+- prix
+- achat
+- disponibilité
+Informations sur l'achat de [Nom du Produit]:
+
+1. [Options d'Achat](Options d'Achat)
+2. [Garantie et Support](Garantie et Support)
+3. [Produits Complémentaires](Produits Complémentaires)
+
+[Et continuer avec toutes les sous-sections...]
+""",
+}
+
+# Disposition des messages: "stable" (préfixe identique entre les appels) ou "legacy" (paramètres en tête)
+LAYOUTS = ("stable", "legacy")
+
+
+def _compile_system_prompt(doc_type: str) -> str:
+    return BASE_PROMPT + "Directives OBLIGATOIRES:\n" + STATIC_RULES + DOC_TYPE_PROMPTS.get(doc_type, "")
+
+
+@lru_cache(maxsize=1024)
+def _format_parameters(tone: str, complexity: str, max_depth: int, choices_per_level: int) -> str:
+    return "Paramètres OBLIGATOIRES de ce chatbot:\n" + PARAMETER_RULES.format(
+        tone=tone, complexity=complexity, max_depth=max_depth, choices_per_level=choices_per_level)
+
+
+# Prompts précompilés: un prompt système par type de document, une consigne par combinaison de paramètres
+_SYSTEM_PROMPTS = {doc_type: _compile_system_prompt(doc_type) for doc_type in DOC_TYPES}
+_PARAMETERS = {(tone, complexity, max_depth, choices): _format_parameters(tone, complexity, max_depth, choices)
+               for tone in TONES for complexity in COMPLEXITIES
+               for max_depth in DEPTHS for choices in CHOICES_PER_LEVEL}
+
+
+def system_prompt(doc_type: str) -> str:
+    """Prompt système précompilé d'un type de document (un type inconnu est traité comme "custom")"""
+    return _SYSTEM_PROMPTS.get(doc_type, _SYSTEM_PROMPTS["custom"])
+
+
+def parameter_directives(tone: str, complexity: str, max_depth: int, choices_per_level: int) -> str:
+    """Consignes propres aux paramètres de génération, précompilées pour les valeurs de la page de génération"""
+    key = (tone, complexity, max_depth, choices_per_level)
+    directives = _PARAMETERS.get(key)
+    return directives if directives is not None else _format_parameters(*key)
+
+
+def legacy_system_prompt(doc_type: str, tone: str, complexity: str, max_depth: int, choices_per_level: int) -> str:
+    """Ancienne disposition: paramètres au milieu du prompt système, reconstruit à chaque appel"""
+    return (BASE_PROMPT + "Directives OBLIGATOIRES:\n"
+            + PARAMETER_RULES.format(tone=tone, complexity=complexity, max_depth=max_depth,
+                                     choices_per_level=choices_per_level)
+            + STATIC_RULES + "        " + DOC_TYPE_PROMPTS.get(doc_type, ""))
+
+
+def build_chatmd_messages(document_prompt: str, params: Dict[str, Any], layout: str = "stable") -> List[Dict[str, str]]:
+    """Messages de génération d'un chatbot
+
+    Disposition "stable": le prompt système ne dépend que du type de
+    document et les consignes propres aux paramètres suivent le document
+    dans le message utilisateur. Le début de la requête (prompt système,
+    puis document) est ainsi identique octet pour octet d'un appel à
+    l'autre, et les serveurs qui gardent en cache le préfixe déjà calculé
+    (cache KV de llama.cpp, cache de prompt des API) n'ont à traiter que la
+    fin. La disposition "legacy" sert de référence au banc d'essai.
+    """
+    doc_type = params.get("doc_type", "custom")
+    tone = params.get("tone", "conversational")
+    complexity = params.get("complexity", "intermediate")
+    max_depth = params.get("max_depth", 3)
+    choices_per_level = params.get("choices_per_level", 3)
+
+    if layout == "legacy":
+        return [
+            {"role": "system", "content": legacy_system_prompt(doc_type, tone, complexity, max_depth, choices_per_level)},
+            {"role": "user", "content": document_prompt}
+        ]
+    return [
+        {"role": "system", "content": system_prompt(doc_type)},
+        {"role": "user", "content": f"{document_prompt}\n\n{parameter_directives(tone, complexity, max_depth, choices_per_level)}"}
+    ]
+
+
+def _time_to_first_token(service, backend: str, messages: List[Dict[str, str]]) -> Optional[float]:
+    """Délai avant le premier fragment généré; la génération est ensuite interrompue"""
+    started = time.perf_counter()
+    stream = service._stream_backend(backend, messages, 0.7)
+    try:
+        next(stream)
+        return time.perf_counter() - started
+    except StopIteration:
+        return None
+    finally:
+        stream.close()
+
+
+def benchmark(service, content: str, runs: int = 5, backend: Optional[str] = None) -> Dict[str, Any]:
+    """Compare le délai avant le premier token des deux dispositions
+
+    Chaque disposition reçoit runs requêtes consécutives sur le même
+    document avec des paramètres différents à chaque fois (ton, complexité),
+    comme un utilisateur qui ajuste sa génération. Avec la disposition
+    stable, seules les consignes finales changent; avec l'ancienne, le
+    prompt système change dès les premières lignes. Le premier appel de
+    chaque série (cache froid) est présenté à part.
+    """
+    backend = backend or service.mode
+    combinations = [(tone, complexity) for complexity in COMPLEXITIES for tone in TONES]
+    document_prompt = f"Voici le document à transformer en chatbot:\n\n{content}"
+
+    report: Dict[str, Any] = {"backend": backend, "runs": runs, "layouts": {}}
+    for layout in LAYOUTS:
+        timings = []
+        for index in range(runs):
+            tone, complexity = combinations[index % len(combinations)]
+            params = {"doc_type": "custom", "tone": tone, "complexity": complexity, "max_depth": 3, "choices_per_level": 3}
+            ttft = _time_to_first_token(service, backend, build_chatmd_messages(document_prompt, params, layout))
+            logger.info(f"{layout} #{index + 1}: premier token en {ttft if ttft is None else round(ttft, 3)}s")
+            timings.append(ttft)
+
+        measured = [ttft for ttft in timings if ttft is not None]
+        warm = [ttft for ttft in timings[1:] if ttft is not None]
+        report["layouts"][layout] = {
+            "ttft": [None if ttft is None else round(ttft, 3) for ttft in timings],
+            "cold": None if timings[0] is None else round(timings[0], 3),
+            "warm_median": round(statistics.median(warm), 3) if warm else None,
+            "median": round(statistics.median(measured), 3) if measured else None,
+        }
+
+    # Coût de construction des prompts seul, sans appel au LLM
+    iterations = 10000
+    for layout in LAYOUTS:
+        started = time.perf_counter()
+        for index in range(iterations):
+            tone, complexity = combinations[index % len(combinations)]
+            build_chatmd_messages(document_prompt, {"tone": tone, "complexity": complexity}, layout)
+        report["layouts"][layout]["build_microseconds"] = round((time.perf_counter() - started) / iterations * 1e6, 2)
+
+    stable, legacy = report["layouts"]["stable"]["warm_median"], report["layouts"]["legacy"]["warm_median"]
+    report["warm_speedup"] = round(legacy / stable, 2) if stable and legacy else None
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if not 1 <= len(argv) <= 3 or (len(argv) > 1 and argv[1] not in ("local", "online")):
+        print("Usage: python chatmd_prompts.py document [local|online] [nombre d'appels]", file=sys.stderr)
+        return 2
+
+    from document_processor import DocumentProcessor
+    from llm_service import LLMService
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    with open(argv[0], "rb") as f:
+        content = DocumentProcessor().process_bytes(f.read(), os.path.basename(argv[0]))
+    if not content:
+        print(f"Impossible de traiter le document {argv[0]}", file=sys.stderr)
+        return 1
+
+    backend = argv[1] if len(argv) > 1 else "local"
+    runs = int(argv[2]) if len(argv) > 2 else 5
+    service = LLMService(use_online=backend == "online")
+    try:
+        report = benchmark(service, content, runs, backend)
+    except Exception as e:
+        print(f"Échec de l'appel au backend {backend}: {str(e)}", file=sys.stderr)
+        return 1
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
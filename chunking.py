@@ -0,0 +1,90 @@
+import re
+import logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# Estimation grossière du nombre de caractères par token pour du texte français
+CHARS_PER_TOKEN = 4
+
+# Ligne de titre Markdown ("# Titre") ou courte ligne en majuscules ("INTRODUCTION")
+_HEADING_RE = re.compile(r'^\s*(#{1,6}\s+\S|[A-ZÀ-Ý0-9][A-ZÀ-Ý0-9 \'\-:.]{2,60}$)')
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+')
+
+
+def estimate_tokens(text: str) -> int:
+    """Estime le nombre de tokens d'un texte"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _is_heading(paragraph: str) -> bool:
+    first_line = paragraph.lstrip().split('\n', 1)[0]
+    return bool(_HEADING_RE.match(first_line))
+
+
+def _split_oversized(paragraph: str, max_chars: int) -> List[str]:
+    """Découpe un paragraphe trop long en morceaux, sur les fins de phrase si possible"""
+    pieces = []
+    current = []
+    current_len = 0
+
+    for sentence in _SENTENCE_END_RE.split(paragraph):
+        # Phrase plus longue que le budget: découpage brut
+        while len(sentence) > max_chars:
+            if current:
+                pieces.append(' '.join(current))
+                current, current_len = [], 0
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+
+        if current and current_len + len(sentence) + 1 > max_chars:
+            pieces.append(' '.join(current))
+            current, current_len = [], 0
+        current.append(sentence)
+        current_len += len(sentence) + 1
+
+    if current:
+        pieces.append(' '.join(current))
+    return pieces
+
+
+def split_into_chunks(text: str, max_tokens: int) -> List[str]:
+    """Découpe un texte en morceaux d'au plus max_tokens tokens (estimés)
+
+    Les coupures se font entre les paragraphes, de préférence juste avant un
+    titre; seuls les paragraphes plus longs que le budget sont découpés en
+    phrases. Le découpage est linéaire en la taille du texte.
+    """
+    max_chars = max(1, max_tokens * CHARS_PER_TOKEN)
+    chunks = []
+    current = []
+    current_len = 0
+
+    def flush():
+        nonlocal current, current_len
+        if current:
+            chunks.append('\n\n'.join(current))
+            current, current_len = [], 0
+
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+
+        if len(paragraph) > max_chars:
+            flush()
+            chunks.extend(_split_oversized(paragraph, max_chars))
+            continue
+
+        # Commencer un nouveau morceau sur un titre si le morceau courant est déjà bien rempli
+        if _is_heading(paragraph) and current_len >= max_chars // 2:
+            flush()
+
+        if current_len + len(paragraph) + 2 > max_chars:
+            flush()
+
+        current.append(paragraph)
+        current_len += len(paragraph) + 2
+
+    flush()
+    return chunks
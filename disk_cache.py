@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Compteurs de consultation exposés dans les métriques, avec leur étiquette
+_REQUEST_RESULTS = {"hits": "hit", "misses": "miss"}
+
+
+def make_key(*parts: Any) -> str:
+    """Calcule une clé de cache (SHA-256) à partir de valeurs sérialisables en JSON"""
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """Cache clé/valeur persistant sur disque, partagé entre les workers gunicorn
+
+    Chaque entrée est un fichier JSON dont la date de modification sert de
+    date de dernier accès: l'éviction supprime les entrées les moins
+    récemment utilisées dès que la taille totale dépasse max_size_bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int = 100 * 1024 * 1024, ttl_seconds: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.name = os.path.basename(os.path.normpath(cache_dir))  # Étiquette des métriques
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        if counter in _REQUEST_RESULTS:
+            metrics.inc("chatmd_cache_requests_total", cache=self.name, result=_REQUEST_RESULTS[counter])
+
+    def get(self, key: str) -> Optional[Any]:
+        """Retourne la valeur associée à la clé, ou None si absente ou expirée"""
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+
+        if self.ttl_seconds and time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            self._remove(path)
+            self._count("misses")
+            return None
+
+        # Marquer l'entrée comme récemment utilisée pour l'éviction LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self._count("hits")
+        return entry.get("value")
+
+    def set(self, key: str, value: Any) -> None:
+        """Enregistre une valeur puis évince les entrées les plus anciennes si nécessaire"""
+        entry = {"created_at": time.time(), "value": value}
+        try:
+            # Écriture atomique: les autres workers ne voient jamais de fichier partiel
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError as e:
+            logger.error(f"Erreur lors de l'écriture dans le cache {self.cache_dir}: {str(e)}")
+            return
+
+        self._evict()
+
+    def delete(self, key: str) -> None:
+        """Supprime une entrée (sans effet si elle est absente)"""
+        self._remove(self._entry_path(key))
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        """Liste les entrées du cache sous forme de (date d'accès, taille, chemin)"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self) -> None:
+        entries = self._entries()
+        total_size = sum(size for _, size, _ in entries)
+        if total_size <= self.max_size_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+            self._count("evictions")
+
+    def clear(self) -> None:
+        """Supprime toutes les entrées du cache"""
+        for _, _, path in self._entries():
+            self._remove(path)
+
+    def stats(self) -> Dict[str, Any]:
+        """Retourne les compteurs du processus courant et l'occupation du disque"""
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size_bytes": sum(size for _, size, _ in entries),
+            "max_size_bytes": self.max_size_bytes,
+            "ttl_seconds": self.ttl_seconds,
+        }
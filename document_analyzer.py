@@ -0,0 +1,95 @@
+import logging
+from typing import List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Lignes commençant par ces mots-clés: titres de section probables
+SECTION_KEYWORDS = ("produits", "services", "histoire", "à propos", "contact", "équipe",
+                    "mission", "valeurs", "tarifs", "prix", "promotions", "offres")
+
+# Limites des titres de section candidats
+MAX_SECTION_LINE_LENGTH = 50
+MAX_SECTION_WORDS = 5
+MAX_SECTION_LENGTH = 30
+
+
+def section_keywords(name: str) -> List[str]:
+    """Mots significatifs (plus de 3 lettres) d'un titre, en minuscules"""
+    return [word.lower() for word in name.split() if len(word) > 3]
+
+
+class DocumentAnalysis:
+    """Analyse d'un document en une seule passe, pour la génération sans LLM
+
+    Les lignes sont parcourues une fois pour trouver le titre et les titres
+    de section candidats (lignes terminées par ":", lignes en majuscules,
+    lignes commençant par un mot-clé); les paragraphes sont découpés une
+    fois et leur version en minuscules est précalculée pour les recherches
+    par mot-clé. Le coût est linéaire en la taille du document.
+    """
+
+    def __init__(self, content: str):
+        self.title = "Chatbot"
+        self.paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
+        self._lowered = [p.lower() for p in self.paragraphs]
+
+        title_found = False
+        colon_sections = []
+        upper_sections = []
+        keyword_sections = []
+
+        for line in content.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            if not title_found:
+                self.title = ' '.join(line.split())
+                title_found = True
+
+            if line.endswith(':') and len(line) < MAX_SECTION_LINE_LENGTH:
+                colon_sections.append(' '.join(line.rstrip(':').split()))
+            if line.isupper() and len(line) < MAX_SECTION_LINE_LENGTH:
+                upper_sections.append(' '.join(line.split()))
+            if line.lower().startswith(SECTION_KEYWORDS):
+                keyword_sections.append(' '.join(line.split()))
+
+        # Priorité aux lignes terminées par ":", puis aux majuscules, puis aux mots-clés
+        self.sections = []
+        self._seen: Set[str] = set()
+        for candidates in (colon_sections, upper_sections, keyword_sections):
+            for section in candidates:
+                if section and len(section.split()) <= MAX_SECTION_WORDS and len(section) <= MAX_SECTION_LENGTH:
+                    self.add_section(section)
+
+    def add_section(self, section: str) -> None:
+        """Ajoute un titre de section s'il n'est pas déjà présent (sans tenir compte de la casse)"""
+        key = section.lower()
+        if key not in self._seen:
+            self._seen.add(key)
+            self.sections.append(section)
+
+    def find_paragraph(self, keywords: List[str], used: Optional[Set[int]] = None) -> Optional[int]:
+        """Indice du premier paragraphe (hors used) contenant l'un des mots-clés"""
+        if not keywords:
+            return None
+        for index, lowered in enumerate(self._lowered):
+            if used is not None and index in used:
+                continue
+            for keyword in keywords:
+                if keyword in lowered:
+                    return index
+        return None
+
+    def first_unused_paragraph(self, used: Set[int]) -> Optional[int]:
+        """Indice du premier paragraphe qui n'est pas dans used"""
+        for index in range(len(self.paragraphs)):
+            if index not in used:
+                return index
+        return None
+
+    def intro_paragraph(self) -> Optional[str]:
+        """Premier paragraphe de taille raisonnable pour servir d'introduction"""
+        for paragraph in self.paragraphs:
+            if 50 < len(paragraph) < 300:
+                return ' '.join(paragraph.split())
+        return None
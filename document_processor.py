@@ -1,66 +1,246 @@
+import io
 import os
+import math
+import time
+import hashlib
 import logging
-from typing import Dict, Any, Optional
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from disk_cache import DiskCache, make_key
+from metrics import metrics
+from profiling import span
 
 logger = logging.getLogger(__name__)
 
+# Version de l'extraction: à incrémenter quand le texte produit change,
+# pour invalider les entrées du cache d'extraction
+PROCESSOR_VERSION = 2
+
+# Styles DOCX convertis en titres Markdown (noms anglais et français)
+DOCX_TITLE_STYLES = ("Title", "Titre")
+DOCX_HEADING_STYLES = ("Heading", "Titre")
+
+# PDF ouvert en dernier par un processus du pool: (chemin, lecteur), analysé une fois pour toutes ses plages
+_worker_reader: Optional[Tuple[str, Any]] = None
+
+def _extract_pdf_page_range(path: str, start: int, end: int) -> List[str]:
+    """Extrait le texte des pages [start, end[ d'un PDF (exécuté dans un processus séparé)
+
+    Le PDF est lu dans un fichier temporaire plutôt que transmis avec
+    chaque plage, et chaque processus ne l'analyse qu'une fois.
+    """
+    global _worker_reader
+    if _worker_reader is None or _worker_reader[0] != path:
+        import PyPDF2
+        _worker_reader = (path, PyPDF2.PdfReader(path))
+    reader = _worker_reader[1]
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
 class DocumentProcessor:
     """Classe pour traiter différents formats de documents"""
     
-    def __init__(self):
+    def __init__(self, cache: Optional[DiskCache] = None, max_pages: Optional[int] = None,
+                 max_chars: Optional[int] = None, parallel_min_pages: int = 50, max_processes: int = 4):
         self.supported_formats = {
             '.txt': self._process_txt,
             '.md': self._process_md,
             '.pdf': self._process_pdf,
             '.docx': self._process_docx
         }
+        
+        # Cache du texte extrait (optionnel), indexé par l'empreinte du fichier
+        self.cache = cache
+        
+        # Limites d'extraction PDF: nombre de pages et nombre de caractères (None = illimité)
+        self.max_pages = max_pages
+        self.max_chars = max_chars
+        
+        # Extraction en parallèle (pool de processus) à partir de ce nombre de pages
+        self.parallel_min_pages = parallel_min_pages
+        self.max_processes = max_processes
+        
+        # Pool créé à la première extraction parallèle puis réutilisé, par processus
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        self._executor_lock = threading.Lock()
     
     def process(self, file_path: str, params: Dict[str, Any] = None) -> Optional[str]:
         """Traite un document et retourne son contenu textuel"""
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext not in self.supported_formats:
+            logger.error(f"Format non supporté: {ext}")
+            return None
+        
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logger.error(f"Erreur lors de la lecture du document {file_path}: {str(e)}")
+            return None
+        
+        return self.process_bytes(data, file_path, params)
+    
+    def process_bytes(self, data: bytes, filename: str, params: Dict[str, Any] = None) -> Optional[str]:
+        """Traite le contenu binaire d'un document (ex: fichier uploadé) et retourne son contenu textuel"""
         if params is None:
             params = {}
-            
-        ext = os.path.splitext(file_path)[1].lower()
+        
+        ext = os.path.splitext(filename)[1].lower()
         if ext not in self.supported_formats:
             logger.error(f"Format non supporté: {ext}")
             return None
         
+        started = time.perf_counter()
+        cache_key = None
+        if self.cache:
+            cache_key = make_key(hashlib.sha256(data).hexdigest(), ext, PROCESSOR_VERSION, self.max_pages, self.max_chars)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Texte extrait trouvé dans le cache pour {filename}")
+                self._observe(ext, "cache", started)
+                return cached
+        
         try:
-            return self.supported_formats[ext](file_path, params)
+            with span("extraction"):
+                text = self.supported_formats[ext](data, params)
         except Exception as e:
-            logger.error(f"Erreur lors du traitement du document {file_path}: {str(e)}")
+            logger.error(f"Erreur lors du traitement du document {filename}: {str(e)}")
+            self._observe(ext, "error", started)
             return None
+        
+        self._observe(ext, "extracted", started)
+        if text and cache_key:
+            self.cache.set(cache_key, text)
+        return text
+    
+    @staticmethod
+    def _observe(ext: str, result: str, started: float) -> None:
+        metrics.observe("chatmd_document_processing_seconds", time.perf_counter() - started,
+                        format=ext.lstrip("."), result=result)
     
-    def _process_txt(self, file_path: str, params: Dict[str, Any] = None) -> str:
+    def _process_txt(self, data: bytes, params: Dict[str, Any] = None) -> str:
         """Traite un fichier texte"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        # TextIOWrapper applique la même normalisation des fins de ligne qu'open()
+        return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8').read()
     
-    def _process_md(self, file_path: str, params: Dict[str, Any] = None) -> str:
+    def _process_md(self, data: bytes, params: Dict[str, Any] = None) -> str:
         """Traite un fichier Markdown"""
         # Similaire à txt mais pourrait inclure un traitement spécifique
-        return self._process_txt(file_path, params)
+        return self._process_txt(data, params)
     
-    def _process_pdf(self, file_path: str, params: Dict[str, Any] = None) -> str:
+    def _process_pdf(self, data: bytes, params: Dict[str, Any] = None) -> str:
         """Traite un fichier PDF"""
+        return "".join(page_text + "\n\n" for page_text in self.iter_pdf_pages(data))
+    
+    def iter_pdf_pages(self, data: bytes) -> Iterator[str]:
+        """Produit le texte de chaque page d'un PDF, en s'arrêtant aux limites de pages et de caractères"""
         try:
             import PyPDF2
-            text = ""
-            with open(file_path, 'rb') as f:
-                reader = PyPDF2.PdfReader(f)
-                for page in reader.pages:
-                    text += page.extract_text() + "\n\n"
-            return text
         except ImportError:
             logger.error("PyPDF2 est requis pour traiter les fichiers PDF")
             raise ImportError("PyPDF2 est requis pour traiter les fichiers PDF")
+        
+        reader = PyPDF2.PdfReader(io.BytesIO(data))
+        page_count = len(reader.pages)
+        if self.max_pages is not None:
+            page_count = min(page_count, self.max_pages)
+        
+        if self.max_processes > 1 and page_count >= self.parallel_min_pages:
+            pages = self._iter_pdf_pages_parallel(data, page_count)
+        else:
+            pages = (reader.pages[i].extract_text() or "" for i in range(page_count))
+        
+        remaining_chars = self.max_chars
+        try:
+            for page_text in pages:
+                if remaining_chars is not None:
+                    if len(page_text) >= remaining_chars:
+                        # Budget de caractères atteint: tronquer la page et arrêter l'extraction
+                        yield page_text[:remaining_chars]
+                        return
+                    remaining_chars -= len(page_text)
+                yield page_text
+        finally:
+            pages.close()
+    
+    def _iter_pdf_pages_parallel(self, data: bytes, page_count: int) -> Iterator[str]:
+        """Extrait des plages de pages dans un pool de processus et les produit dans l'ordre"""
+        # Plusieurs plages par processus pour équilibrer la charge et pouvoir s'arrêter tôt
+        range_size = max(1, math.ceil(page_count / (self.max_processes * 4)))
+        ranges = [(start, min(start + range_size, page_count)) for start in range(0, page_count, range_size)]
+        logger.info(f"Extraction PDF parallèle: {page_count} pages, {len(ranges)} plages, {self.max_processes} processus")
+        
+        executor = self._get_executor()
+        futures = []
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            futures = [executor.submit(_extract_pdf_page_range, path, start, end) for start, end in ranges]
+            for future in futures:
+                yield from future.result()
+        except BrokenProcessPool:
+            # Processus du pool arrêté (mémoire, signal): le pool sera recréé à la prochaine extraction
+            self._discard_executor(executor)
+            raise
+        finally:
+            # Annuler les plages restantes si le consommateur s'arrête avant la fin
+            for future in futures:
+                future.cancel()
+            # Les plages en cours ont déjà chargé le PDF en mémoire
+            os.remove(path)
+    
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Pool de processus de ce processus, créé au premier appel"""
+        pid = os.getpid()
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != pid:
+                # "spawn": les workers gunicorn sont multithreadés, un fork pourrait copier
+                # un verrou détenu par un autre thread et bloquer le processus enfant. Les
+                # processus lancés réimportent le script principal (__mp_main__): il doit
+                # pouvoir être importé sans effet (gunicorn, uvicorn; voir app.py)
+                self._executor = ProcessPoolExecutor(max_workers=self.max_processes,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                self._executor_pid = pid
+            return self._executor
     
-    def _process_docx(self, file_path: str, params: Dict[str, Any] = None) -> str:
+    def _discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _process_docx(self, data: bytes, params: Dict[str, Any] = None) -> str:
         """Traite un fichier DOCX"""
         try:
             import docx
-            doc = docx.Document(file_path)
-            return "\n\n".join([para.text for para in doc.paragraphs])
+            doc = docx.Document(io.BytesIO(data))
+            # Avec un paragraphe de style "Titre", les titres de niveau 1 deviennent des "## "
+            heading_offset = 1 if any(self._docx_style(para) in DOCX_TITLE_STYLES for para in doc.paragraphs) else 0
+            return "\n\n".join([self._docx_paragraph_text(para, heading_offset) for para in doc.paragraphs])
         except ImportError:
             logger.error("python-docx est requis pour traiter les fichiers DOCX")
             raise ImportError("python-docx est requis pour traiter les fichiers DOCX")
+    
+    @staticmethod
+    def _docx_style(para) -> str:
+        return para.style.name if para.style is not None else ""
+    
+    @classmethod
+    def _docx_paragraph_text(cls, para, heading_offset: int) -> str:
+        """Texte d'un paragraphe DOCX, les titres (styles "Title"/"Heading N") étant convertis en titres Markdown"""
+        text = para.text.strip()
+        if not text:
+            return para.text
+        
+        style = cls._docx_style(para)
+        if style in DOCX_TITLE_STYLES:
+            return f"# {text}"
+        parts = style.split()
+        if len(parts) == 2 and parts[0] in DOCX_HEADING_STYLES and parts[1].isdigit():
+            return f"{'#' * min(int(parts[1]) + heading_offset, 6)} {text}"
+        return para.text
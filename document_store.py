@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from chatmd_parser import ChatMDDocument, apply_line_edit, reparse
+
+try:
+    import fcntl
+except ImportError:  # Windows: journaux partagés sans verrou entre processus
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Nombre de modifications après lequel le journal d'un document est réécrit en un seul instantané
+COMPACT_AFTER_EDITS = 200
+
+# Intervalle minimal entre deux nettoyages du répertoire partagé (secondes)
+PRUNE_INTERVAL = 300
+
+
+class RevisionConflict(Exception):
+    """La révision de base d'une modification ne correspond pas au document enregistré"""
+
+
+class _Entry:
+    """Document en mémoire et position atteinte dans son journal partagé"""
+
+    __slots__ = ("document", "epoch", "count", "inode", "offset", "logged_edits")
+
+    def __init__(self, document: ChatMDDocument, epoch: str, count: int = 0):
+        self.document = document
+        self.epoch = epoch  # Identifiant du texte complet enregistré en dernier
+        self.count = count  # Modifications appliquées depuis
+        self.inode: Optional[int] = None
+        self.offset = 0
+        self.logged_edits = 0  # Modifications à la suite de l'instantané du journal
+
+    @property
+    def revision(self) -> str:
+        return f"{self.epoch}:{self.count}"
+
+
+class DocumentStore:
+    """Derniers documents ChatMD analysés, par session d'édition (LRU borné, en mémoire)
+
+    La révision d'un document est un compteur de modifications, préfixé
+    par l'identifiant du dernier texte complet reçu: le client peut
+    n'envoyer que les lignes modifiées par rapport à la révision qu'il
+    connaît, et seuls les blocs touchés sont réanalysés. Avec un
+    répertoire partagé (shared_dir), chaque document a un journal entre
+    les workers: un instantané du texte, puis une ligne par modification.
+    Un enregistrement verrouille le journal, lit les modifications écrites
+    par les autres workers depuis sa dernière lecture (en général aucune)
+    et ajoute la sienne: le coût est proportionnel aux modifications, pas
+    à la taille du document. Le journal n'est relu en entier que si le
+    document manque en mémoire ou après un compactage.
+    """
+
+    def __init__(self, max_documents: int = 200, shared_dir: Optional[str] = None,
+                 max_size_bytes: Optional[int] = None, ttl_seconds: Optional[int] = None):
+        self.max_documents = max_documents
+        self.shared_dir = shared_dir
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self._documents: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def _log_path(self, document_id: str) -> str:
+        # L'identifiant est haché: il contient l'identifiant de session
+        return os.path.join(self.shared_dir, hashlib.sha256(document_id.encode("utf-8")).hexdigest() + ".log")
+
+    @contextmanager
+    def _locked_log(self, document_id: str) -> Iterator[BinaryIO]:
+        """Ouvre et verrouille le journal du document (créé vide au besoin)"""
+        path = self._log_path(document_id)
+        while True:
+            log = open(path, "a+b")
+            if fcntl is None:
+                break
+            fcntl.flock(log, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(log.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # Journal remplacé (compactage, nouveau texte) ou supprimé pendant l'attente du verrou
+            log.close()
+        with log:
+            yield log
+
+    def _sync(self, document_id: str, log: BinaryIO) -> Optional[_Entry]:
+        """Met la copie en mémoire à jour d'après le journal verrouillé: modifications des autres workers, ou relecture complète"""
+        entry = self._documents.get(document_id)
+        stat = os.fstat(log.fileno())
+        if entry is not None and entry.inode == stat.st_ino and entry.offset == stat.st_size:
+            return entry  # Aucune écriture depuis la dernière lecture
+
+        if entry is None or entry.inode != stat.st_ino or stat.st_size < entry.offset:
+            # Document absent de la mémoire, ou journal réécrit: relire l'instantané
+            log.seek(0)
+            line = log.readline()
+            if not line.endswith(b"\n"):
+                self._documents.pop(document_id, None)
+                return None
+            snapshot = json.loads(line)
+            entry = _Entry(reparse(entry.document if entry else None, snapshot["text"]),
+                           snapshot["epoch"], snapshot["count"])
+            entry.inode = stat.st_ino
+            entry.offset = log.tell()
+            self._documents[document_id] = entry
+
+        log.seek(entry.offset)
+        for line in log:
+            if not line.endswith(b"\n"):
+                break  # Ligne incomplète (écriture interrompue): ignorée
+            for edit in json.loads(line)["edits"]:
+                entry.document = apply_line_edit(entry.document, edit["start_line"], edit["end_line"], edit["lines"])
+            entry.count += 1
+            entry.logged_edits += 1
+            entry.offset += len(line)
+        return entry
+
+    def _write_snapshot(self, document_id: str, entry: _Entry) -> None:
+        """Remplace le journal par un instantané du texte (écriture atomique)"""
+        data = json.dumps({"epoch": entry.epoch, "count": entry.count,
+                           "text": "\n".join(entry.document.lines)}, ensure_ascii=False).encode("utf-8") + b"\n"
+        fd, tmp_path = tempfile.mkstemp(dir=self.shared_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._log_path(document_id))
+        entry.inode = os.stat(self._log_path(document_id)).st_ino
+        entry.offset = len(data)
+        entry.logged_edits = 0
+
+    def _remember(self, document_id: str, entry: _Entry) -> None:
+        self._documents[document_id] = entry
+        self._documents.move_to_end(document_id)
+        while len(self._documents) > self.max_documents:
+            self._documents.popitem(last=False)
+
+    def get(self, document_id: str) -> Optional[Tuple[ChatMDDocument, str]]:
+        """Retourne (document, révision) pour la session, ou None"""
+        with self._lock:
+            if not self.shared_dir:
+                entry = self._documents.get(document_id)
+            elif not os.path.exists(self._log_path(document_id)):
+                entry = self._documents.pop(document_id, None) and None  # Supprimé par un autre worker
+            else:
+                with self._locked_log(document_id) as log:
+                    entry = self._sync(document_id, log)
+            if entry is None:
+                return None
+            self._remember(document_id, entry)
+            return entry.document, entry.revision
+
+    def discard(self, document_id: str) -> None:
+        with self._lock:
+            self._documents.pop(document_id, None)
+            if self.shared_dir:
+                try:
+                    os.remove(self._log_path(document_id))
+                except OSError:
+                    pass
+
+    def replace(self, document_id: str, text: str) -> Tuple[ChatMDDocument, str]:
+        """Enregistre le texte complet, réanalysé à partir du dernier modèle de la session"""
+        with self._lock:
+            previous = self._documents.get(document_id)
+            entry = _Entry(reparse(previous.document if previous else None, text), uuid.uuid4().hex[:12])
+            if self.shared_dir:
+                with self._locked_log(document_id):
+                    self._write_snapshot(document_id, entry)
+                self._prune()
+            self._remember(document_id, entry)
+            return entry.document, entry.revision
+
+    def apply_edits(self, document_id: str, base_revision: Optional[str],
+                    edits: List[Dict[str, Any]]) -> Tuple[ChatMDDocument, str]:
+        """Applique des remplacements de lignes à la révision base_revision du document
+
+        Chaque modification est un dictionnaire {start_line, end_line, lines}
+        qui remplace les lignes [start_line, end_line[ ; les modifications sont
+        appliquées dans l'ordre, chacune sur le résultat de la précédente.
+        """
+        with self._lock:
+            if not self.shared_dir:
+                entry = self._apply(document_id, self._documents.get(document_id), base_revision, edits)[0]
+                return entry.document, entry.revision
+            with self._locked_log(document_id) as log:
+                entry, applied = self._apply(document_id, self._sync(document_id, log), base_revision, edits)
+                if entry.logged_edits >= COMPACT_AFTER_EDITS:
+                    self._write_snapshot(document_id, entry)
+                else:
+                    line = json.dumps({"edits": applied}, ensure_ascii=False).encode("utf-8") + b"\n"
+                    log.seek(0, os.SEEK_END)
+                    log.write(line)
+                    log.flush()
+                    entry.offset += len(line)
+                    entry.logged_edits += 1
+                return entry.document, entry.revision
+
+    def _apply(self, document_id: str, entry: Optional[_Entry], base_revision: Optional[str],
+               edits: List[Dict[str, Any]]) -> Tuple[_Entry, List[Dict[str, Any]]]:
+        """Applique les modifications à la copie en mémoire: (entrée, modifications validées à journaliser)"""
+        if entry is None:
+            raise RevisionConflict("Document inconnu, renvoyer le texte complet")
+        if base_revision != entry.revision:
+            raise RevisionConflict("Révision obsolète, renvoyer le texte complet")
+
+        document = entry.document
+        applied = []
+        for edit in edits:
+            start, end, lines = self._validate_edit(edit, len(document.lines))
+            document = apply_line_edit(document, start, end, lines)
+            applied.append({"start_line": start, "end_line": end, "lines": lines})
+
+        entry.document = document
+        entry.count += 1
+        self._remember(document_id, entry)
+        return entry, applied
+
+    def _prune(self) -> None:
+        """Supprime les journaux expirés puis les plus anciens au-delà de max_size_bytes (au plus toutes les PRUNE_INTERVAL secondes)"""
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+
+        logs = []
+        for name in os.listdir(self.shared_dir):
+            if not name.endswith(".log"):
+                continue
+            path = os.path.join(self.shared_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if self.ttl_seconds and now - stat.st_mtime > self.ttl_seconds:
+                self._remove_log(path)
+            else:
+                logs.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in logs)
+        for _, size, path in sorted(logs):
+            if not self.max_size_bytes or total <= self.max_size_bytes:
+                break
+            self._remove_log(path)
+            total -= size
+
+    @staticmethod
+    def _remove_log(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Impossible de supprimer le journal {path}: {str(e)}")
+
+    @staticmethod
+    def _validate_edit(edit: Dict[str, Any], line_count: int) -> Tuple[int, int, List[str]]:
+        try:
+            start = edit["start_line"]
+            end = edit["end_line"]
+            lines = edit["lines"]
+        except (KeyError, TypeError):
+            raise ValueError("Modification invalide: start_line, end_line et lines sont requis")
+
+        if not (isinstance(start, int) and isinstance(end, int) and 0 <= start <= end <= line_count):
+            raise ValueError(f"Plage de lignes invalide: [{start}, {end}[ pour {line_count} lignes")
+        if not isinstance(lines, list) or not all(isinstance(line, str) and "\n" not in line for line in lines):
+            raise ValueError("Modification invalide: lines doit être une liste de lignes")
+        return start, end, lines
@@ -0,0 +1,321 @@
+import re
+import math
+import logging
+from functools import lru_cache
+from collections import Counter
+from typing import Dict, Any, List, Optional
+
+from chatmd_matcher import STOP_WORDS, normalize
+
+logger = logging.getLogger(__name__)
+
+# Nombre de phrases extraites par bloc selon la complexité demandée
+SENTENCES_PER_COMPLEXITY = {"beginner": 2, "intermediate": 3, "advanced": 5}
+TRIGGERS_PER_RESPONSE = 3
+MAX_SENTENCE_LENGTH = 400
+MAX_TITLE_LENGTH = 80
+
+# Mots fréquents à ignorer pour les déclencheurs, en plus des mots vides du moteur de correspondance
+EXTRA_STOP_WORDS = frozenset("""
+ainsi alors aussi autre autres avoir cela cette cet ceux comme dont elles entre etait etre ete fait faire
+ils leurs meme ont peut peuvent plus sans selon sont tout tous toute toutes tres
+""".split())
+
+_MD_HEADING_RE = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+_NUMBERED_HEADING_RE = re.compile(r'^((?:\d+|[IVX]+)(?:\.\d+)*)[.)]?\s+([A-ZÀ-Ý].{0,60})$')
+_SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+|\n+')
+_WORD_RE = re.compile(r"[^\W\d_]{3,}")
+_LINK_CHARS_RE = re.compile(r'[\[\]()]')
+# Liens et images Markdown, remplacés par leur texte: dans le contenu, ChatMD les lirait comme des choix
+_MD_LINK_RE = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+# Débuts de ligne lus par ChatMD comme déclencheur ("- "), choix ("1. ", "[") ou titre ("#")
+_LINE_MARKER_RE = re.compile(r'^(?:[-*+•>#]+|\d+[.)]|\[)\s*')
+
+
+class _Section:
+    """Section du document: titre, texte propre (hors sous-sections) et sous-sections"""
+
+    def __init__(self, title: str, level: int):
+        self.title = title
+        self.level = level
+        self.lines: List[str] = []
+        self.children: List["_Section"] = []
+        self.id = ""
+        self.terms: Counter = Counter()
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.lines).strip()
+
+    def all_lines(self) -> List[str]:
+        lines = list(self.lines)
+        for child in self.children:
+            lines.append(child.title + ".")
+            lines.extend(child.all_lines())
+        return lines
+
+
+@lru_cache(maxsize=65536)
+def _is_stop_word(word: str) -> bool:
+    key = normalize(word)
+    return key in STOP_WORDS or key in EXTRA_STOP_WORDS
+
+
+def _terms(text: str) -> List[str]:
+    """Mots significatifs d'un texte, en minuscules (accents conservés)"""
+    return [word for word in _WORD_RE.findall(text.lower()) if not _is_stop_word(word)]
+
+
+def _heuristic_heading(line: str, previous_blank: bool, next_blank: bool) -> Optional[int]:
+    """Niveau d'une ligne de titre dans un texte sans Markdown (lignes isolées en majuscules, numérotées ou terminées par ":")"""
+    if not (previous_blank and next_blank) or len(line) > 60 or line[-1] in ".!?;,":
+        return None
+    match = _NUMBERED_HEADING_RE.match(line)
+    if match:
+        return match.group(1).count(".") + 1
+    if (line.isupper() and len(line) > 3) or (line.endswith(":") and len(line.split()) <= 6):
+        return 1
+    return None
+
+
+def _parse_outline(content: str) -> _Section:
+    """Construit l'arbre des sections à partir des titres Markdown, ou à défaut des titres devinés"""
+    lines = content.split("\n")
+
+    # Ignorer un éventuel en-tête YAML (document déjà au format ChatMD, Markdown avec métadonnées)
+    if lines and lines[0].strip() == "---":
+        end = next((i for i in range(1, len(lines)) if lines[i].strip() == "---"), None)
+        if end is not None:
+            lines = lines[end + 1:]
+
+    headings = {}
+    in_code = False
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+            continue
+        match = None if in_code else _MD_HEADING_RE.match(line)
+        if match:
+            headings[i] = (len(match.group(1)), match.group(2).strip())
+
+    if not headings:
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if not stripped:
+                continue
+            previous_blank = i == 0 or not lines[i - 1].strip()
+            next_blank = i + 1 == len(lines) or not lines[i + 1].strip()
+            level = _heuristic_heading(stripped, previous_blank, next_blank)
+            if level is not None:
+                headings[i] = (level, stripped.rstrip(":").strip())
+
+    root = _Section("", 0)
+    stack = [root]
+    for i, line in enumerate(lines):
+        heading = headings.get(i)
+        if heading is None:
+            stack[-1].lines.append(line)
+            continue
+        level, title = heading
+        while stack[-1].level >= level:
+            stack.pop()
+        section = _Section(title, level)
+        stack[-1].children.append(section)
+        stack.append(section)
+
+    # Un titre de premier niveau unique en tête du document est le titre du chatbot
+    if len(root.children) == 1 and not root.text:
+        only = root.children[0]
+        root.title = only.title
+        root.lines = only.lines
+        root.children = only.children
+    return root
+
+
+def _split_paragraph_groups(root: _Section, groups: int) -> None:
+    """Document sans titres: regroupe les paragraphes en sections consécutives de taille voisine"""
+    paragraphs = [p.strip() for p in root.text.split("\n\n") if p.strip()]
+    if len(paragraphs) < 2:
+        return
+
+    # Le premier paragraphe sert d'introduction
+    root.lines = [paragraphs[0]]
+    paragraphs = paragraphs[1:]
+    groups = max(1, min(groups, len(paragraphs)))
+    size = math.ceil(len(paragraphs) / groups)
+    for start in range(0, len(paragraphs), size):
+        section = _Section("", 1)
+        section.lines = paragraphs[start:start + size]
+        root.children.append(section)
+
+
+def _limit_choices(section: _Section, choices: int) -> None:
+    """Regroupe les sous-sections consécutives pour qu'aucune section n'ait plus de choices sous-sections"""
+    for child in section.children:
+        _limit_choices(child, choices)
+    while len(section.children) > choices:
+        size = math.ceil(len(section.children) / choices)
+        grouped = []
+        for start in range(0, len(section.children), size):
+            members = section.children[start:start + size]
+            if len(members) == 1:
+                grouped.append(members[0])
+                continue
+            # Section intermédiaire, nommée d'après la première et la dernière sous-section regroupées
+            group = _Section(f"{members[0].title} … {members[-1].title}" if members[0].title and members[-1].title else "",
+                             section.level + 1)
+            group.children = members
+            grouped.append(group)
+        section.children = grouped
+
+
+def _limit_depth(section: _Section, depth: int, max_depth: int) -> None:
+    """Replie dans leur parent les sections plus profondes que max_depth"""
+    for child in section.children:
+        if depth + 1 >= max_depth:
+            child.lines = child.all_lines()
+            child.children = []
+        else:
+            _limit_depth(child, depth + 1, max_depth)
+
+
+def _flatten(root: _Section) -> List[_Section]:
+    sections = []
+    stack = list(reversed(root.children))
+    while stack:
+        section = stack.pop()
+        sections.append(section)
+        stack.extend(reversed(section.children))
+    return sections
+
+
+def _clean_sentence(sentence: str) -> str:
+    """Phrase sans liens Markdown ni marqueur de liste ou de titre en tête, sûre dans le contenu d'une réponse
+
+    >>> _clean_sentence("- premier point important - second point [lien](cible)")
+    'premier point important - second point lien'
+    >>> _clean_sentence("1. [Voir](#suite) la suite")
+    'Voir la suite'
+    """
+    sentence = _MD_LINK_RE.sub(r"\1", sentence).strip()
+    while True:
+        cleaned = _LINE_MARKER_RE.sub("", sentence, count=1)
+        if cleaned == sentence:
+            return sentence
+        sentence = cleaned
+
+
+def _select_sentences(text: str, weights: Dict[str, float], count: int) -> str:
+    """Sélection extractive: les phrases les plus chargées en termes importants, dans l'ordre du texte
+
+    Section en liste à puces (chaque élément est une phrase):
+
+    >>> _select_sentences("- point\\n- liste\\n- premier point important - second point [lien](cible)", {}, 3)
+    'point liste premier point important - second point lien'
+    """
+    sentences = [_clean_sentence(s) for s in _SENTENCE_RE.split(text)]
+    sentences = [s for s in sentences if len(s) > 1]
+    if len(sentences) <= count:
+        return " ".join(sentences)
+
+    scored = []
+    for index, sentence in enumerate(sentences):
+        terms = _terms(sentence)
+        score = sum(weights.get(term, 0.0) for term in set(terms)) / math.sqrt(len(terms) + 1)
+        scored.append((score, -index))
+    selected = sorted(-index for _, index in sorted(scored, reverse=True)[:count])
+    return " ".join(sentences[i][:MAX_SENTENCE_LENGTH] for i in selected)
+
+
+def build_extractive_chatbot(content: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Construit un chatbot sans LLM à partir de la structure du document
+
+    Les titres (Markdown, ou lignes de titre devinées dans le texte brut)
+    donnent l'arborescence des réponses, jusqu'à max_depth niveaux; les
+    déclencheurs sont les termes les mieux classés par TF-IDF dans chaque
+    section et le contenu est composé des phrases les plus représentatives.
+    Retourne la même structure JSON que celle demandée au LLM.
+    """
+    max_depth = max(1, int(params.get("max_depth", 3)))
+    choices_per_level = max(1, int(params.get("choices_per_level", 3)))
+    sentence_count = SENTENCES_PER_COMPLEXITY.get(params.get("complexity", "intermediate"), 3)
+
+    root = _parse_outline(content)
+    if not root.children:
+        _split_paragraph_groups(root, choices_per_level)
+    _limit_choices(root, choices_per_level)
+    _limit_depth(root, 0, max_depth)
+    sections = _flatten(root)
+
+    # Fréquences des termes par section et fréquence documentaire pour l'IDF
+    document_frequency: Counter = Counter()
+    for section in sections:
+        section.terms = Counter(_terms(section.text))
+        for term in _terms(section.title):
+            section.terms[term] += 2
+        document_frequency.update(section.terms.keys())
+    root.terms = Counter(_terms(root.text))
+    section_count = len(sections) + 1
+
+    def weights(section: _Section) -> Dict[str, float]:
+        return {term: count * math.log(section_count / (1 + document_frequency[term]) + 1)
+                for term, count in section.terms.items()}
+
+    # Titres manquants (documents sans titres) et identifiants uniques des réponses
+    used_ids = set()
+    for index, section in enumerate(sections, 1):
+        if not section.title:
+            top_terms = [term for term, _ in Counter(weights(section)).most_common(2)]
+            section.title = f"Partie {index}" + (f" : {', '.join(top_terms)}" if top_terms else "")
+        title = _LINK_CHARS_RE.sub("", " ".join(section.title.split()))[:MAX_TITLE_LENGTH].strip() or f"Partie {index}"
+        section.id = title
+        suffix = 2
+        while section.id.lower() in used_ids:
+            section.id = f"{title} {suffix}"
+            suffix += 1
+        used_ids.add(section.id.lower())
+
+    title = " ".join(root.title.split()) if root.title else ""
+    if not title:
+        first_line = next((line.strip().lstrip("#").strip() for line in root.all_lines() if line.strip()), "")
+        title = first_line[:MAX_TITLE_LENGTH] or "Chatbot"
+
+    welcome_message = _select_sentences(root.text, weights(root), 2) if root.text else ""
+    if not welcome_message or welcome_message == title:
+        welcome_message = f"Bienvenue dans ce chatbot interactif sur {title}."
+
+    def choices_for(section: _Section) -> List[Dict[str, str]]:
+        return [{"text": child.id, "target": child.id} for child in section.children]
+
+    responses = {}
+
+    def add_responses(section: _Section, parent: Optional[_Section]) -> None:
+        section_weights = weights(section)
+        triggers = [term for term, _ in Counter(section_weights).most_common(TRIGGERS_PER_RESPONSE)]
+
+        text = section.text
+        if text:
+            response_content = _select_sentences(text, section_weights, sentence_count)
+        elif section.children:
+            response_content = "Cette partie aborde : " + ", ".join(child.id for child in section.children) + "."
+        else:
+            response_content = f"Informations sur {section.id}."
+
+        choices = choices_for(section)
+        if not choices and parent is not None:
+            choices = [{"text": f"Revenir à {parent.id}", "target": parent.id}]
+        responses[section.id] = {"triggers": triggers, "content": response_content, "choices": choices}
+
+        for child in section.children:
+            add_responses(child, section)
+
+    for section in root.children:
+        add_responses(section, None)
+
+    logger.info(f"Chatbot extractif: {len(responses)} réponses à partir de {len(content)} caractères")
+    return {
+        "title": title,
+        "welcome_message": welcome_message,
+        "welcome_choices": choices_for(root),
+        "responses": responses,
+    }
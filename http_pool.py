@@ -0,0 +1,208 @@
+import os
+import socket
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Registre des sessions par backend, partagé au niveau du module pour que
+# les pools de connexions survivent au remplacement de l'instance LLMService
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+# Clients HTTP asynchrones (httpx) par backend, pour AsyncLLMService; liés à la boucle d'événements
+# du processus (une seule boucle par worker ASGI)
+_async_clients: Dict[str, Any] = {}
+
+# Codes HTTP pour lesquels une nouvelle tentative est effectuée
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Valeur invalide pour {name}, utilisation de {default}")
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        logger.warning(f"Valeur invalide pour {name}, utilisation de {default}")
+        return default
+
+
+def get_pool_config(backend: str) -> Dict[str, float]:
+    """Retourne la configuration du pool pour un backend ("local" ou "online")
+
+    Chaque valeur peut être surchargée par une variable d'environnement
+    préfixée par le nom du backend (ex: LOCAL_READ_TIMEOUT), sinon par la
+    variable générique (ex: LLM_READ_TIMEOUT).
+    """
+    prefix = backend.upper()
+    # Le LLM local est lent (génération sur CPU), l'API en ligne beaucoup moins
+    default_read_timeout = 600.0 if backend == "local" else 120.0
+
+    def int_setting(key: str, default: int) -> int:
+        return _env_int(f"{prefix}_{key}", _env_int(f"LLM_{key}", default))
+
+    def float_setting(key: str, default: float) -> float:
+        return _env_float(f"{prefix}_{key}", _env_float(f"LLM_{key}", default))
+
+    return {
+        "pool_size": int_setting("POOL_SIZE", 10),
+        "connect_timeout": float_setting("CONNECT_TIMEOUT", 5.0),
+        "read_timeout": float_setting("READ_TIMEOUT", default_read_timeout),
+        "async_pool_size": int_setting("ASYNC_POOL_SIZE", 200),
+        "max_retries": int_setting("MAX_RETRIES", 3),
+        "backoff_factor": float_setting("BACKOFF_FACTOR", 0.5),
+    }
+
+
+def get_timeout(backend: str) -> Tuple[float, float]:
+    """Retourne le couple (connexion, lecture) de timeouts pour un backend"""
+    pool_config = get_pool_config(backend)
+    return pool_config["connect_timeout"], pool_config["read_timeout"]
+
+
+def _create_session(backend: str) -> requests.Session:
+    pool_config = get_pool_config(backend)
+
+    retry = Retry(
+        total=pool_config["max_retries"],
+        connect=pool_config["max_retries"],
+        read=0,  # Ne pas relancer une génération déjà partie côté serveur
+        status=pool_config["max_retries"],
+        backoff_factor=pool_config["backoff_factor"],
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_config["pool_size"],
+        pool_maxsize=pool_config["pool_size"],
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    logger.info(f"Session HTTP créée pour le backend {backend}: {pool_config}")
+    return session
+
+
+def get_session(backend: str) -> requests.Session:
+    """Retourne la session HTTP (keep-alive) partagée pour un backend"""
+    session = _sessions.get(backend)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        if backend not in _sessions:
+            _sessions[backend] = _create_session(backend)
+        return _sessions[backend]
+
+
+def abort_response(response: requests.Response) -> None:
+    """Interrompt, depuis un autre thread, une réponse lue en streaming
+
+    Fermer le socket ne réveille pas un thread bloqué dans recv(): shutdown()
+    coupe la connexion, le thread lecteur reçoit une erreur et libère la
+    réponse lui-même. La génération s'arrête côté serveur.
+    """
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Connexion déjà fermée
+
+
+def close_sessions() -> None:
+    """Ferme toutes les sessions et libère les connexions du pool"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _create_async_client(backend: str):
+    try:
+        import httpx
+    except ImportError:
+        logger.error("httpx est requis pour AsyncLLMService")
+        raise ImportError("httpx est requis pour AsyncLLMService")
+
+    pool_config = get_pool_config(backend)
+    # Les nouvelles tentatives du transport ne portent que sur l'établissement de la connexion,
+    # comme read=0 pour les sessions requests; les codes HTTP sont relancés par async_post
+    transport = httpx.AsyncHTTPTransport(retries=pool_config["max_retries"])
+    client = httpx.AsyncClient(
+        transport=transport,
+        limits=httpx.Limits(max_connections=pool_config["async_pool_size"],
+                            max_keepalive_connections=pool_config["async_pool_size"]),
+        timeout=httpx.Timeout(pool_config["read_timeout"], connect=pool_config["connect_timeout"]),
+    )
+    logger.info(f"Client HTTP asynchrone créé pour le backend {backend}: {pool_config}")
+    return client
+
+
+def get_async_client(backend: str):
+    """Retourne le client HTTP asynchrone (keep-alive) partagé pour un backend"""
+    client = _async_clients.get(backend)
+    if client is None or client.is_closed:
+        client = _async_clients[backend] = _create_async_client(backend)
+    return client
+
+
+def _retry_delay(response, attempt: int, backoff_factor: float) -> float:
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    return backoff_factor * (2 ** (attempt - 1))
+
+
+async def async_post(backend: str, url: str, headers: Dict[str, str], payload: Dict[str, Any], stream: bool = False):
+    """Envoie une requête POST avec le client asynchrone d'un backend
+
+    Les réponses RETRY_STATUS_CODES sont relancées avec le même délai
+    exponentiel (ou Retry-After) que les sessions requests. Avec stream,
+    la réponse est retournée avant la lecture du corps et doit être fermée
+    par l'appelant (aclose).
+    """
+    client = get_async_client(backend)
+    pool_config = get_pool_config(backend)
+    attempt = 0
+    while True:
+        request = client.build_request("POST", url, headers=headers, json=payload)
+        response = await client.send(request, stream=stream)
+        if response.status_code not in RETRY_STATUS_CODES or attempt >= pool_config["max_retries"]:
+            return response
+        attempt += 1
+        await response.aclose()
+        delay = _retry_delay(response, attempt, pool_config["backoff_factor"])
+        logger.warning(f"Code {response.status_code} du backend {backend}, nouvelle tentative dans {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+async def close_async_clients() -> None:
+    """Ferme les clients asynchrones et libère les connexions (arrêt du serveur ASGI)"""
+    clients = list(_async_clients.values())
+    _async_clients.clear()
+    for client in clients:
+        await client.aclose()
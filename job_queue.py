@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: les tâches d'un worker arrêté ne sont supprimées qu'à expiration
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Statuts possibles d'une tâche
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_ERROR = "error"
+
+# Intervalle minimal entre deux suppressions des tâches expirées par un même processus (secondes)
+PRUNE_INTERVAL = 60
+
+# Message d'erreur des tâches dont le worker s'est arrêté avant de les terminer
+ORPHANED_ERROR = "Le worker qui exécutait la tâche s'est arrêté avant de la terminer"
+
+
+class JobQueue:
+    """File de tâches asynchrones avec un pool de workers borné
+
+    L'état des tâches est écrit sur disque pour que n'importe quel worker
+    gunicorn puisse répondre aux requêtes de suivi, quel que soit le
+    processus qui exécute la tâche. Chaque processus détient, tant qu'il
+    vit, un verrou fcntl.flock sur owner-<id>.lock; une tâche en attente
+    ou en cours dont le verrou du propriétaire est libre a perdu son
+    worker (arrêt, plantage) et passe en erreur.
+    """
+
+    def __init__(self, jobs_dir: str = None, max_workers: int = 2, max_pending: int = 20,
+                 ttl_seconds: int = 3600):
+        self.jobs_dir = jobs_dir or os.path.join(tempfile.gettempdir(), "chatmd_jobs")
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chatmd-job")
+        self._lock = threading.Lock()
+        self._pending = 0  # Tâches en attente ou en cours dans ce processus
+        self._owner: Optional[str] = None
+        self._owner_pid: Optional[int] = None
+        self._owner_lock = None
+        self._last_prune = 0.0
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _write_job(self, job: Dict[str, Any]) -> None:
+        # Écriture atomique pour ne jamais exposer un fichier à moitié écrit
+        path = self._job_path(job["id"])
+        fd, tmp_path = tempfile.mkstemp(dir=self.jobs_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(job, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _save(self, job: Dict[str, Any]) -> bool:
+        """Écrit l'état d'une tâche exécutée dans ce processus; False si l'écriture échoue"""
+        try:
+            self._write_job(job)
+            return True
+        except (OSError, TypeError, ValueError) as e:
+            logger.error(f"Impossible d'enregistrer l'état de la tâche {job['id']}: {str(e)}")
+            return False
+
+    def _owner_path(self, owner: str) -> str:
+        return os.path.join(self.jobs_dir, f"owner-{owner}.lock")
+
+    def _owner_id(self) -> str:
+        """Identifiant de ce processus, unique même si le système réutilise un pid"""
+        pid = os.getpid()
+        with self._lock:
+            if self._owner_pid == pid:
+                return self._owner
+            owner = f"{pid}-{uuid.uuid4().hex[:8]}"
+            if fcntl is not None:
+                # Verrouillé sous un nom temporaire puis renommé: jamais vu libre par un autre processus
+                fd, tmp_path = tempfile.mkstemp(dir=self.jobs_dir, suffix=".tmp")
+                lock_file = os.fdopen(fd, "wb")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                os.replace(tmp_path, self._owner_path(owner))
+                self._owner_lock = lock_file
+            self._owner, self._owner_pid = owner, pid
+            return owner
+
+    def _owner_alive(self, owner: str) -> bool:
+        """Indique si le processus propriétaire détient encore son verrou"""
+        if fcntl is None or owner == self._owner:
+            return True
+        path = self._owner_path(owner)
+        try:
+            with open(path, "rb") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return True
+                os.remove(path)  # Processus arrêté: ses autres tâches trouveront le verrou absent
+        except OSError:
+            pass
+        return False
+
+    def _check_owner(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Passe en erreur une tâche en attente ou en cours dont le worker s'est arrêté"""
+        if job.get("status") not in (STATUS_QUEUED, STATUS_RUNNING) or not job.get("owner"):
+            return job
+        if self._owner_alive(job["owner"]):
+            return job
+        logger.warning(f"Tâche {job['id']} abandonnée par le worker {job['owner']}")
+        job["status"] = STATUS_ERROR
+        job["error"] = ORPHANED_ERROR
+        job["finished_at"] = time.time()
+        if job.get("started_at") is not None:
+            job["run_time"] = job["finished_at"] - job["started_at"]
+        try:
+            self._write_job(job)
+        except OSError as e:
+            logger.warning(f"Impossible de mettre à jour la tâche {job['id']}: {str(e)}")
+        return job
+
+    def _prune(self) -> None:
+        """Supprime les tâches expirées (au plus toutes les PRUNE_INTERVAL secondes)
+
+        Un fichier non modifié depuis ttl_seconds appartient à une tâche
+        terminée depuis ce délai, ou jamais terminée: sa date suffit, sans
+        lire les résultats qu'il contient; seule une tâche encore en cours
+        dans un worker en vie est conservée.
+        """
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+
+        try:
+            names = os.listdir(self.jobs_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith((".json", ".tmp")):
+                continue
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if now - os.path.getmtime(path) <= self.ttl_seconds:
+                    continue
+                if name.endswith(".json") and self._still_running(path):
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+
+    def _still_running(self, path: str) -> bool:
+        """Indique si la tâche d'un fichier expiré est encore exécutée par un worker en vie (tâche très longue)"""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (job.get("status") in (STATUS_QUEUED, STATUS_RUNNING) and bool(job.get("owner"))
+                and self._owner_alive(job["owner"]))
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Optional[str]:
+        """Soumet une tâche et retourne son identifiant, ou None si la file est pleine"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                logger.warning(f"File de tâches pleine ({self._pending}/{self.max_pending})")
+                return None
+            self._pending += 1
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": STATUS_QUEUED,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "queue_time": None,
+            "run_time": None,
+            "error": None,
+            "result": None,
+            "pid": os.getpid(),
+            "owner": self._owner_id(),
+        }
+        self._write_job(job)
+        self._executor.submit(self._run, job, func, args, kwargs)
+        self._prune()
+
+        logger.info(f"Tâche {job['id']} soumise")
+        return job["id"]
+
+    def _run(self, job: Dict[str, Any], func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]) -> None:
+        try:
+            job["status"] = STATUS_RUNNING
+            job["started_at"] = time.time()
+            job["queue_time"] = job["started_at"] - job["submitted_at"]
+            self._save(job)
+
+            try:
+                job["result"] = func(*args, **kwargs)
+                job["status"] = STATUS_DONE
+            except Exception as e:
+                logger.error(f"Erreur lors de l'exécution de la tâche {job['id']}: {str(e)}")
+                job["status"] = STATUS_ERROR
+                job["error"] = str(e)
+
+            job["finished_at"] = time.time()
+            job["run_time"] = job["finished_at"] - job["started_at"]
+            if not self._save(job):
+                # Résultat impossible à enregistrer (non sérialisable, disque plein): la tâche passe en erreur
+                job["status"] = STATUS_ERROR
+                job["result"] = None
+                job["error"] = "Impossible d'enregistrer le résultat de la tâche"
+                self._save(job)
+            logger.info(f"Tâche {job['id']} terminée ({job['status']}) en {job['run_time']:.2f}s")
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Retourne l'état d'une tâche, ou None si elle est inconnue"""
+        # L'identifiant provient de l'URL: refuser tout ce qui n'est pas un uuid hexadécimal
+        if not job_id or len(job_id) != 32 or any(c not in "0123456789abcdef" for c in job_id):
+            return None
+        self._prune()
+        try:
+            with open(self._job_path(job_id), "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return self._check_owner(job)
+
+    def stats(self) -> Dict[str, Any]:
+        """Retourne la profondeur de la file et les temps moyens, tous workers confondus"""
+        counts = {STATUS_QUEUED: 0, STATUS_RUNNING: 0, STATUS_DONE: 0, STATUS_ERROR: 0}
+        queue_times = []
+        run_times = []
+        now = time.time()
+
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".json"):
+                continue
+            job = self.get(name[:-5])
+            if not job:
+                continue
+
+            # Supprimer les tâches trop anciennes: terminées, ou soumises depuis plus longtemps
+            # que la durée de conservation (tâches d'un worker arrêté sous Windows); get() a déjà
+            # passé en erreur celles d'un worker arrêté, les autres tâches en cours sont conservées
+            running_alive = job["status"] in (STATUS_QUEUED, STATUS_RUNNING) and job.get("owner") and fcntl is not None
+            if not running_alive and now - (job.get("finished_at") or job["submitted_at"]) > self.ttl_seconds:
+                try:
+                    os.remove(self._job_path(job["id"]))
+                except OSError:
+                    pass
+                continue
+
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+            if job.get("queue_time") is not None:
+                queue_times.append(job["queue_time"])
+            if job.get("run_time") is not None:
+                run_times.append(job["run_time"])
+
+        return {
+            "queue_depth": counts[STATUS_QUEUED],
+            "running": counts[STATUS_RUNNING],
+            "done": counts[STATUS_DONE],
+            "error": counts[STATUS_ERROR],
+            "local_pending": self._pending,
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "avg_queue_time": sum(queue_times) / len(queue_times) if queue_times else None,
+            "avg_run_time": sum(run_times) / len(run_times) if run_times else None,
+        }
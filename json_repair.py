@@ -0,0 +1,456 @@
+import re
+import logging
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+_NUMBER_RE = re.compile(r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+_BAREWORD_RE = re.compile(r'[A-Za-z_$À-ÿ][\w$\-]*')
+_WHITESPACE = " \t\r\n"
+# Caractères qui peuvent suivre la fin d'une chaîne: sinon le guillemet fait partie du texte
+_AFTER_STRING = ",:}]"
+_ESCAPES = {'"': '"', "'": "'", "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+_LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+
+# Corrections signalées dans ParseResult.repairs
+REPAIR_TRUNCATED = "truncated"
+REPAIR_TRAILING_COMMA = "trailing_comma"
+REPAIR_SINGLE_QUOTES = "single_quotes"
+REPAIR_UNQUOTED = "unquoted"
+REPAIR_INNER_QUOTE = "inner_quote"
+REPAIR_COMMENT = "comment"
+REPAIR_MISSING_COMMA = "missing_comma"
+REPAIR_INVALID = "invalid"
+
+
+class ParseResult:
+    """Résultat d'une analyse tolérante
+
+    value est la valeur reconstruite (None si aucune structure n'a été
+    trouvée), complete indique si le texte contenait la valeur entière et
+    repairs liste les défauts corrigés. Les conteneurs coupés par la fin du
+    texte ou par un passage irréparable sont conservés avec leurs éléments
+    complets et sont repérés par is_complete().
+    """
+
+    def __init__(self, value: Any, complete: bool, repairs: Set[str], incomplete: Set[int]):
+        self.value = value
+        self.complete = complete
+        self.repairs = repairs
+        self._incomplete = incomplete
+
+    def is_complete(self, container: Any) -> bool:
+        return id(container) not in self._incomplete
+
+
+class _Truncated(Exception):
+    """Fin du texte atteinte au milieu d'une valeur scalaire"""
+
+
+class _TolerantParser:
+    """Analyseur JSON récursif qui accepte les défauts courants des sorties de LLM
+
+    Virgules finales ou manquantes, chaînes entre apostrophes, clés sans
+    guillemets, guillemets non échappés dans le texte, commentaires // et
+    /* */, littéraux Python (True, None) et texte tronqué.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.repairs: Set[str] = set()
+        # Identifiants des conteneurs coupés (tous restent référencés par la valeur retournée)
+        self.incomplete: Set[int] = set()
+
+    def _invalid(self, error: ValueError) -> None:
+        """Passage irréparable: l'analyse s'arrête là, les conteneurs ouverts sont fermés comme coupés"""
+        logger.warning(f"JSON irréparable, éléments complets conservés: {str(error)}")
+        self.repairs.add(REPAIR_INVALID)
+        self.pos = len(self.text)
+
+    def _skip(self) -> None:
+        """Avance après les blancs et les commentaires"""
+        text = self.text
+        while self.pos < len(text):
+            char = text[self.pos]
+            if char in _WHITESPACE:
+                self.pos += 1
+            elif text.startswith("//", self.pos):
+                end = text.find("\n", self.pos)
+                self.pos = len(text) if end == -1 else end + 1
+                self.repairs.add(REPAIR_COMMENT)
+            elif text.startswith("/*", self.pos):
+                end = text.find("*/", self.pos + 2)
+                self.pos = len(text) if end == -1 else end + 2
+                self.repairs.add(REPAIR_COMMENT)
+            else:
+                break
+
+    def parse_value(self) -> Tuple[Any, bool]:
+        """Retourne (valeur, complète); lève _Truncated si aucune valeur n'a pu être lue"""
+        self._skip()
+        if self.pos >= len(self.text):
+            raise _Truncated()
+
+        char = self.text[self.pos]
+        if char == "{":
+            return self._parse_object()
+        if char == "[":
+            return self._parse_array()
+        if char in "\"'":
+            return self.parse_string()
+        if char in "-.0123456789":
+            return self._parse_number()
+
+        match = _BAREWORD_RE.match(self.text, self.pos)
+        if not match:
+            raise ValueError(f"Caractère inattendu {char!r} à la position {self.pos}")
+        self.pos = match.end()
+        word = match.group(0)
+        if word in _LITERALS:
+            return _LITERALS[word], True
+        if self.pos >= len(self.text) and any(literal.startswith(word) for literal in _LITERALS):
+            raise _Truncated()
+        self.repairs.add(REPAIR_UNQUOTED)
+        return word, self.pos < len(self.text)
+
+    def _parse_number(self) -> Tuple[Any, bool]:
+        match = _NUMBER_RE.match(self.text, self.pos)
+        if not match:
+            raise ValueError(f"Nombre invalide à la position {self.pos}")
+        self.pos = match.end()
+        if self.pos >= len(self.text):
+            # Le nombre a pu être coupé
+            raise _Truncated()
+        number = match.group(0)
+        if any(char in number for char in ".eE"):
+            return float(number), True
+        return int(number), True
+
+    def parse_string(self) -> Tuple[str, bool]:
+        text = self.text
+        quote = text[self.pos]
+        if quote == "'":
+            self.repairs.add(REPAIR_SINGLE_QUOTES)
+        self.pos += 1
+        chars = []
+        while self.pos < len(text):
+            char = text[self.pos]
+            if char == "\\":
+                if self.pos + 1 >= len(text):
+                    break
+                escaped = text[self.pos + 1]
+                if escaped == "u" and self.pos + 6 <= len(text):
+                    try:
+                        chars.append(chr(int(text[self.pos + 2:self.pos + 6], 16)))
+                        self.pos += 6
+                        continue
+                    except ValueError:
+                        pass
+                chars.append(_ESCAPES.get(escaped, escaped))
+                self.pos += 2
+                continue
+            if char == quote:
+                # Un guillemet suivi d'autre chose qu'un séparateur appartient au texte, sauf
+                # s'il termine la ligne et que la suivante commence par une chaîne (virgule oubliée)
+                after = self.pos + 1
+                while after < len(text) and text[after] in _WHITESPACE:
+                    after += 1
+                if (after >= len(text) or text[after] in _AFTER_STRING or
+                        (text[after] in "\"'" and "\n" in text[self.pos + 1:after])):
+                    self.pos += 1
+                    return "".join(chars), True
+                self.repairs.add(REPAIR_INNER_QUOTE)
+            chars.append(char)
+            self.pos += 1
+        return "".join(chars), False
+
+    def _parse_key(self) -> Tuple[str, bool]:
+        if self.text[self.pos] in "\"'":
+            return self.parse_string()
+        match = _BAREWORD_RE.match(self.text, self.pos)
+        if not match:
+            raise ValueError(f"Clé invalide à la position {self.pos}")
+        self.pos = match.end()
+        self.repairs.add(REPAIR_UNQUOTED)
+        return match.group(0), self.pos < len(self.text)
+
+    def _parse_object(self) -> Tuple[Dict[str, Any], bool]:
+        result: Dict[str, Any] = {}
+        self.pos += 1
+        expect_member = True
+        while True:
+            self._skip()
+            if self.pos >= len(self.text):
+                break
+            char = self.text[self.pos]
+            if char == "}":
+                if expect_member and result:
+                    self.repairs.add(REPAIR_TRAILING_COMMA)
+                self.pos += 1
+                return result, True
+            if char == ",":
+                self.pos += 1
+                expect_member = True
+                continue
+            if not expect_member:
+                self.repairs.add(REPAIR_MISSING_COMMA)
+
+            try:
+                key, complete = self._parse_key()
+                self._skip()
+                if not complete or self.pos >= len(self.text):
+                    break
+                if self.text[self.pos] != ":":
+                    raise ValueError(f"':' attendu après la clé {key!r} à la position {self.pos}")
+                self.pos += 1
+                value, complete = self.parse_value()
+            except _Truncated:
+                break
+            except ValueError as e:
+                self._invalid(e)
+                break
+            if complete:
+                result[key] = value
+            elif isinstance(value, (dict, list)):
+                # Conteneur coupé: conservé avec ses éléments complets
+                result[key] = value
+                break
+            else:
+                break
+            expect_member = False
+
+        self.incomplete.add(id(result))
+        if REPAIR_INVALID not in self.repairs:
+            self.repairs.add(REPAIR_TRUNCATED)
+        return result, False
+
+    def _parse_array(self) -> Tuple[List[Any], bool]:
+        result: List[Any] = []
+        self.pos += 1
+        expect_item = True
+        while True:
+            self._skip()
+            if self.pos >= len(self.text):
+                break
+            char = self.text[self.pos]
+            if char == "]":
+                if expect_item and result:
+                    self.repairs.add(REPAIR_TRAILING_COMMA)
+                self.pos += 1
+                return result, True
+            if char == ",":
+                self.pos += 1
+                expect_item = True
+                continue
+            if not expect_item:
+                self.repairs.add(REPAIR_MISSING_COMMA)
+
+            try:
+                value, complete = self.parse_value()
+            except _Truncated:
+                break
+            except ValueError as e:
+                self._invalid(e)
+                break
+            if complete or isinstance(value, (dict, list)):
+                result.append(value)
+            if not complete:
+                break
+            expect_item = False
+
+        self.incomplete.add(id(result))
+        if REPAIR_INVALID not in self.repairs:
+            self.repairs.add(REPAIR_TRUNCATED)
+        return result, False
+
+
+def parse_tolerant(text: str) -> ParseResult:
+    """Analyse le premier objet JSON d'un texte en corrigeant les défauts courants
+
+    Le texte qui précède la première accolade (explications, bloc de code
+    ```json) et celui qui suit la fin de l'objet sont ignorés.
+    """
+    start = text.find("{")
+    if start == -1:
+        return ParseResult(None, False, set(), set())
+
+    parser = _TolerantParser(text)
+    parser.pos = start
+    try:
+        value, complete = parser.parse_value()
+    except _Truncated:
+        return ParseResult(None, False, parser.repairs | {REPAIR_TRUNCATED}, set())
+    except ValueError as e:
+        logger.warning(f"JSON irréparable: {str(e)}")
+        return ParseResult(None, False, parser.repairs, set())
+    return ParseResult(value, complete, parser.repairs, parser.incomplete)
+
+
+def _clean_choices(choices: Any, result: ParseResult) -> List[Dict[str, str]]:
+    """Choix utilisables: objets complets avec un texte et une cible"""
+    if not isinstance(choices, list):
+        return []
+    return [
+        {"text": str(choice["text"]), "target": str(choice["target"])}
+        for choice in choices
+        if isinstance(choice, dict) and result.is_complete(choice) and choice.get("text") and choice.get("target")
+    ]
+
+
+def salvage_chatbot(text: str) -> Tuple[Optional[Dict[str, Any]], ParseResult]:
+    """Reconstruit la structure JSON d'un chatbot à partir d'une réponse de LLM, même défectueuse
+
+    Retourne (chatbot, résultat de l'analyse). Toutes les entrées complètes
+    de "responses" sont conservées; une entrée coupée par la fin du texte
+    est écartée. chatbot vaut None si la réponse ne contient ni message
+    d'accueil ni réponse exploitable.
+    """
+    result = parse_tolerant(text)
+    data = result.value
+    if not isinstance(data, dict):
+        return None, result
+
+    responses = {}
+    raw_responses = data.get("responses")
+    if isinstance(raw_responses, dict):
+        for response_id, entry in raw_responses.items():
+            if not isinstance(entry, dict) or not result.is_complete(entry):
+                continue
+            triggers = entry.get("triggers")
+            responses[str(response_id)] = {
+                "triggers": [str(trigger) for trigger in triggers if isinstance(trigger, (str, int, float))]
+                            if isinstance(triggers, list) else [],
+                "content": str(entry.get("content") or ""),
+                "choices": _clean_choices(entry.get("choices"), result),
+            }
+
+    welcome_message = data.get("welcome_message")
+    if not responses and not isinstance(welcome_message, str):
+        return None, result
+
+    title = data.get("title") if isinstance(data.get("title"), str) and data.get("title").strip() else "Chatbot"
+    chatbot = {
+        "title": title,
+        "welcome_message": welcome_message if isinstance(welcome_message, str) else "",
+        "welcome_choices": _clean_choices(data.get("welcome_choices"), result),
+        "responses": responses,
+    }
+    return chatbot, result
+
+
+class StreamingChatbotParser:
+    """Suit la réponse JSON d'un LLM au fil des fragments et isole chaque entrée de "responses" terminée
+
+    Seuls les nouveaux caractères sont examinés à chaque fragment (coût
+    linéaire sur toute la génération); chaque entrée terminée est analysée
+    une seule fois avec l'analyseur tolérant.
+    """
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._stack: List[str] = []
+        self._quote: Optional[str] = None
+        self._escape = False
+        # Guillemet rencontré dans une chaîne: fin de chaîne ou guillemet du texte selon le caractère suivant
+        self._pending_close = False
+        self._literal: List[str] = []
+        self._bareword: List[str] = []
+        self._last_literal: Optional[str] = None
+        self._keys: Dict[int, Optional[str]] = {}
+        self._entry: Optional[List[str]] = None
+        self._entry_key: Optional[str] = None
+        self.completed: List[str] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def _in_responses(self) -> bool:
+        return len(self._stack) == 2 and self._stack == ["{", "{"] and self._keys.get(1) == "responses"
+
+    def feed(self, fragment: str) -> List[Tuple[str, Dict[str, Any]]]:
+        """Ajoute un fragment et retourne les entrées de "responses" terminées par ce fragment"""
+        self._parts.append(fragment)
+        finished = []
+        for char in fragment:
+            if self._entry is not None:
+                self._entry.append(char)
+
+            if self._quote is not None:
+                if self._pending_close:
+                    if char in _WHITESPACE:
+                        self._literal.append(char)
+                        continue
+                    if char in _AFTER_STRING or (char in "\"'" and "\n" in self._literal):
+                        self._end_string()
+                    else:
+                        self._pending_close = False
+                        self._literal.append(char)
+                        continue
+                elif self._escape:
+                    self._escape = False
+                    self._literal.append(char)
+                    continue
+                elif char == "\\":
+                    self._escape = True
+                    self._literal.append(char)
+                    continue
+                elif char == self._quote:
+                    self._pending_close = True
+                    self._literal.append(char)
+                    continue
+                else:
+                    self._literal.append(char)
+                    continue
+
+            # Mot sans guillemets (clé, nombre ou littéral)
+            if char.isalnum() or char in "_$-.":
+                if self._stack:
+                    self._bareword.append(char)
+                continue
+            if self._bareword:
+                self._last_literal = "".join(self._bareword)
+                self._bareword = []
+
+            if char in "\"'":
+                if self._stack:
+                    self._quote = char
+                    self._literal = [char]
+            elif char in "{[":
+                if char == "{" and self._in_responses():
+                    self._entry = [char]
+                    self._entry_key = self._keys.get(2)
+                self._stack.append(char)
+                self._keys[len(self._stack)] = None
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if self._entry is not None and self._in_responses():
+                    entry = self._finish_entry()
+                    if entry:
+                        finished.append(entry)
+            elif char == ":" and self._stack and self._stack[-1] == "{":
+                self._keys[len(self._stack)] = self._last_literal
+        return finished
+
+    def _end_string(self) -> None:
+        literal = "".join(self._literal)
+        value, _ = _TolerantParser(literal).parse_string()
+        self._last_literal = value
+        self._quote = None
+        self._pending_close = False
+        self._literal = []
+
+    def _finish_entry(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        text = "".join(self._entry)
+        key = self._entry_key
+        self._entry = None
+        self._entry_key = None
+        if not key:
+            return None
+        result = parse_tolerant(text)
+        if not isinstance(result.value, dict) or not result.complete:
+            return None
+        self.completed.append(key)
+        return key, result.value
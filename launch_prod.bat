@@ -32,6 +32,7 @@ for /f "tokens=*" %%a in ('python -c "import json; print(json.load(open('config_
 for /f "tokens=*" %%a in ('python -c "import json; print(json.load(open('config_prod.json'))['port'])"') do set PORT=%%a
 for /f "tokens=*" %%a in ('python -c "import json; print(json.load(open('config_prod.json'))['workers'])"') do set WORKERS=%%a
 for /f "tokens=*" %%a in ('python -c "import json; print(json.load(open('config_prod.json'))['timeout'])"') do set TIMEOUT=%%a
+for /f "tokens=*" %%a in ('python -c "import json; print(json.load(open('config_prod.json')).get('threads', 8))"') do set THREADS=%%a
 
 :: Créer les répertoires nécessaires s'ils n'existent pas
 if not exist static\js mkdir static\js
@@ -70,7 +71,7 @@ set FLASK_ENV=production
 
 :: Lancer Gunicorn
 echo [INFO] Lancement de Gunicorn...
-gunicorn --bind %HOST%:%PORT% --workers %WORKERS% --timeout %TIMEOUT% wsgi:application
+gunicorn --bind %HOST%:%PORT% --workers %WORKERS% --worker-class gthread --threads %THREADS% --timeout %TIMEOUT% wsgi:application
 
 :: Vérifier si Gunicorn s'est lancé correctement
 if %ERRORLEVEL% neq 0 (
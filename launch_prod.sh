@@ -57,6 +57,7 @@ config = {
     'host': '0.0.0.0',
     'port': 8000,
     'workers': 4,
+    'threads': 8,
     'timeout': 120
 }
 with open('config_prod.json', 'w', encoding='utf-8') as f:
@@ -74,6 +75,7 @@ HOST=$(python -c "import json; print(json.load(open('config_prod.json'))['host']
 PORT=$(python -c "import json; print(json.load(open('config_prod.json'))['port'])")
 WORKERS=$(python -c "import json; print(json.load(open('config_prod.json'))['workers'])")
 TIMEOUT=$(python -c "import json; print(json.load(open('config_prod.json'))['timeout'])")
+THREADS=$(python -c "import json; print(json.load(open('config_prod.json')).get('threads', 8))")
 
 # Créer les répertoires nécessaires s'ils n'existent pas
 mkdir -p static/js static/css templates models
@@ -108,8 +110,8 @@ log_info "Serveur accessible à l'adresse: http://$HOST:$PORT"
 export FLASK_APP=wsgi.py
 export FLASK_ENV=production
 
-# Lancer Gunicorn
-gunicorn --bind $HOST:$PORT --workers $WORKERS --timeout $TIMEOUT wsgi:application
+# Lancer Gunicorn: workers à threads (gthread), le timeout ne coupe pas les générations longues ni les flux SSE
+gunicorn --bind $HOST:$PORT --workers $WORKERS --worker-class gthread --threads $THREADS --timeout $TIMEOUT wsgi:application
 
 # Vérifier si Gunicorn s'est lancé correctement
 if [ $? -ne 0 ]; then
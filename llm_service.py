@@ -1,209 +1,851 @@
-import requests
 import json
+import time
+import hashlib
 import logging
 import os
-from typing import Dict, Any, List, Optional
+import threading
+from typing import Dict, Any, List, Optional, Iterator, Set, Tuple
 from dotenv import load_dotenv
+from http_pool import abort_response, get_session, get_timeout
+from disk_cache import DiskCache, make_key
+from chunking import CHARS_PER_TOKEN, estimate_tokens, split_into_chunks
+from document_analyzer import DocumentAnalysis, section_keywords
+from extractive_generator import build_extractive_chatbot
+from backend_stats import backend_stats
+from metrics import metrics
+from profiling import span
+from single_flight import single_flight
+from admission import admission
+from json_repair import StreamingChatbotParser, salvage_chatbot
+from chatbot_schema import CHATBOT_SCHEMA, RESPONSES_SCHEMA, validate_chatbot
+from chatmd_prompts import build_chatmd_messages
+from token_budget import (DEFAULT_COMPLETION_TOKENS, SAFETY_MARGIN, blocks_completion_tokens,
+                          chatbot_completion_tokens, context_window, count_message_tokens, count_tokens,
+                          fit_messages, use_tiktoken)
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Charger les variables d'environnement depuis le fichier .env
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Consommation de tokens de chaque appel (une ligne JSON par appel), pour le suivi de capacité
+usage_logger = logging.getLogger(f"{__name__}.usage")
+
+# Introduction du document dans le message utilisateur de la génération (document complet ou plans des morceaux)
+_DOCUMENT_PROMPT = "Voici le document à transformer en chatbot:\n\n"
+_OUTLINE_PROMPT = "Voici le plan détaillé du document à transformer en chatbot, partie par partie:\n\n"
+
+# Marqueur de fin d'un flux SSE compatible OpenAI ("data: [DONE]")
+_STREAM_DONE: Dict[str, Any] = {}
+
+# Backends ayant refusé le paramètre response_format (erreur 400/422), propres à chaque processus
+_RESPONSE_FORMAT_UNSUPPORTED: Set[str] = set()
+
+class _Cancellation:
+    """Annulation de la requête perdante d'un appel doublé
+
+    Le thread qui annule ferme lui-même la connexion: sans cela, la requête
+    ne s'arrête qu'au fragment suivant, qu'un serveur encore occupé par le
+    prompt peut mettre longtemps à envoyer.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._response = None
+    
+    def is_set(self) -> bool:
+        return self._cancelled
+    
+    def attach(self, response) -> None:
+        """Enregistre la réponse en cours de lecture, fermée aussitôt si l'appel est déjà annulé"""
+        with self._lock:
+            self._response = response
+            cancelled = self._cancelled
+        if cancelled:
+            abort_response(response)
+    
+    def set(self) -> None:
+        with self._lock:
+            self._cancelled = True
+            response = self._response
+        if response is not None:
+            abort_response(response)
+
+
 class LLMService:
     """Service d'interaction avec le LLM"""
     
-    def __init__(self, api_url=None, model=None, use_online=False):
+    def __init__(self, api_url=None, model=None, use_online=False, cache: Optional[DiskCache] = None,
+                 use_offline=False):
         # Utiliser les variables d'environnement ou les valeurs par défaut
         self.api_url = api_url or os.getenv("LOCAL_API_URL", "http://localhost:1337/v1/chat/completions")
         self.model = model or os.getenv("LOCAL_MODEL", "mistral:7b")
         self.use_online = use_online
         
+        # Mode hors ligne: aucun appel au LLM, chatbots construits à partir de la structure du document
+        self.use_offline = use_offline
+        
+        # Cache des chatbots générés (optionnel, partagé entre les instances)
+        self.cache = cache
+        
+        # Découpage des documents trop longs pour la fenêtre de contexte du modèle
+        self.chunk_tokens = int(os.getenv("LLM_CHUNK_TOKENS", "3000"))
+        self.map_workers = int(os.getenv("LLM_MAP_WORKERS", "4"))
+        
+        # Requêtes doublées: si le backend principal n'a pas répondu après le percentile de latence
+        # observé (ou LLM_HEDGE_DELAY secondes tant qu'il y a trop peu de mesures), interroger aussi l'autre
+        self.hedge = os.getenv("LLM_HEDGE", "false").lower() in ("1", "true", "yes", "on")
+        self.hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+        self.hedge_delay = float(os.getenv("LLM_HEDGE_DELAY", "30"))
+        self.hedge_min_samples = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "5"))
+        
+        # Sortie structurée pour la génération des chatbots: response_format demandé aux backends
+        # (json_object, json_schema ou off), puis nouvelles tentatives ciblées pour les blocs manquants
+        self.response_format = os.getenv("LLM_RESPONSE_FORMAT", "json_object").lower()
+        self.repair_rounds = int(os.getenv("LLM_REPAIR_ROUNDS", "2"))
+        self.repair_max_blocks = int(os.getenv("LLM_REPAIR_MAX_BLOCKS", "10"))
+        
         # Configuration de l'API en ligne
         self.online_api_key = os.getenv("MISTRAL_API_KEY", "")
         self.online_api_url = os.getenv("MISTRAL_API_URL", "https://api.mistral.ai/v1/chat/completions")
         self.online_model = os.getenv("MISTRAL_MODEL", "codestral-latest")
+        
+        # Budget de tokens: fenêtre de contexte de chaque modèle (table de token_budget si non configurée),
+        # plafond de la réponse demandée et comptage des tokens (estimation ou tiktoken)
+        self.context_tokens = {"local": int(os.getenv("LOCAL_CONTEXT_TOKENS", "0")) or None,
+                               "online": int(os.getenv("MISTRAL_CONTEXT_TOKENS", "0")) or None}
+        self.max_completion_tokens = int(os.getenv("LLM_MAX_COMPLETION_TOKENS", "8192"))
+        if os.getenv("LLM_TOKENIZER", "estimate").lower() == "tiktoken":
+            use_tiktoken()
     
-    def _call_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> Optional[str]:
-        """Appelle l'API LLM locale et retourne la réponse"""
+    def _call_api(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                  json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None) -> Optional[str]:
+        """Appelle l'API LLM locale et retourne la réponse
+        
+        Avec json_schema, une sortie JSON structurée est demandée au backend (response_format).
+        max_tokens est la taille de réponse souhaitée (DEFAULT_COMPLETION_TOKENS par défaut),
+        réduite si nécessaire pour tenir dans la fenêtre de contexte du modèle.
+        """
+        if self.use_offline:
+            return None
+        if self.hedge:
+            return self._call_hedged(messages, temperature, json_schema, max_tokens)
         if self.use_online:
-            return self._call_online_api(messages, temperature)
+            return self._call_online_api(messages, temperature, json_schema, max_tokens)
+        if not backend_stats.allow("local"):
+            logger.info("LLM local indisponible (disjoncteur ouvert), appel direct à l'API en ligne")
+            return self._call_online_api(messages, temperature, json_schema, max_tokens)
         
         try:
-            payload = {
-                "model": self.model,
-                "messages": messages,
-                "temperature": temperature
-            }
+            url, headers, payload, limit = self._build_request("local", messages, temperature, json_schema, max_tokens)
             
-            response = requests.post(self.api_url, json=payload)
+            started = time.perf_counter()
+            response = get_session("local").post(url, headers=headers, json=payload, timeout=get_timeout("local"))
+            if self._rejects_response_format("local", response, payload):
+                response = get_session("local").post(url, headers=headers, json=payload, timeout=get_timeout("local"))
             response.raise_for_status()
             
             result = response.json()
-            return result["choices"][0]["message"]["content"]
+            content = result["choices"][0]["message"]["content"]
+            backend_stats.record_success("local", time.perf_counter() - started)
+            self._record_usage("local", payload["messages"], content, result.get("usage"), limit,
+                               time.perf_counter() - started)
+            return content
         except Exception as e:
             logger.error(f"Erreur lors de l'appel à l'API LLM locale: {str(e)}")
+            backend_stats.record_failure("local", str(e))
             # En cas d'erreur avec l'API locale, essayer l'API en ligne comme fallback
             if not self.use_online:
                 logger.info("Tentative de fallback vers l'API en ligne...")
-                return self._call_online_api(messages, temperature)
+                metrics.inc("chatmd_llm_fallbacks_total", kind="local_to_online")
+                return self._call_online_api(messages, temperature, json_schema, max_tokens)
             return None
     
-    def _call_online_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> Optional[str]:
+    def _call_online_api(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                         json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None) -> Optional[str]:
         """Appelle l'API Mistral en ligne et retourne la réponse"""
+        if not backend_stats.allow("online"):
+            logger.warning("API en ligne indisponible (disjoncteur ouvert)")
+            return None
+        
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.online_api_key}"
-            }
-            
-            payload = {
-                "model": self.online_model,
-                "messages": messages,
-                "temperature": temperature,
-                "max_tokens": 2000  # Valeur par défaut raisonnable
-            }
+            url, headers, payload, limit = self._build_request("online", messages, temperature, json_schema, max_tokens)
             
-            response = requests.post(self.online_api_url, headers=headers, json=payload, timeout=60)
+            started = time.perf_counter()
+            response = get_session("online").post(url, headers=headers, json=payload, timeout=get_timeout("online"))
+            if self._rejects_response_format("online", response, payload):
+                response = get_session("online").post(url, headers=headers, json=payload, timeout=get_timeout("online"))
             response.raise_for_status()
             
             result = response.json()
-            return result["choices"][0]["message"]["content"]
+            content = result["choices"][0]["message"]["content"]
+            backend_stats.record_success("online", time.perf_counter() - started)
+            self._record_usage("online", payload["messages"], content, result.get("usage"), limit,
+                               time.perf_counter() - started)
+            return content
         except Exception as e:
             logger.error(f"Erreur lors de l'appel à l'API Mistral en ligne: {str(e)}")
+            backend_stats.record_failure("online", str(e))
             return None
     
-    def generate_chatmd(self, content: str, params: Dict[str, Any]) -> Optional[str]:
-        """Génère un chatbot au format ChatMD à partir du contenu"""
-        doc_type = params.get("doc_type", "custom")
-        tone = params.get("tone", "conversational")
-        complexity = params.get("complexity", "intermediate")
-        max_depth = params.get("max_depth", 3)
-        choices_per_level = params.get("choices_per_level", 3)
+    def _call_hedged(self, messages: List[Dict[str, str]], temperature: float,
+                     json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None) -> Optional[str]:
+        """Appelle le backend principal puis, s'il tarde ou échoue, le second en parallèle
         
-        # Construction du prompt pour la génération JSON
-        system_prompt = self._get_json_system_prompt(doc_type, tone, complexity, max_depth, choices_per_level)
+        La première réponse non vide l'emporte; la requête perdante est annulée
+        (sa connexion est fermée par ce thread). Le gagnant et la durée de chaque backend
+        sont enregistrés dans backend_stats.
+        """
+        # Les backends dont le disjoncteur est ouvert ne sont pas interrogés
+        backends = [backend for backend in (("online", "local") if self.use_online else ("local", "online"))
+                    if backend_stats.allow(backend)]
+        if not backends:
+            logger.error("Aucun backend disponible (disjoncteurs ouverts)")
+            backend_stats.record_hedge(None, {}, False, [])
+            return None
+        primary = backends[0]
+        secondary = backends[1] if len(backends) > 1 else None
+        delay = backend_stats.latency_percentile(primary, self.hedge_percentile, self.hedge_min_samples)
+        if delay is None:
+            delay = self.hedge_delay
         
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Voici le document à transformer en chatbot:\n\n{content}"}
+        cancel_events = {backend: _Cancellation() for backend in backends}
+        started_at = {}
+        latencies = {}
+        winner = None
+        result = None
+        hedged = False
+        
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="llm-hedge")
+        
+        def launch(backend: str) -> None:
+            started_at[backend] = time.perf_counter()
+            pending[executor.submit(self._collect_backend, backend, messages, temperature, cancel_events[backend],
+                                    json_schema, max_tokens)] = backend
+        
+        pending = {}
+        try:
+            launch(primary)
+            while pending and winner is None:
+                done, _ = wait(pending, timeout=None if hedged or not secondary else delay, return_when=FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"Pas de réponse de {primary} après {delay:.1f}s, requête doublée vers {secondary}")
+                    hedged = True
+                    launch(secondary)
+                    continue
+                
+                for future in done:
+                    backend = pending.pop(future)
+                    text, latencies[backend] = future.result()
+                    if text and winner is None:
+                        winner, result = backend, text
+                    elif not text and not hedged and secondary:
+                        # Échec du principal avant le délai: interroger le second sans attendre
+                        hedged = True
+                        launch(secondary)
+        finally:
+            cancelled = []
+            for backend in pending.values():
+                cancel_events[backend].set()
+                latencies[backend] = time.perf_counter() - started_at[backend]
+                cancelled.append(backend)
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        latencies = {backend: round(seconds, 3) for backend, seconds in latencies.items()}
+        backend_stats.record_hedge(winner, latencies, hedged, cancelled)
+        if winner:
+            logger.info(f"Réponse de {winner} (latences: {latencies}, annulés: {cancelled})")
+        else:
+            logger.error(f"Aucun backend n'a répondu (latences: {latencies})")
+        return result
+    
+    def _collect_backend(self, backend: str, messages: List[Dict[str, str]], temperature: float,
+                         cancel: _Cancellation, json_schema: Optional[Dict[str, Any]] = None,
+                         max_tokens: Optional[int] = None) -> Tuple[Optional[str], float]:
+        """Lit la réponse complète d'un backend en streaming, en s'arrêtant dès que cancel est positionné"""
+        started = time.perf_counter()
+        fragments = []
+        try:
+            stream = self._stream_backend(backend, messages, temperature, json_schema, max_tokens, cancel)
+            try:
+                for fragment in stream:
+                    if cancel.is_set():
+                        logger.info(f"Requête vers {backend} annulée: l'autre backend a répondu")
+                        return None, time.perf_counter() - started
+                    fragments.append(fragment)
+            finally:
+                # Fermer le générateur ferme la connexion, ce qui interrompt la génération côté serveur
+                stream.close()
+        except Exception as e:
+            if cancel.is_set():
+                # Connexion coupée par le thread qui a annulé la requête
+                logger.info(f"Requête vers {backend} annulée: l'autre backend a répondu")
+            else:
+                logger.error(f"Erreur lors de l'appel au backend {backend}: {str(e)}")
+            return None, time.perf_counter() - started
+        
+        text = "".join(fragments)
+        return text or None, time.perf_counter() - started
+    
+    def _stream_api(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                    json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None) -> Iterator[str]:
+        """Appelle l'API LLM en mode streaming et produit les fragments de texte au fil de l'eau"""
+        if self.use_offline:
+            return
+        if not self.use_online and not backend_stats.allow("local"):
+            logger.info("LLM local indisponible (disjoncteur ouvert), appel direct à l'API en ligne")
+        elif not self.use_online:
+            started = False
+            try:
+                for chunk in self._stream_backend("local", messages, temperature, json_schema, max_tokens):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                logger.error(f"Erreur lors de l'appel en streaming à l'API LLM locale: {str(e)}")
+                # Impossible de basculer si des fragments ont déjà été envoyés au client
+                if started:
+                    raise
+                logger.info("Tentative de fallback vers l'API en ligne...")
+                metrics.inc("chatmd_llm_fallbacks_total", kind="local_to_online")
+        
+        if not backend_stats.allow("online"):
+            raise RuntimeError("API en ligne indisponible (disjoncteur ouvert)")
+        
+        try:
+            yield from self._stream_backend("online", messages, temperature, json_schema, max_tokens)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'appel en streaming à l'API Mistral en ligne: {str(e)}")
+            raise
+    
+    def _stream_backend(self, backend: str, messages: List[Dict[str, str]], temperature: float,
+                        json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None,
+                        cancel: Optional[_Cancellation] = None) -> Iterator[str]:
+        """Lit le flux SSE compatible OpenAI (stream: true) d'un backend et produit le texte des deltas
+        
+        Avec cancel, la réponse lui est confiée pour que l'appel puisse être annulé depuis un autre thread.
+        """
+        url, headers, payload, limit = self._build_request(backend, messages, temperature, json_schema, max_tokens,
+                                                           stream=True)
+        
+        # Un flux abandonné par le consommateur (GeneratorExit) n'est compté ni comme succès ni comme échec
+        started = time.perf_counter()
+        fragments = []
+        usage = None
+        try:
+            response = get_session(backend).post(url, headers=headers, json=payload, stream=True, timeout=get_timeout(backend))
+            if self._rejects_response_format(backend, response, payload):
+                response.close()
+                response = get_session(backend).post(url, headers=headers, json=payload, stream=True, timeout=get_timeout(backend))
+            if cancel is not None:
+                cancel.attach(response)
+            with response:
+                response.raise_for_status()
+                
+                for line in response.iter_lines():
+                    chunk = self._parse_stream_line(line.decode("utf-8"))
+                    if chunk is None:
+                        continue
+                    if chunk is _STREAM_DONE:
+                        break
+                    
+                    # Certains serveurs joignent le décompte des tokens au dernier fragment
+                    usage = chunk.get("usage") or usage
+                    choices = chunk.get("choices") or [{}]
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        fragments.append(content)
+                        yield content
+        except Exception as e:
+            # Une requête annulée n'est pas un échec du backend
+            if cancel is None or not cancel.is_set():
+                backend_stats.record_failure(backend, str(e))
+            raise
+        if cancel is not None and cancel.is_set():
+            return  # Flux coupé par l'annulation: ni succès ni échec
+        backend_stats.record_success(backend, time.perf_counter() - started)
+        self._record_usage(backend, payload["messages"], "".join(fragments), usage, limit, time.perf_counter() - started)
+    
+    def _build_request(self, backend: str, messages: List[Dict[str, str]], temperature: float,
+                       json_schema: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None,
+                       stream: bool = False) -> Tuple[str, Dict[str, str], Dict[str, Any], int]:
+        """Prépare un appel compatible OpenAI: (url, en-têtes, corps, max_tokens), messages ajustés à la fenêtre de contexte"""
+        messages, limit = self._fit_request(backend, messages, max_tokens)
+        headers = {"Content-Type": "application/json"}
+        if backend == "online":
+            url = self.online_api_url
+            headers["Authorization"] = f"Bearer {self.online_api_key}"
+        else:
+            url = self.api_url
+        payload = {
+            "model": self._model_for(backend),
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": limit
+        }
+        if stream:
+            payload["stream"] = True
+        self._add_response_format(backend, payload, json_schema)
+        return url, headers, payload, limit
+    
+    @staticmethod
+    def _parse_stream_line(line: str) -> Optional[Dict[str, Any]]:
+        """Décode une ligne d'un flux SSE: fragment JSON, _STREAM_DONE en fin de flux, None pour les autres lignes"""
+        line = line.strip()
+        if not line.startswith("data:"):
+            return None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return _STREAM_DONE
+        return json.loads(data)
+    
+    def _add_response_format(self, backend: str, payload: Dict[str, Any], json_schema: Optional[Dict[str, Any]]) -> None:
+        """Demande une sortie JSON structurée (response_format) si elle est activée et acceptée par le backend"""
+        if json_schema is None or self.response_format == "off" or backend in _RESPONSE_FORMAT_UNSUPPORTED:
+            return
+        if self.response_format == "json_schema":
+            payload["response_format"] = {"type": "json_schema",
+                                          "json_schema": {"name": "chatbot", "schema": json_schema}}
+        else:
+            payload["response_format"] = {"type": "json_object"}
+    
+    @staticmethod
+    def _rejects_response_format(backend: str, response, payload: Dict[str, Any]) -> bool:
+        """Détecte un refus de response_format (erreur 400/422): le paramètre est retiré et n'est plus envoyé à ce backend
+        
+        Seules les erreurs dont le message cite response_format ou json_schema
+        sont un refus du paramètre; les autres (prompt trop long, modèle
+        inconnu...) sont traitées comme des échecs ordinaires.
+        """
+        if "response_format" not in payload or response.status_code not in (400, 422):
+            return False
+        try:
+            body = response.text.lower()
+        except Exception:
+            body = ""
+        if "response_format" not in body and "json_schema" not in body:
+            return False
+        logger.warning(f"Le backend {backend} refuse response_format (code {response.status_code}), "
+                       f"sortie structurée désactivée pour ce backend")
+        _RESPONSE_FORMAT_UNSUPPORTED.add(backend)
+        del payload["response_format"]
+        return True
+    
+    def _model_for(self, backend: str) -> str:
+        return self.online_model if backend == "online" else self.model
+    
+    def _context_window(self, backend: str) -> int:
+        """Fenêtre de contexte du modèle d'un backend, en tokens"""
+        return context_window(self._model_for(backend), self.context_tokens.get(backend))
+    
+    def _fit_request(self, backend: str, messages: List[Dict[str, str]],
+                     max_tokens: Optional[int] = None) -> Tuple[List[Dict[str, str]], int]:
+        """Ajuste les messages et la taille de réponse (max_tokens) à la fenêtre de contexte du backend"""
+        wanted = min(max_tokens or DEFAULT_COMPLETION_TOKENS, self.max_completion_tokens)
+        return fit_messages(messages, self._model_for(backend), self._context_window(backend), wanted)
+    
+    def _chatbot_max_tokens(self, params: Dict[str, Any]) -> int:
+        """Taille de réponse d'une génération de chatbot, d'après la profondeur et le nombre de choix demandés"""
+        wanted = chatbot_completion_tokens(params.get("max_depth", 3), params.get("choices_per_level", 3))
+        return min(wanted, self.max_completion_tokens)
+    
+    def _record_usage(self, backend: str, messages: List[Dict[str, str]], text: str,
+                      usage: Optional[Dict[str, Any]] = None, max_tokens: Optional[int] = None,
+                      seconds: Optional[float] = None) -> None:
+        """Compte et journalise les tokens d'un appel: décompte du serveur s'il est fourni, estimation sinon"""
+        usage = usage or {}
+        model = self._model_for(backend)
+        prompt_tokens = usage.get("prompt_tokens") or count_message_tokens(messages, model)
+        completion_tokens = usage.get("completion_tokens") or count_tokens(text, model)
+        metrics.inc("chatmd_llm_tokens_total", prompt_tokens, backend=backend, kind="prompt")
+        metrics.inc("chatmd_llm_tokens_total", completion_tokens, backend=backend, kind="completion")
+        
+        window = self._context_window(backend)
+        usage_logger.info(json.dumps({
+            "backend": backend,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "max_tokens": max_tokens,
+            "context_window": window,
+            "context_used": round((prompt_tokens + completion_tokens) / window, 3),
+            "counted_by": "server" if usage.get("prompt_tokens") else "estimate",
+            "truncated": bool(max_tokens and completion_tokens >= max_tokens),
+            "seconds": round(seconds, 3) if seconds is not None else None,
+        }))
+    
+    def _condense_document(self, content: str, max_tokens: Optional[int] = None) -> str:
+        """Réduit un document trop long en plans résumés par morceaux (étape map du map-reduce)
+        
+        Le document est résumé s'il dépasse chunk_tokens, ou max_tokens si
+        cette limite (place disponible dans la fenêtre de contexte) est plus
+        petite.
+        """
+        budget = min(self.chunk_tokens, max_tokens) if max_tokens else self.chunk_tokens
+        # Plusieurs passes au maximum si les plans concaténés dépassent encore le budget
+        for _ in range(3):
+            if estimate_tokens(content) <= budget:
+                break
+            
+            chunks = split_into_chunks(content, budget)
+            logger.info(f"Document trop long ({estimate_tokens(content)} tokens estimés), découpage en {len(chunks)} morceaux")
+            
+            with ThreadPoolExecutor(max_workers=self._map_concurrency()) as executor:
+                outlines = list(executor.map(
+                    lambda item: self._outline_chunk(item[1], item[0], len(chunks)),
+                    enumerate(chunks, 1)
+                ))
+            
+            content = self._join_outlines(chunks, outlines, budget)
+        
+        return content
+    
+    def _map_concurrency(self) -> int:
+        """Appels simultanés de l'étape map: map_workers, sans dépasser la limite d'admission du backend
+        
+        Les appels de l'étape map partagent la place de la génération en cours:
+        plus d'appels simultanés que le backend n'en accepte le surchargeraient.
+        """
+        limit = admission.limit(self.mode)
+        return max(1, min(self.map_workers, limit) if limit else self.map_workers)
+    
+    @staticmethod
+    def _join_outlines(chunks: List[str], outlines: List[Optional[str]], budget: int) -> str:
+        """Assemble les plans des morceaux en un document condensé"""
+        # Sans réponse du LLM pour un morceau, conserver le début de son texte
+        fallback_chars = budget * CHARS_PER_TOKEN // len(chunks)
+        return "\n\n".join(
+            f"## Partie {i}\n{outline or chunk[:fallback_chars]}"
+            for i, (chunk, outline) in enumerate(zip(chunks, outlines), 1)
+        )
+    
+    def _outline_chunk(self, chunk: str, index: int, total: int) -> Optional[str]:
+        """Résume un morceau de document sous forme de plan structuré"""
+        return self._call_api(self._outline_messages(chunk, index, total), temperature=0.3)
+    
+    @staticmethod
+    def _outline_messages(chunk: str, index: int, total: int) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": "Tu es un assistant qui prépare des documents pour la création de chatbots. "
+                                          "Résume le passage fourni sous forme de plan structuré: les titres des thèmes abordés, "
+                                          "puis les points clés et les faits importants (noms, dates, chiffres, définitions). "
+                                          "Conserve la langue du document. Réponds uniquement par le plan, sans introduction."},
+            {"role": "user", "content": f"Passage {index}/{total} du document:\n\n{chunk}"}
         ]
+    
+    def _build_chatmd_messages(self, content: str, params: Dict[str, Any]) -> List[Dict[str, str]]:
+        """Construit les messages envoyés au LLM pour la génération d'un chatbot
+        
+        Le prompt système est précompilé par type de document et les consignes
+        propres aux paramètres suivent le document (voir chatmd_prompts): le
+        début de la requête reste identique d'un appel à l'autre et peut être
+        repris du cache de préfixe du serveur.
+        """
+        # Les documents trop longs sont d'abord résumés par morceaux, puis le chatbot est généré à partir des plans
+        with span("condense"):
+            condensed = self._condense_document(content, self._document_budget(params))
+        return self._chatmd_messages(content, condensed, params)
+    
+    @staticmethod
+    def _chatmd_messages(content: str, condensed: str, params: Dict[str, Any]) -> List[Dict[str, str]]:
+        if condensed is not content:
+            return build_chatmd_messages(f"{_OUTLINE_PROMPT}{condensed}", params)
+        return build_chatmd_messages(f"{_DOCUMENT_PROMPT}{content}", params)
+    
+    def _document_budget(self, params: Dict[str, Any]) -> int:
+        """Place du document dans la fenêtre de contexte, une fois les consignes et la réponse réservées
+        
+        La réponse ne peut pas occuper plus de la moitié de la fenêtre.
+        """
+        backend = "online" if self.use_online else "local"
+        budget = int(self._context_window(backend) * (1 - SAFETY_MARGIN))
+        prompt_tokens = count_message_tokens(build_chatmd_messages(_OUTLINE_PROMPT, params), self._model_for(backend))
+        return max(1, budget - prompt_tokens - min(self._chatbot_max_tokens(params), budget // 2))
+    
+    def _cache_key(self, content: str, params: Dict[str, Any]) -> str:
+        """Calcule la clé de cache d'une génération (document, paramètres, backend et modèle)"""
+        backend = "online" if self.use_online else "local"
+        model = self.online_model if self.use_online else self.model
+        generation_params = {
+            "doc_type": params.get("doc_type", "custom"),
+            "tone": params.get("tone", "conversational"),
+            "complexity": params.get("complexity", "intermediate"),
+            "max_depth": params.get("max_depth", 3),
+            "choices_per_level": params.get("choices_per_level", 3)
+        }
+        return make_key(hashlib.sha256(content.encode("utf-8")).hexdigest(), generation_params, backend, model)
+    
+    def _get_cached_chatmd(self, content: str, params: Dict[str, Any], use_cache: bool) -> Tuple[Optional[str], Optional[str]]:
+        """Retourne (clé de cache, chatbot en cache), la clé étant None si le cache n'est pas utilisé"""
+        if not self.cache or not use_cache:
+            return None, None
+        
+        cache_key = self._cache_key(content, params)
+        cached = self.cache.get(cache_key)
+        if cached:
+            logger.info(f"Chatbot trouvé dans le cache ({cache_key[:12]})")
+        return cache_key, cached
+    
+    @property
+    def mode(self) -> str:
+        """Backend utilisé pour la génération: offline, online ou local"""
+        if self.use_offline:
+            return "offline"
+        return "online" if self.use_online else "local"
+    
+    def _generate_offline(self, content: str, params: Dict[str, Any]) -> str:
+        """Génère un chatbot sans LLM, par extraction à partir de la structure du document"""
+        with span("offline_generation"):
+            return self._json_to_chatmd(build_extractive_chatbot(content, params))
+    
+    def generate_chatmd(self, content: str, params: Dict[str, Any], use_cache: bool = True,
+                        background: bool = False) -> Optional[str]:
+        """Génère un chatbot au format ChatMD à partir du contenu
+        
+        background: génération d'une tâche asynchrone ou d'un lot, qui attend sa
+        place dans la file du LLM sans le délai des requêtes interactives.
+        """
+        if self.use_offline:
+            return self._generate_offline(content, params)
+        
+        cache_key, cached = self._get_cached_chatmd(content, params, use_cache)
+        if cached:
+            return cached
+        
+        # Les demandes identiques simultanées (même document, mêmes paramètres) partagent une seule génération
+        return single_flight.do(self._cache_key(content, params), self._generate_chatmd, content, params, cache_key,
+                                background)
+    
+    def _generate_chatmd(self, content: str, params: Dict[str, Any], cache_key: Optional[str],
+                         background: bool = False) -> Optional[str]:
+        """Génère un chatbot avec le LLM et le met en cache sous cache_key (si fournie)"""
+        # Une place du backend est occupée pendant toute la génération (contrôle d'admission)
+        with admission.slot(self.mode, background):
+            return self._generate_admitted_chatmd(content, params, cache_key)
+    
+    def _generate_admitted_chatmd(self, content: str, params: Dict[str, Any], cache_key: Optional[str]) -> Optional[str]:
+        with span("prompt"):
+            messages = self._build_chatmd_messages(content, params)
         
         # Obtenir la réponse JSON du LLM
-        json_response = self._call_api(messages, temperature=0.7)
+        with span("llm"):
+            json_response = self._call_api(messages, temperature=0.7, json_schema=CHATBOT_SCHEMA,
+                                           max_tokens=self._chatbot_max_tokens(params))
         if not json_response:
-            logger.error("Aucune réponse reçue du LLM")
-            return None
+            # Mode dégradé, non mis en cache: le LLM pourra être utilisé dès son retour
+            logger.error("Aucune réponse reçue du LLM, génération extractive hors ligne")
+            metrics.inc("chatmd_llm_fallbacks_total", kind="llm_to_offline")
+            return self._generate_offline(content, params)
+        
+        with span("response_conversion"):
+            markdown = self._chatmd_from_response(json_response, content, params, messages)
+        if markdown and cache_key:
+            self.cache.set(cache_key, markdown)
+        return markdown
+    
+    def stream_chatmd(self, content: str, params: Dict[str, Any], use_cache: bool = True) -> Iterator[Tuple[str, str]]:
+        """Génère un chatbot en streaming: produit des couples ("token", fragment) puis ("result", markdown)
+        
+        Un couple ("response", titre) est produit dès qu'une entrée de
+        "responses" est complète dans le JSON généré. Si le flux est
+        interrompu, le chatbot est reconstruit à partir des entrées complètes
+        reçues (sans mise en cache).
+        """
+        if self.use_offline:
+            yield "result", self._generate_offline(content, params)
+            return
+        
+        cache_key, cached = self._get_cached_chatmd(content, params, use_cache)
+        if cached:
+            yield "result", cached
+            return
+        
+        with admission.slot(self.mode):
+            yield from self._stream_admitted_chatmd(content, params, cache_key)
+    
+    def _stream_admitted_chatmd(self, content: str, params: Dict[str, Any],
+                                cache_key: Optional[str]) -> Iterator[Tuple[str, str]]:
+        with span("prompt"):
+            messages = self._build_chatmd_messages(content, params)
+        
+        fragments = []
+        parser = StreamingChatbotParser()
+        interrupted = False
+        try:
+            # Inclut le temps d'envoi des fragments au client
+            with span("llm"):
+                for fragment in self._stream_api(messages, temperature=0.7, json_schema=CHATBOT_SCHEMA,
+                                                 max_tokens=self._chatbot_max_tokens(params)):
+                    fragments.append(fragment)
+                    yield "token", fragment
+                    for title, _ in parser.feed(fragment):
+                        yield "response", title
+        except Exception as e:
+            # Aucun backend disponible: mode dégradé; flux coupé: récupération des réponses complètes
+            if fragments:
+                logger.error(f"Flux interrompu après {len(parser.completed)} réponse(s) complète(s): {str(e)}")
+                interrupted = True
+        
+        json_response = "".join(fragments)
+        if not json_response:
+            logger.error("Aucune réponse reçue du LLM, génération extractive hors ligne")
+            metrics.inc("chatmd_llm_fallbacks_total", kind="llm_to_offline")
+            yield "result", self._generate_offline(content, params)
+            return
         
+        with span("response_conversion"):
+            markdown = self._chatmd_from_response(json_response, content, params, messages)
+        if markdown and cache_key and not interrupted:
+            self.cache.set(cache_key, markdown)
+        yield "result", markdown
+    
+    def _chatmd_from_response(self, json_response: str, content: str, params: Dict[str, Any],
+                              messages: Optional[List[Dict[str, str]]] = None) -> Optional[str]:
+        """Convertit la réponse JSON du LLM en ChatMD, avec repli sur la méthode directe
+        
+        La réponse est lue avec l'analyseur tolérant de json_repair: texte
+        autour du JSON, virgules finales, apostrophes et guillemets non
+        échappés sont corrigés et, si la réponse est tronquée, toutes les
+        entrées complètes de "responses" sont conservées. Avec les messages
+        de la génération, les blocs manquants ou invalides sont ensuite
+        redemandés au LLM (_complete_chatbot).
+        """
         logger.info(f"Réponse brute du LLM: {json_response[:100]}...")
         
-        # Plan B: Si le modèle ne génère pas de JSON valide, essayer avec un prompt direct pour Markdown
+        # Plan B: Si le modèle ne génère pas de JSON exploitable, générer directement le Markdown
         try:
-            # Extraire la partie JSON de la réponse (au cas où le modèle ajoute du texte avant/après)
-            json_start = json_response.find('{')
-            json_end = json_response.rfind('}') + 1
-            
-            if json_start == -1 or json_end == 0:
-                logger.warning("Impossible de trouver une structure JSON valide dans la réponse, passage au plan B")
+            chatbot_data = self._parse_chatbot_response(json_response)
+            if chatbot_data is None:
                 return self._generate_chatmd_direct(content, params)
             
-            json_str = json_response[json_start:json_end]
-            logger.info(f"JSON extrait: {json_str[:100]}...")
+            if messages:
+                chatbot_data = self._complete_chatbot(chatbot_data, messages)
             
-            try:
-                chatbot_data = json.loads(json_str)
-                
-                # Vérifier que la structure JSON est valide
-                if not isinstance(chatbot_data, dict) or 'title' not in chatbot_data or 'welcome_message' not in chatbot_data:
-                    logger.warning("Structure JSON invalide, passage au plan B")
-                    return self._generate_chatmd_direct(content, params)
-                
-                # Convertir la structure JSON en format ChatMD
+            # Convertir la structure JSON en format ChatMD
+            with span("json_to_chatmd"):
                 return self._json_to_chatmd(chatbot_data)
-            except json.JSONDecodeError as e:
-                logger.warning(f"Erreur de décodage JSON: {str(e)}, passage au plan B")
-                return self._generate_chatmd_direct(content, params)
         except Exception as e:
             logger.error(f"Erreur lors de la conversion JSON vers ChatMD: {str(e)}")
             # En cas d'erreur, essayer la méthode directe
             return self._generate_chatmd_direct(content, params)
     
+    @staticmethod
+    def _parse_chatbot_response(json_response: str) -> Optional[Dict[str, Any]]:
+        """Lit le chatbot dans la réponse du LLM (analyseur tolérant), ou None si aucune structure n'est exploitable"""
+        chatbot_data, parsed = salvage_chatbot(json_response)
+        if chatbot_data is None:
+            logger.warning("Impossible de trouver une structure JSON exploitable dans la réponse, passage au plan B")
+            return None
+        
+        for repair in sorted(parsed.repairs):
+            metrics.inc("chatmd_llm_json_repairs_total", repair=repair)
+        if parsed.repairs:
+            logger.warning(f"JSON réparé ({', '.join(sorted(parsed.repairs))}): "
+                           f"{len(chatbot_data['responses'])} réponse(s) conservée(s)")
+        return chatbot_data
+    
+    def _complete_chatbot(self, chatbot_data: Dict[str, Any], messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """Valide le chatbot contre CHATBOT_SCHEMA et redemande au LLM uniquement les blocs à corriger
+        
+        Les blocs ciblés sont les cibles de choix sans bloc correspondant et
+        les blocs non conformes au schéma (contenu vide, sans déclencheurs).
+        Chaque tentative (au plus repair_rounds) ne génère que ces blocs, au
+        plus repair_max_blocks à la fois, avec le même prompt système et le
+        même document: la sortie se limite aux blocs demandés.
+        """
+        for attempt in range(1, self.repair_rounds + 1):
+            wanted = self._repair_targets(chatbot_data, attempt)
+            if not wanted:
+                break
+            
+            with span("targeted_retry"):
+                response = self._call_api(self._build_repair_messages(chatbot_data, messages, wanted),
+                                          temperature=0.5, json_schema=RESPONSES_SCHEMA,
+                                          max_tokens=blocks_completion_tokens(len(wanted)))
+            if not self._apply_repair_blocks(chatbot_data, wanted, response):
+                break
+        
+        self._warn_incomplete(chatbot_data)
+        return chatbot_data
+    
+    def _repair_targets(self, chatbot_data: Dict[str, Any], attempt: int) -> List[str]:
+        """Blocs à redemander lors d'une tentative ciblée: cibles manquantes puis blocs invalides"""
+        validation = validate_chatbot(chatbot_data)
+        wanted = (validation["missing"] + validation["invalid"])[:self.repair_max_blocks]
+        if wanted:
+            logger.info(f"Tentative ciblée {attempt}/{self.repair_rounds}: {len(wanted)} bloc(s) à générer "
+                        f"({', '.join(wanted)})")
+        return wanted
+    
+    @staticmethod
+    def _apply_repair_blocks(chatbot_data: Dict[str, Any], wanted: List[str], response: Optional[str]) -> int:
+        """Ajoute au chatbot les blocs demandés présents dans la réponse et retourne leur nombre"""
+        blocks = (salvage_chatbot(response)[0] or {}).get("responses", {}) if response else {}
+        
+        # Seuls les blocs demandés sont retenus, identifiants comparés sans tenir compte de la casse
+        by_key = {response_id.strip().lower(): block for response_id, block in blocks.items()}
+        filled = 0
+        for response_id in wanted:
+            block = by_key.get(response_id.strip().lower())
+            if block and block["content"].strip() and block["triggers"]:
+                chatbot_data["responses"][response_id] = block
+                filled += 1
+        metrics.inc("chatmd_llm_block_retries_total", filled, result="filled")
+        metrics.inc("chatmd_llm_block_retries_total", len(wanted) - filled, result="unfilled")
+        return filled
+    
+    @staticmethod
+    def _warn_incomplete(chatbot_data: Dict[str, Any]) -> None:
+        validation = validate_chatbot(chatbot_data)
+        if validation["missing"] or validation["invalid"]:
+            logger.warning(f"Chatbot incomplet après les tentatives ciblées: cibles manquantes {validation['missing']}, "
+                           f"blocs invalides {validation['invalid']}")
+    
+    def _build_repair_messages(self, chatbot_data: Dict[str, Any], messages: List[Dict[str, str]],
+                               wanted: List[str]) -> List[Dict[str, str]]:
+        """Messages demandant uniquement les blocs listés, avec le prompt système et le document d'origine"""
+        # Les choix qui mènent à chaque bloc indiquent au LLM ce que l'utilisateur attend
+        origins: Dict[str, List[str]] = {response_id: [] for response_id in wanted}
+        sources = [(chatbot_data["title"], chatbot_data["welcome_choices"])]
+        sources += [(response_id, block["choices"]) for response_id, block in chatbot_data["responses"].items()]
+        for parent, choices in sources:
+            for choice in choices:
+                if choice["target"].strip() in origins:
+                    origins[choice["target"].strip()].append(f"choix « {choice['text']} » depuis « {parent} »")
+        
+        existing = [response_id for response_id in chatbot_data["responses"] if response_id not in origins]
+        wanted_lines = "\n".join(f"- {response_id}" + (f" ({'; '.join(origins[response_id])})" if origins[response_id] else "")
+                                 for response_id in wanted)
+        instructions = (
+            "Le chatbot généré à partir de ce document est incomplet.\n"
+            f"Blocs de réponse déjà rédigés (ne pas les réécrire): {json.dumps(existing, ensure_ascii=False)}\n\n"
+            f"Rédige UNIQUEMENT les blocs de réponse suivants, avec exactement ces identifiants:\n{wanted_lines}\n\n"
+            'Réponds uniquement par un objet JSON de la forme {"responses": {"Identifiant": {"triggers": ["..."], '
+            '"content": "...", "choices": [{"text": "...", "target": "..."}]}}}. '
+            "Les choix doivent mener à des blocs déjà rédigés ou à des blocs de cette liste."
+        )
+        # Un seul message utilisateur: certains modèles exigent l'alternance des rôles
+        return [messages[0], {"role": "user", "content": f"{messages[-1]['content']}\n\n{instructions}"}]
+    
     def _generate_chatmd_direct(self, content: str, params: Dict[str, Any]) -> Optional[str]:
         """Méthode de secours: génère directement un chatbot au format ChatMD en extrayant des informations du document"""
+        metrics.inc("chatmd_llm_fallbacks_total", kind="invalid_json")
         doc_type = params.get("doc_type", "custom")
-        tone = params.get("tone", "conversational")
-        complexity = params.get("complexity", "intermediate")
-        max_depth = params.get("max_depth", 3)
-        choices_per_level = params.get("choices_per_level", 3)
         
         logger.info("Extraction d'informations pertinentes du document")
         
         # En-tête YAML
         yaml_header = "---\ngestionGrosMots: true\ntitresRéponses: [\"## \"]\n---\n\n"
         
-        # Analyser le contenu pour extraire des informations
-        lines = content.split('\n')
-        paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
-        
-        # Nettoyer le contenu
-        clean_content = content.replace('\r', ' ').replace('\t', ' ')
-        while '  ' in clean_content:  # Supprimer les espaces multiples
-            clean_content = clean_content.replace('  ', ' ')
-        
-        # Extraire et nettoyer le titre (première ligne non vide)
-        title = "Chatbot"
-        for line in lines:
-            if line.strip():
-                # Nettoyer le titre en supprimant les espaces supplémentaires
-                title = ' '.join(line.strip().split())
-                break
+        # Analyser le contenu en une seule passe: titre, sections candidates, paragraphes
+        analysis = DocumentAnalysis(content)
+        title = analysis.title
+        paragraphs = analysis.paragraphs
         
-        # Identifier les sections potentielles
-        potential_sections = []
-        
-        # 1. Chercher les lignes qui se terminent par ":" et qui sont courtes (probablement des titres de section)
-        for line in lines:
-            line = line.strip()
-            if line.endswith(':') and len(line) < 50:
-                section_name = line.rstrip(':').strip()
-                # Nettoyer le nom de la section
-                section_name = ' '.join(section_name.split())
-                if section_name and len(section_name.split()) <= 5:  # Limiter à 5 mots maximum
-                    potential_sections.append(section_name)
-        
-        # 2. Chercher les lignes en majuscules (souvent des titres de section)
-        for line in lines:
-            line = line.strip()
-            if line.isupper() and len(line) < 50:
-                section_name = line.strip()
-                # Nettoyer le nom de la section
-                section_name = ' '.join(section_name.split())
-                if section_name and len(section_name.split()) <= 5:  # Limiter à 5 mots maximum
-                    potential_sections.append(section_name)
-        
-        # 3. Chercher les lignes qui commencent par des mots-clés typiques de sections
-        section_keywords = ["produits", "services", "histoire", "à propos", "contact", "équipe", 
-                           "mission", "valeurs", "tarifs", "prix", "promotions", "offres"]
-        for line in lines:
-            line = line.strip()
-            if any(line.lower().startswith(keyword) for keyword in section_keywords):
-                section_name = line.strip()
-                # Nettoyer le nom de la section
-                section_name = ' '.join(section_name.split())
-                if section_name and len(section_name.split()) <= 5:  # Limiter à 5 mots maximum
-                    potential_sections.append(section_name)
-        
-        # Filtrer les sections pour éviter les doublons et les sections trop longues
-        filtered_sections = []
-        for section in potential_sections:
-            # Vérifier si la section est déjà dans la liste (ignorer la casse)
-            if not any(section.lower() == s.lower() for s in filtered_sections):
-                # Vérifier si la section n'est pas trop longue
-                if len(section) <= 30:
-                    filtered_sections.append(section)
-        
-        # Si pas assez de sections trouvées, créer des sections par défaut selon le type de document
-        if len(filtered_sections) < 3:
+        # Si pas assez de sections trouvées, ajouter des sections par défaut selon le type de document
+        if len(analysis.sections) < 3:
             if doc_type == "company":
                 default_sections = ["Produits et Services", "Notre Histoire", "Contactez-nous"]
             elif doc_type == "biography":
@@ -215,40 +857,29 @@ class LLMService:
             else:
                 default_sections = ["À propos", "Informations", "Contact"]
             
-            # Ajouter les sections par défaut qui ne sont pas déjà présentes
             for section in default_sections:
-                if not any(section.lower() == s.lower() for s in filtered_sections):
-                    filtered_sections.append(section)
+                analysis.add_section(section)
         
         # Limiter à 3 sections principales
-        sections = filtered_sections[:3]
+        sections = analysis.sections[:3]
         
-        # Extraire des paragraphes pertinents pour chaque section
+        # Un paragraphe par section: le premier non utilisé contenant un mot-clé de la section
         section_content = {}
-        remaining_paragraphs = paragraphs.copy()
-        
-        # Essayer de trouver du contenu pertinent pour chaque section
+        used = set()
         for section in sections:
+            index = analysis.find_paragraph(section_keywords(section), used)
             section_content[section] = []
-            keywords = [word.lower() for word in section.split() if len(word) > 3]  # Ignorer les mots courts
-            
-            # Chercher des paragraphes contenant des mots-clés de la section
-            for paragraph in remaining_paragraphs[:]:
-                if any(keyword in paragraph.lower() for keyword in keywords):
-                    # Nettoyer le paragraphe
-                    clean_paragraph = ' '.join(paragraph.split())
-                    section_content[section].append(clean_paragraph)
-                    remaining_paragraphs.remove(paragraph)
-                    if len(section_content[section]) >= 1:  # Limiter à 1 paragraphe par section
-                        break
+            if index is not None:
+                used.add(index)
+                section_content[section].append(' '.join(paragraphs[index].split()))
         
         # Distribuer les paragraphes restants si certaines sections sont vides
         for section in sections:
-            if not section_content[section] and remaining_paragraphs:
-                # Nettoyer le paragraphe
-                clean_paragraph = ' '.join(remaining_paragraphs[0].split())
-                section_content[section].append(clean_paragraph)
-                remaining_paragraphs.pop(0)
+            if not section_content[section]:
+                index = analysis.first_unused_paragraph(used)
+                if index is not None:
+                    used.add(index)
+                    section_content[section].append(' '.join(paragraphs[index].split()))
         
         # Créer des sous-sections pertinentes pour chaque section principale
         subsections = {}
@@ -256,15 +887,15 @@ class LLMService:
         # Fonction pour extraire des sous-sections potentielles du contenu
         def extract_subsections(content_text, section_name):
             subsection_candidates = []
+            keywords = section_keywords(section_name)
             
             # Chercher des phrases qui pourraient être des sous-sections
-            sentences = content_text.split('.')
-            for sentence in sentences:
+            for sentence in content_text.split('.'):
                 sentence = sentence.strip()
-                if len(sentence) > 10 and len(sentence) < 40 and sentence[0].isupper():
+                if 10 < len(sentence) < 40 and sentence[0].isupper():
                     # Vérifier si la phrase contient des mots-clés de la section
-                    section_keywords = [word.lower() for word in section_name.split() if len(word) > 3]
-                    if any(keyword in sentence.lower() for keyword in section_keywords):
+                    lowered = sentence.lower()
+                    if any(keyword in lowered for keyword in keywords):
                         subsection_candidates.append(sentence)
             
             return subsection_candidates
@@ -280,12 +911,13 @@ class LLMService:
                 subsections[section] = extracted_subsections[:3]
             else:
                 # Sinon, utiliser des sous-sections par défaut selon le type de document et la section
+                lowered = section.lower()
                 if doc_type == "company":
-                    if "produit" in section.lower() or "service" in section.lower():
+                    if "produit" in lowered or "service" in lowered:
                         subsections[section] = ["Nos produits phares", "Services spéciaux", "Garanties et SAV"]
-                    elif "histoire" in section.lower() or "propos" in section.lower():
+                    elif "histoire" in lowered or "propos" in lowered:
                         subsections[section] = ["Notre fondation", "Évolution de l'entreprise", "Valeurs et mission"]
-                    elif "contact" in section.lower() or "trouver" in section.lower():
+                    elif "contact" in lowered or "trouver" in lowered:
                         subsections[section] = ["Coordonnées", "Horaires d'ouverture", "Service client"]
                     else:
                         subsections[section] = ["Informations principales", "Détails supplémentaires", "Foire aux questions"]
@@ -305,84 +937,68 @@ class LLMService:
         else:
             welcome_message = f"Bienvenue dans ce chatbot interactif sur {title}."
         
-        # Extraire un paragraphe d'introduction si disponible
-        if paragraphs:
-            # Chercher un paragraphe court qui pourrait servir d'introduction
-            for paragraph in paragraphs:
-                if 50 < len(paragraph) < 300:  # Paragraphe de taille raisonnable
-                    # Nettoyer le paragraphe
-                    welcome_message = ' '.join(paragraph.split())
-                    break
+        # Utiliser un paragraphe d'introduction si disponible
+        welcome_message = analysis.intro_paragraph() or welcome_message
         
         # Construire le chatbot
-        chatmd = f"{yaml_header}# {title}\n{welcome_message}\n\n"
+        parts = [f"{yaml_header}# {title}\n{welcome_message}\n\n"]
         
         # Ajouter les choix principaux
-        for i, section in enumerate(sections, 1):
-            chatmd += f"{i}. [{section}]({section})\n"
-        chatmd += "\n"
+        main_choices = "".join(f"{i}. [{section}]({section})\n" for i, section in enumerate(sections, 1)) + "\n"
+        parts.append(main_choices)
         
         # Ajouter les sections principales
         for section in sections:
-            chatmd += f"## {section}\n"
+            parts.append(f"## {section}\n")
             
-            # Ajouter des déclencheurs pertinents (limités à 3 maximum)
-            keywords = [word.lower() for word in section.split() if len(word) > 3][:3]  # Prendre les 3 premiers mots significatifs
-            for keyword in keywords:
-                chatmd += f"- {keyword}\n"
+            # Ajouter des déclencheurs pertinents (les 3 premiers mots significatifs)
+            for keyword in section_keywords(section)[:3]:
+                parts.append(f"- {keyword}\n")
             
             # Ajouter le contenu de la section
             if section_content[section]:
-                chatmd += section_content[section][0] + "\n\n"
+                parts.append(section_content[section][0] + "\n\n")
             else:
-                chatmd += f"Informations sur {section}.\n\n"
+                parts.append(f"Informations sur {section}.\n\n")
             
             # Ajouter les sous-sections comme choix
             for i, subsection in enumerate(subsections[section], 1):
-                chatmd += f"{i}. [{subsection}]({subsection})\n"
-            chatmd += "\n"
+                parts.append(f"{i}. [{subsection}]({subsection})\n")
+            parts.append("\n")
         
         # Ajouter les sous-sections
         for section in sections:
             for subsection in subsections[section]:
-                chatmd += f"## {subsection}\n"
+                parts.append(f"## {subsection}\n")
                 
-                # Ajouter des déclencheurs (limités à 2)
-                keywords = [word.lower() for word in subsection.split() if len(word) > 3][:2]  # Prendre les 2 premiers mots significatifs
+                # Ajouter des déclencheurs (les 2 premiers mots significatifs)
+                keywords = section_keywords(subsection)[:2]
                 for keyword in keywords:
-                    chatmd += f"- {keyword}\n"
+                    parts.append(f"- {keyword}\n")
                 
                 # Chercher du contenu pertinent pour cette sous-section
                 subsection_content = "Informations détaillées sur ce sujet."
-                for paragraph in paragraphs:
-                    if any(keyword in paragraph.lower() for keyword in keywords):
-                        # Nettoyer et limiter la longueur du paragraphe
-                        clean_paragraph = ' '.join(paragraph.split())
-                        if len(clean_paragraph) > 300:
-                            clean_paragraph = clean_paragraph[:300] + "..."
-                        subsection_content = clean_paragraph
-                        break
+                index = analysis.find_paragraph(keywords)
+                if index is not None:
+                    # Nettoyer et limiter la longueur du paragraphe
+                    clean_paragraph = ' '.join(paragraphs[index].split())
+                    if len(clean_paragraph) > 300:
+                        clean_paragraph = clean_paragraph[:300] + "..."
+                    subsection_content = clean_paragraph
                 
-                chatmd += subsection_content + "\n\n"
+                parts.append(subsection_content + "\n\n")
                 
                 # Ajouter un choix pour revenir à la section parente
-                chatmd += f"1. [Retour à {section}]({section})\n\n"
+                parts.append(f"1. [Retour à {section}]({section})\n\n")
         
         # Ajouter une section de retour à l'accueil
-        chatmd += "## Retour à l'accueil\n"
-        chatmd += "- retour\n"
-        chatmd += "- accueil\n"
-        chatmd += "Retour à la page d'accueil.\n\n"
+        parts.append("## Retour à l'accueil\n- retour\n- accueil\nRetour à la page d'accueil.\n\n")
+        parts.append(main_choices)
         
-        # Ajouter les choix principaux
-        for i, section in enumerate(sections, 1):
-            chatmd += f"{i}. [{section}]({section})\n"
-        chatmd += "\n"
-        
-        return chatmd
+        return "".join(parts)
     
-    def suggest_improvements(self, current_markdown: str, section: str = None) -> Optional[str]:
-        """Suggère des améliorations pour le markdown actuel"""
+    def _build_suggestion_messages(self, current_markdown: str, section: str = None) -> List[Dict[str, str]]:
+        """Construit les messages envoyés au LLM pour les suggestions d'amélioration"""
         system_prompt = """Tu es un assistant spécialisé dans la création de chatbots au format ChatMD.
         Analyse le contenu fourni et suggère des améliorations pour le rendre plus engageant,
         informatif et interactif. Concentre-toi sur la structure, les choix proposés,
@@ -392,12 +1008,22 @@ class LLMService:
         if section:
             user_prompt += f"\n\nJe souhaite améliorer spécifiquement la section: {section}"
         
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ]
-        
-        return self._call_api(messages, temperature=0.8)
+    
+    def suggest_improvements(self, current_markdown: str, section: str = None) -> Optional[str]:
+        """Suggère des améliorations pour le markdown actuel"""
+        messages = self._build_suggestion_messages(current_markdown, section)
+        with admission.slot(self.mode):
+            return self._call_api(messages, temperature=0.8)
+    
+    def stream_suggestions(self, current_markdown: str, section: str = None) -> Iterator[str]:
+        """Suggère des améliorations en produisant le texte au fil de la génération"""
+        messages = self._build_suggestion_messages(current_markdown, section)
+        with admission.slot(self.mode):
+            yield from self._stream_api(messages, temperature=0.8)
     
     def _json_to_chatmd(self, chatbot_data: Dict[str, Any]) -> str:
         """Convertit une structure JSON en format ChatMD"""
@@ -438,291 +1064,3 @@ class LLMService:
         
         # Assembler le document ChatMD complet
         return yaml_header + welcome_block + response_blocks
-    
-    def _get_json_system_prompt(self, doc_type: str, tone: str, complexity: str, max_depth: int, choices_per_level: int) -> str:
-        """Retourne le prompt système pour la génération JSON selon les paramètres"""
-        base_prompt = f"""Tu es un expert en création de chatbots interactifs. Ta tâche est de transformer le document fourni en une structure JSON qui sera ensuite convertie en chatbot interactif.
-
-IMPORTANT: Tu dois ABSOLUMENT générer une structure JSON valide et bien formée selon le schéma ci-dessous. Ne fais PAS une simple analyse de texte.
-
-Schéma JSON requis:
-```json
-{{
-  "title": "Titre du chatbot basé sur le document",
-  "welcome_message": "Message d'accueil qui présente le sujet principal du document",
-  "welcome_choices": [
-    {{
-      "text": "Premier choix",
-      "target": "Réponse 1"
-    }},
-    {{
-      "text": "Deuxième choix",
-      "target": "Réponse 2"
-    }},
-    {{
-      "text": "Troisième choix",
-      "target": "Réponse 3"
-    }}
-  ],
-  "responses": {{
-    "Réponse 1": {{
-      "triggers": ["déclencheur 1", "déclencheur 2"],
-      "content": "Contenu détaillé sur le premier aspect du document",
-      "choices": [
-        {{
-          "text": "Sous-option 1.1",
-          "target": "Sous-réponse 1.1"
-        }},
-        {{
-          "text": "Sous-option 1.2",
-          "target": "Sous-réponse 1.2"
-        }}
-      ]
-    }},
-    "Réponse 2": {{
-      "triggers": ["déclencheur 1", "déclencheur 2"],
-      "content": "Contenu détaillé sur le deuxième aspect du document",
-      "choices": [
-        {{
-          "text": "Sous-option 2.1",
-          "target": "Sous-réponse 2.1"
-        }},
-        {{
-          "text": "Sous-option 2.2",
-          "target": "Sous-réponse 2.2"
-        }}
-      ]
-    }},
-    "Réponse 3": {{
-      "triggers": ["déclencheur 1", "déclencheur 2"],
-      "content": "Contenu détaillé sur le troisième aspect du document",
-      "choices": [
-        {{
-          "text": "Sous-option 3.1",
-          "target": "Sous-réponse 3.1"
-        }},
-        {{
-          "text": "Sous-option 3.2",
-          "target": "Sous-réponse 3.2"
-        }}
-      ]
-    }},
-    "Sous-réponse 1.1": {{
-      "triggers": ["déclencheur spécifique"],
-      "content": "Contenu détaillé sur cet aspect spécifique",
-      "choices": [
-        {{
-          "text": "Option pour continuer",
-          "target": "Autre réponse"
-        }},
-        {{
-          "text": "Revenir en arrière",
-          "target": "Réponse 1"
-        }}
-      ]
-    }},
-    "Sous-réponse 1.2": {{
-      "triggers": ["déclencheur spécifique"],
-      "content": "Contenu détaillé sur cet aspect spécifique",
-      "choices": [
-        {{
-          "text": "Option pour continuer",
-          "target": "Autre réponse"
-        }},
-        {{
-          "text": "Revenir en arrière",
-          "target": "Réponse 1"
-        }}
-      ]
-    }}
-    // Et ainsi de suite pour toutes les sous-réponses...
-  }}
-}}
-```
-
-Directives OBLIGATOIRES:
-- Ton: {tone}
-- Niveau de complexité: {complexity}
-- Profondeur maximale: {max_depth} niveaux (pas plus!)
-- Nombre de choix par niveau: exactement {choices_per_level} options
-- Inclure 2-3 déclencheurs pertinents pour chaque bloc de réponse
-- Créer une structure cohérente et logique basée sur le contenu du document
-- Assurer que TOUS les liens entre les blocs fonctionnent correctement (chaque "target" doit correspondre à une clé existante dans "responses")
-- Générer un JSON valide et bien formé, sans erreurs de syntaxe
-        """
-        
-        # Ajout de directives spécifiques selon le type de document
-        if doc_type == "company":
-            base_prompt += """
-STRUCTURE SPÉCIFIQUE POUR UNE DESCRIPTION D'ENTREPRISE:
-
-# [Nom de l'entreprise]
-Bienvenue dans le chatbot de [Nom de l'entreprise]! Découvrez notre entreprise, nos produits et services, et comment nous pouvons répondre à vos besoins.
-
-1. [Produits et Services](Produits et Services)
-2. [Notre Histoire](Notre Histoire)
-3. [Contactez-nous](Contactez-nous)
-
-## Produits et Services
-- produits
-- services
-- offres
-Découvrez notre gamme complète de produits et services:
-
-1. [Produit/Service Phare](Produit/Service Phare)
-2. [Autres Offres](Autres Offres)
-3. [Tarifs et Disponibilité](Tarifs et Disponibilité)
-
-## Notre Histoire
-- histoire
-- fondation
-- évolution
-[Nom de l'entreprise] a été fondée en [année] par [fondateur]. Voici notre parcours:
-
-1. [Débuts et Vision](Débuts et Vision)
-2. [Croissance et Développement](Croissance et Développement)
-3. [Notre Mission et Nos Valeurs](Notre Mission et Nos Valeurs)
-
-## Contactez-nous
-- contact
-- adresse
-- téléphone
-Vous souhaitez nous contacter? Voici toutes les informations nécessaires:
-
-1. [Nos Bureaux et Points de Vente](Nos Bureaux et Points de Vente)
-2. [Service Client](Service Client)
-3. [Opportunités de Carrière](Opportunités de Carrière)
-
-[Et continuer avec toutes les sous-sections...]
-"""
-        elif doc_type == "biography":
-            base_prompt += """
-STRUCTURE SPÉCIFIQUE POUR UNE BIOGRAPHIE:
-
-# [Nom de la Personne]
-Découvrez la vie et l'œuvre de [Nom de la Personne], [brève description de sa notoriété ou de son domaine].
-
-1. [Jeunesse et Formation](Jeunesse et Formation)
-2. [Carrière et Réalisations](Carrière et Réalisations)
-3. [Vie Personnelle](Vie Personnelle)
-
-## Jeunesse et Formation
-- enfance
-- éducation
-- formation
-[Nom] est né(e) le [date] à [lieu]. Voici les moments clés de sa jeunesse:
-
-1. [Origines Familiales](Origines Familiales)
-2. [Éducation et Influences](Éducation et Influences)
-3. [Premiers Pas](Premiers Pas)
-
-## Carrière et Réalisations
-- carrière
-- travail
-- accomplissements
-Découvrez le parcours professionnel remarquable de [Nom]:
-
-1. [Débuts Professionnels](Débuts Professionnels)
-2. [Principales Œuvres/Réalisations](Principales Œuvres/Réalisations)
-3. [Reconnaissance et Prix](Reconnaissance et Prix)
-
-## Vie Personnelle
-- famille
-- loisirs
-- vie privée
-En dehors de sa carrière, [Nom] a mené une vie personnelle riche:
-
-1. [Famille et Relations](Famille et Relations)
-2. [Passions et Intérêts](Passions et Intérêts)
-3. [Philosophie et Valeurs](Philosophie et Valeurs)
-
-[Et continuer avec toutes les sous-sections...]
-"""
-        elif doc_type == "course":
-            base_prompt += """
-STRUCTURE SPÉCIFIQUE POUR UN COURS:
-
-# [Titre du Cours]
-Bienvenue dans ce cours sur [Sujet]. Vous allez découvrir les concepts fondamentaux et développer vos compétences dans ce domaine.
-
-1. [Introduction et Concepts de Base](Introduction et Concepts de Base)
-2. [Modules Principaux](Modules Principaux)
-3. [Exercices Pratiques](Exercices Pratiques)
-
-## Introduction et Concepts de Base
-- introduction
-- concepts
-- fondamentaux
-Commençons par comprendre les bases essentielles de [Sujet]:
-
-1. [Définitions Clés](Définitions Clés)
-2. [Contexte Historique](Contexte Historique)
-3. [Pourquoi Étudier Ce Sujet](Pourquoi Étudier Ce Sujet)
-
-## Modules Principaux
-- modules
-- chapitres
-- leçons
-Le cours est divisé en plusieurs modules thématiques:
-
-1. [Module 1: Titre](Module 1)
-2. [Module 2: Titre](Module 2)
-3. [Module 3: Titre](Module 3)
-
-## Exercices Pratiques
-- exercices
-- pratique
-- applications
-Mettez en pratique vos connaissances avec ces exercices:
-
-1. [Exercices de Niveau Débutant](Exercices Débutant)
-2. [Exercices de Niveau Intermédiaire](Exercices Intermédiaire)
-3. [Projets Pratiques](Projets Pratiques)
-
-[Et continuer avec toutes les sous-sections, incluant des quiz à la fin de chaque module...]
-"""
-        elif doc_type == "product":
-            base_prompt += """
-STRUCTURE SPÉCIFIQUE POUR UNE DESCRIPTION DE PRODUIT:
-
-# [Nom du Produit]
-Découvrez [Nom du Produit], [brève description du produit et de sa valeur principale].
-
-1. [Caractéristiques et Avantages](Caractéristiques et Avantages)
-2. [Utilisation et Applications](Utilisation et Applications)
-3. [Prix et Disponibilité](Prix et Disponibilité)
-
-## Caractéristiques et Avantages
-- caractéristiques
-- spécifications
-- avantages
-Voici ce qui rend [Nom du Produit] unique:
-
-1. [Caractéristiques Techniques](Caractéristiques Techniques)
-2. [Avantages Principaux](Avantages Principaux)
-3. [Comparaison avec d'Autres Produits](Comparaison)
-
-## Utilisation et Applications
-- utilisation
-- mode d'emploi
-- applications
-Comment tirer le meilleur parti de [Nom du Produit]:
-
-1. [Guide de Démarrage Rapide](Guide de Démarrage)
-2. [Cas d'Utilisation Courants](Cas d'Utilisation)
-3. [Conseils et Astuces](Conseils et Astuces)
-
-## Prix et Disponibilité
-- prix
-- achat
-- disponibilité
-Informations sur l'achat de [Nom du Produit]:
-
-1. [Options d'Achat](Options d'Achat)
-2. [Garantie et Support](Garantie et Support)
-3. [Produits Complémentaires](Produits Complémentaires)
-
-[Et continuer avec toutes les sous-sections...]
-"""
-        
-        return base_prompt
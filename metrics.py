@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: les fichiers des processus arrêtés ne sont pas regroupés
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+INF = float("inf")
+
+# Mesures cumulées des processus arrêtés, et verrou qui protège leur regroupement
+ARCHIVE_FILENAME = "metrics-archive.json"
+ARCHIVE_LOCK_FILENAME = "archive.lock"
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, INF)
+DOCUMENT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, INF)
+LLM_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, INF)
+
+# Métriques exposées: nom -> (type, description, classes de l'histogramme)
+METRICS = {
+    "chatmd_http_request_duration_seconds": (
+        "histogram", "Durée de traitement des requêtes HTTP par route", HTTP_BUCKETS),
+    "chatmd_document_processing_seconds": (
+        "histogram", "Durée d'extraction du texte des documents par format", DOCUMENT_BUCKETS),
+    "chatmd_llm_request_duration_seconds": (
+        "histogram", "Durée des appels réussis au LLM par backend", LLM_BUCKETS),
+    "chatmd_llm_errors_total": (
+        "counter", "Appels au LLM en échec par backend", None),
+    "chatmd_llm_tokens_total": (
+        "counter", "Tokens envoyés (prompt) et reçus (completion) par backend", None),
+    "chatmd_llm_fallbacks_total": (
+        "counter", "Replis de génération (local vers en ligne, LLM vers hors ligne, JSON invalide)", None),
+    "chatmd_llm_json_repairs_total": (
+        "counter", "Défauts corrigés dans le JSON généré par le LLM, par type", None),
+    "chatmd_llm_block_retries_total": (
+        "counter", "Blocs de réponse redemandés au LLM lors des tentatives ciblées (filled ou unfilled)", None),
+    "chatmd_cache_requests_total": (
+        "counter", "Consultations des caches sur disque (hit ou miss)", None),
+    "chatmd_generation_coalesced_total": (
+        "counter", "Générations rattachées à une génération identique en cours (thread, task ou process)", None),
+    "chatmd_llm_admissions_total": (
+        "counter", "Demandes admises ou refusées par le contrôle d'admission, par backend (admitted, rejected, timeout)", None),
+    "chatmd_llm_queue_wait_seconds": (
+        "histogram", "Attente d'une place dans la file du contrôle d'admission, par backend", HTTP_BUCKETS),
+    "chatmd_rate_limited_total": (
+        "counter", "Demandes refusées par la limite de débit par client", None),
+}
+
+
+def _label_key(labels: Dict[str, Any]) -> str:
+    return json.dumps(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(pairs, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(pairs) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == INF else repr(float(bound))
+
+
+def _merge(counters: Dict[str, Dict[str, float]], histograms: Dict[str, Dict[str, Dict[str, Any]]],
+           data: Dict[str, Any]) -> None:
+    """Ajoute les mesures d'un fichier aux totaux"""
+    for name, series in data.get("counters", {}).items():
+        totals = counters.setdefault(name, {})
+        for key, value in series.items():
+            totals[key] = totals.get(key, 0) + value
+
+    for name, series in data.get("histograms", {}).items():
+        totals = histograms.setdefault(name, {})
+        for key, histogram in series.items():
+            total = totals.get(key)
+            if total is None:
+                totals[key] = {"buckets": list(histogram["buckets"]), "sum": histogram["sum"],
+                               "count": histogram["count"]}
+                continue
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+
+
+class MetricsRegistry:
+    """Compteurs et histogrammes au format Prometheus, agrégés entre les workers gunicorn
+
+    Chaque processus accumule ses mesures en mémoire et les écrit
+    régulièrement dans un fichier qui lui est propre (metrics-<id>.json,
+    id unique même si le système réutilise un pid) du répertoire partagé;
+    /metrics additionne les fichiers de tous les processus. Tant qu'il
+    vit, le processus détient un verrou fcntl.flock sur metrics-<id>.lock:
+    un verrou libre désigne un processus arrêté, dont les mesures sont
+    ajoutées à metrics-archive.json puis supprimées, pour que les
+    compteurs ne diminuent pas sans que les fichiers s'accumulent.
+    """
+
+    def __init__(self, metrics_dir: Optional[str] = None, flush_interval: float = 1.0):
+        self.metrics_dir = metrics_dir or os.path.join(tempfile.gettempdir(), "chatmd_metrics")
+        self.flush_interval = flush_interval
+        self._counters: Dict[str, Dict[str, float]] = {}
+        self._histograms: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pid: Optional[int] = None
+        self._process_id: Optional[str] = None
+        self._owner_lock = None
+
+    def configure(self, metrics_dir: Optional[str]) -> None:
+        """Change le répertoire partagé des mesures (configuration de l'application)"""
+        if metrics_dir:
+            self.metrics_dir = metrics_dir
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Incrémente un compteur"""
+        self._ensure_process()
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Ajoute une mesure à un histogramme"""
+        self._ensure_process()
+        buckets = METRICS[name][2]
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+                    break
+            histogram["sum"] += value
+            histogram["count"] += 1
+            self._dirty = True
+
+    def _ensure_process(self) -> None:
+        # Un identifiant et un fil d'écriture par processus (recréés après un fork)
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # Processus issu d'un fork: les mesures du parent sont déjà dans son fichier
+                self._counters = {}
+                self._histograms = {}
+                self._dirty = False
+                if self._owner_lock is not None:
+                    # Descripteur hérité: le garder maintiendrait le verrou du parent après son arrêt
+                    self._owner_lock.close()
+            self._pid = pid
+            self._process_id = f"{pid}-{uuid.uuid4().hex[:8]}"
+            self._owner_lock = None
+        threading.Thread(target=self._flush_loop, name="chatmd-metrics", daemon=True).start()
+
+    def _flush_loop(self) -> None:
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"Impossible d'écrire les métriques: {str(e)}")
+
+    def _write_json(self, filename: str, data: str) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.metrics_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.metrics_dir, filename))
+
+    def _hold_owner_lock(self) -> None:
+        """Verrouille metrics-<id>.lock pour la durée de vie du processus"""
+        if fcntl is None or self._owner_lock is not None:
+            return
+        # Verrouillé sous un nom temporaire puis renommé: un processus qui regroupe
+        # les fichiers ne peut pas prendre pour arrêté un processus qui démarre
+        fd, tmp_path = tempfile.mkstemp(dir=self.metrics_dir, suffix=".tmp")
+        lock_file = os.fdopen(fd, "wb")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        os.replace(tmp_path, os.path.join(self.metrics_dir, f"metrics-{self._process_id}.lock"))
+        self._owner_lock = lock_file
+
+    def flush(self) -> None:
+        """Écrit les mesures de ce processus dans son fichier (écriture atomique)"""
+        self._ensure_process()
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"counters": self._counters, "histograms": self._histograms})
+            self._dirty = False
+
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        self._hold_owner_lock()
+        self._write_json(f"metrics-{self._process_id}.json", data)
+
+    def _archive_dead(self, filenames) -> None:
+        """Ajoute à l'archive les mesures des processus arrêtés (verrou libre), puis supprime leurs fichiers"""
+        for filename in filenames:
+            if not (filename.startswith("metrics-") and filename.endswith(".lock")):
+                continue
+            process_id = filename[len("metrics-"):-len(".lock")]
+            if process_id == self._process_id:
+                continue
+            lock_path = os.path.join(self.metrics_dir, filename)
+            data_path = os.path.join(self.metrics_dir, f"metrics-{process_id}.json")
+            try:
+                with open(lock_path, "rb") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # Processus en vie
+                    try:
+                        with open(data_path, "r", encoding="utf-8") as f:
+                            data = json.load(f)
+                    except FileNotFoundError:
+                        data = None  # Déjà regroupé, ou aucune mesure écrite
+                    if data is not None:
+                        counters: Dict[str, Dict[str, float]] = {}
+                        histograms: Dict[str, Dict[str, Dict[str, Any]]] = {}
+                        try:
+                            with open(os.path.join(self.metrics_dir, ARCHIVE_FILENAME), "r", encoding="utf-8") as f:
+                                _merge(counters, histograms, json.load(f))
+                        except FileNotFoundError:
+                            pass
+                        _merge(counters, histograms, data)
+                        self._write_json(ARCHIVE_FILENAME, json.dumps({"counters": counters, "histograms": histograms}))
+                        os.remove(data_path)
+                    os.remove(lock_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Impossible d'archiver les métriques du processus {process_id}: {str(e)}")
+
+    def _collect(self) -> Tuple[Dict[str, Dict[str, float]], Dict[str, Dict[str, Dict[str, Any]]]]:
+        """Additionne les mesures de tous les processus, en vie ou archivés"""
+        counters: Dict[str, Dict[str, float]] = {}
+        histograms: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+        try:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            archive_lock = open(os.path.join(self.metrics_dir, ARCHIVE_LOCK_FILENAME), "a+b")
+        except OSError as e:
+            logger.warning(f"Répertoire des métriques inaccessible: {str(e)}")
+            return counters, histograms
+
+        with archive_lock:
+            if fcntl is not None:
+                # Regroupement exclusif, puis lecture partagée: un fichier archivé n'est jamais compté deux fois
+                fcntl.flock(archive_lock, fcntl.LOCK_EX)
+                self._archive_dead(os.listdir(self.metrics_dir))
+                fcntl.flock(archive_lock, fcntl.LOCK_SH)
+
+            filenames = [name for name in os.listdir(self.metrics_dir)
+                         if name.startswith("metrics-") and name.endswith(".json")]
+            for filename in filenames:
+                try:
+                    with open(os.path.join(self.metrics_dir, filename), "r", encoding="utf-8") as f:
+                        _merge(counters, histograms, json.load(f))
+                except FileNotFoundError:
+                    continue
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Fichier de métriques illisible {filename}: {str(e)}")
+
+        return counters, histograms
+
+    def render(self) -> str:
+        """Retourne les mesures de tous les workers au format texte de Prometheus"""
+        self.flush()
+        counters, histograms = self._collect()
+
+        lines = []
+        for name, (kind, description, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            if kind == "counter":
+                for key, value in sorted(counters.get(name, {}).items()):
+                    lines.append(f"{name}{_format_labels(json.loads(key))} {value}")
+                continue
+
+            for key, histogram in sorted(histograms.get(name, {}).items()):
+                labels = json.loads(key)
+                cumulative = 0
+                for bound, count in zip(buckets, histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_bound(bound)))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
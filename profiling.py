@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Dict, Any, Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# En-tête HTTP activant le profilage d'une requête
+PROFILE_HEADER = "X-ChatMD-Profile"
+
+# Fonctions les plus coûteuses (temps cumulé) conservées dans le rapport
+TOP_FUNCTIONS = 30
+
+_PROFILE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# Profil en cours dans le thread courant (None hors profilage)
+_current = threading.local()
+
+# Contexte vide réutilisé par span() lorsque le profilage est désactivé
+_NO_SPAN = nullcontext()
+
+
+def span(name: str):
+    """Mesure la durée d'une étape de traitement si la requête courante est profilée
+
+    Sans profil actif, retourne un contexte vide partagé: le coût se limite
+    à une lecture de variable locale au thread.
+    """
+    profile = getattr(_current, "profile", None)
+    if profile is None:
+        return _NO_SPAN
+    return profile.span(name)
+
+
+class RequestProfile:
+    """Profil d'un traitement: cProfile et durées des étapes (spans) du thread courant"""
+
+    def __init__(self, label: str):
+        self.id = uuid.uuid4().hex
+        self.label = label
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.spans: List[Dict[str, Any]] = []
+        self.total: Optional[float] = None
+        self._profiler = cProfile.Profile()
+        self._depth = 0
+        self._started = 0.0
+
+    def start(self) -> None:
+        _current.profile = self
+        self._started = time.perf_counter()
+        self._profiler.enable()
+
+    def stop(self) -> None:
+        self._profiler.disable()
+        self.total = time.perf_counter() - self._started
+        if getattr(_current, "profile", None) is self:
+            _current.profile = None
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        depth = self._depth
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth = depth
+            self.spans.append({
+                "name": name,
+                "start": round(started - self._started, 6),
+                "duration": round(time.perf_counter() - started, 6),
+                "depth": depth,
+            })
+
+    def report(self, status: Optional[int] = None) -> Dict[str, Any]:
+        """Rapport JSON: étapes dans l'ordre chronologique, temps par étape et fonctions les plus coûteuses"""
+        stages: Dict[str, float] = {}
+        for entry in self.spans:
+            stages[entry["name"]] = round(stages.get(entry["name"], 0.0) + entry["duration"], 6)
+
+        stats = pstats.Stats(self._profiler)
+        functions = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            functions.append({
+                "function": f"{os.path.basename(filename)}:{line}({function})",
+                "calls": calls,
+                "tottime": round(tottime, 6),
+                "cumtime": round(cumtime, 6),
+            })
+        functions.sort(key=lambda entry: entry["cumtime"], reverse=True)
+
+        return {
+            "id": self.id,
+            "label": self.label,
+            "started_at": self.started_at,
+            "status": status,
+            "total": round(self.total, 6) if self.total is not None else None,
+            "stages": stages,
+            "spans": sorted(self.spans, key=lambda entry: entry["start"]),
+            "top_functions": functions[:TOP_FUNCTIONS],
+        }
+
+
+class ProfileStore:
+    """Rapports de profilage sur disque, partagés entre les workers gunicorn
+
+    Chaque profil donne deux fichiers: <id>.json (rapport lisible) et
+    <id>.prof (statistiques cProfile, lisibles avec pstats ou snakeviz).
+    Seuls les max_reports profils les plus récents sont conservés.
+    """
+
+    def __init__(self, profiles_dir: Optional[str] = None, max_reports: int = 100):
+        self.profiles_dir = profiles_dir or os.path.join(tempfile.gettempdir(), "chatmd_profiles")
+        self.max_reports = max_reports
+
+    def configure(self, profiles_dir: Optional[str] = None, max_reports: Optional[int] = None) -> None:
+        """Change le répertoire et le nombre de rapports conservés (configuration de l'application)"""
+        if profiles_dir:
+            self.profiles_dir = profiles_dir
+        if max_reports is not None:
+            self.max_reports = max_reports
+
+    def _path(self, profile_id: str, suffix: str) -> Optional[str]:
+        if not _PROFILE_ID_RE.match(profile_id):
+            return None
+        return os.path.join(self.profiles_dir, f"{profile_id}{suffix}")
+
+    def save(self, profile: RequestProfile, status: Optional[int] = None) -> Dict[str, Any]:
+        """Enregistre le rapport et les statistiques cProfile d'un profil terminé"""
+        report = profile.report(status)
+        os.makedirs(self.profiles_dir, exist_ok=True)
+
+        # Écritures atomiques: la liste ne voit jamais de fichier à moitié écrit
+        fd, tmp_path = tempfile.mkstemp(dir=self.profiles_dir, suffix=".tmp")
+        os.close(fd)
+        profile._profiler.dump_stats(tmp_path)
+        os.replace(tmp_path, self._path(profile.id, ".prof"))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.profiles_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        os.replace(tmp_path, self._path(profile.id, ".json"))
+
+        logger.info(f"Profil {profile.id} enregistré: {profile.label} en {report['total']:.3f}s")
+        self._prune()
+        return report
+
+    def _prune(self) -> None:
+        try:
+            reports = [entry for entry in os.scandir(self.profiles_dir) if entry.name.endswith(".json")]
+        except FileNotFoundError:
+            return
+        reports.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in reports[self.max_reports:]:
+            profile_id = entry.name[:-len(".json")]
+            for suffix in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(self.profiles_dir, profile_id + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Résumé des profils enregistrés, du plus récent au plus ancien"""
+        profiles = []
+        try:
+            filenames = [name for name in os.listdir(self.profiles_dir) if name.endswith(".json")]
+        except FileNotFoundError:
+            return profiles
+
+        for filename in filenames:
+            report = self.get(filename[:-len(".json")])
+            if report:
+                profiles.append({key: report.get(key) for key in ("id", "label", "started_at", "status", "total", "stages")})
+        profiles.sort(key=lambda report: report["started_at"] or "", reverse=True)
+        return profiles
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        """Rapport complet d'un profil, ou None s'il n'existe pas"""
+        path = self._path(profile_id, ".json")
+        if not path:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def stats_path(self, profile_id: str) -> Optional[str]:
+        """Chemin du fichier cProfile d'un profil, ou None s'il n'existe pas"""
+        path = self._path(profile_id, ".prof")
+        return path if path and os.path.exists(path) else None
+
+    def call(self, label: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Exécute func sous profilage (dans le thread courant) et enregistre le rapport"""
+        profile = RequestProfile(label)
+        profile.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.stop()
+            try:
+                self.save(profile)
+            except OSError as e:
+                logger.warning(f"Impossible d'enregistrer le profil {profile.id}: {str(e)}")
+
+
+profile_store = ProfileStore()
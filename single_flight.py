@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: regroupement limité aux threads du processus
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Durée de conservation des résultats transmis aux autres processus (secondes)
+RESULT_TTL_SECONDS = 300
+
+# Intervalle de vérification du verrou par les appels en attente (secondes)
+POLL_INTERVAL = 0.2
+
+# Valeur distincte de None (résultat possible) pour un résultat absent
+_MISSING = object()
+
+
+class _Call:
+    """Calcul en cours dans le processus, attendu par les threads suivants"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Regroupe les calculs identiques simultanés (single-flight), entre threads et entre workers gunicorn
+
+    Le premier appel pour une clé exécute le calcul; les appels identiques
+    qui arrivent pendant ce temps l'attendent et reçoivent son résultat.
+    Entre processus, un verrou fcntl.flock par clé (<clé>.lock) désigne le
+    processus qui calcule; il dépose le résultat dans <clé>.json, lu par
+    les processus qui attendaient le verrou. Si le calcul échoue, le
+    processus suivant le refait. Les appels en attente attendent tant que
+    le calcul est en cours: un processus arrêté libère son verrou, et le
+    suivant refait alors le calcul.
+    """
+
+    def __init__(self, lock_dir: Optional[str] = None, result_ttl: int = RESULT_TTL_SECONDS):
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), "chatmd_single_flight")
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._futures: Dict[str, asyncio.Future] = {}
+
+    def configure(self, lock_dir: Optional[str]) -> None:
+        """Change le répertoire partagé des verrous (configuration de l'application)"""
+        if lock_dir:
+            self.lock_dir = lock_dir
+
+    def in_flight(self) -> int:
+        """Nombre de calculs en cours dans ce processus"""
+        with self._lock:
+            return len(self._calls) + len(self._futures)
+
+    def _path(self, key: str, suffix: str) -> str:
+        # La clé est hachée: elle peut contenir des caractères interdits dans un nom de fichier
+        return os.path.join(self.lock_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + suffix)
+
+    def _read_result(self, key: str, since: float) -> Any:
+        """Résultat déposé par un autre processus après since, ou _MISSING"""
+        path = self._path(key, ".json")
+        try:
+            if os.path.getmtime(path) < since:
+                return _MISSING  # Résultat d'un calcul antérieur à l'attente
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)["result"]
+        except (OSError, ValueError, KeyError):
+            return _MISSING
+
+    def _write_result(self, key: str, result: Any) -> None:
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"result": result}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key, ".json"))
+        except (OSError, TypeError) as e:
+            logger.warning(f"Impossible de transmettre le résultat aux autres workers: {str(e)}")
+
+    def _prune(self) -> None:
+        """Supprime les résultats expirés et les verrous inutilisés depuis result_ttl"""
+        limit = time.time() - self.result_ttl
+        try:
+            names = os.listdir(self.lock_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if os.path.getmtime(path) >= limit:
+                    continue
+                if name.endswith(".lock"):
+                    # Ne supprimer que les verrous libres
+                    with open(path, "a+b") as lock_file:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os.remove(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def _try_lock(self, key: str):
+        """Ouvre et verrouille <clé>.lock sans attendre; None si un autre processus le détient"""
+        path = self._path(key, ".lock")
+        while True:
+            lock_file = open(path, "a+b")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            try:
+                if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            # Fichier supprimé par _prune entre l'ouverture et le verrouillage: un autre
+            # processus a pu verrouiller le nouveau fichier, recommencer avec celui-ci
+            lock_file.close()
+
+    def _lead(self, key: str, lock_file, func: Callable[..., Any], *args) -> Any:
+        """Exécute le calcul en détenant le verrou, puis dépose le résultat pour les autres processus"""
+        try:
+            result = func(*args)
+            self._write_result(key, result)
+            return result
+        finally:
+            os.utime(lock_file.fileno())
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._prune()
+
+    def _run_across_processes(self, key: str, func: Callable[..., Any], *args) -> Any:
+        if fcntl is None:
+            return func(*args)
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        started = time.time()
+        waiting = False
+        # Verrou non bloquant interrogé périodiquement (voir _try_lock)
+        while True:
+            lock_file = self._try_lock(key)
+            if lock_file is not None:
+                break
+            if not waiting:
+                logger.info(f"Calcul identique en cours dans un autre worker, attente de son résultat ({key[:12]})")
+                waiting = True
+            time.sleep(POLL_INTERVAL)
+
+        with lock_file:
+            if waiting:
+                result = self._read_result(key, started)
+                if result is not _MISSING:
+                    metrics.inc("chatmd_generation_coalesced_total", scope="process")
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    return result
+                logger.info(f"Le calcul de l'autre worker a échoué, nouvelle tentative ({key[:12]})")
+            return self._lead(key, lock_file, func, *args)
+
+    def do(self, key: str, func: Callable[..., Any], *args) -> Any:
+        """Exécute func(*args), ou attend le résultat du calcul identique (même clé) déjà en cours"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            logger.info(f"Calcul identique en cours, attente de son résultat ({key[:12]})")
+            metrics.inc("chatmd_generation_coalesced_total", scope="thread")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_across_processes(key, func, *args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def _run_across_processes_async(self, key: str, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        if fcntl is None:
+            return await func(*args)
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        started = time.time()
+        waiting = False
+        # Verrou non bloquant interrogé périodiquement: une attente bloquante occuperait un thread
+        while True:
+            lock_file = self._try_lock(key)
+            if lock_file is not None:
+                break
+            if not waiting:
+                logger.info(f"Calcul identique en cours dans un autre worker, attente de son résultat ({key[:12]})")
+                waiting = True
+            await asyncio.sleep(POLL_INTERVAL)
+
+        with lock_file:
+            if waiting:
+                result = self._read_result(key, started)
+                if result is not _MISSING:
+                    metrics.inc("chatmd_generation_coalesced_total", scope="process")
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    return result
+                logger.info(f"Le calcul de l'autre worker a échoué, nouvelle tentative ({key[:12]})")
+
+            try:
+                result = await func(*args)
+                await asyncio.to_thread(self._write_result, key, result)
+                return result
+            finally:
+                os.utime(lock_file.fileno())
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                self._prune()
+
+    async def do_async(self, key: str, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Version asyncio de do(): les tâches de la boucle attendent le calcul identique en cours"""
+        future = self._futures.get(key)
+        if future is not None:
+            logger.info(f"Calcul identique en cours, attente de son résultat ({key[:12]})")
+            metrics.inc("chatmd_generation_coalesced_total", scope="task")
+            # L'annulation d'une tâche en attente n'annule pas le calcul partagé
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        # Marquer l'exception comme lue, même sans tâche en attente
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        with self._lock:
+            self._futures[key] = future
+        try:
+            result = await self._run_across_processes_async(key, func, *args)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+
+single_flight = SingleFlight()
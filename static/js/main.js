@@ -391,26 +391,86 @@ document.addEventListener('DOMContentLoaded', function() {
      * Fonctions de communication avec le serveur
      */
     
+    // État de la synchronisation avec le serveur: seules les lignes modifiées
+    // depuis la dernière révision enregistrée sont envoyées
+    const documentId = Math.random().toString(36).substring(2) + Date.now().toString(36);
+    let savedLines = null;
+    let savedRevision = null;
+    let saveInProgress = false;
+    let savePending = false;
+    
+    // Calculer la plage de lignes modifiée entre deux versions (préfixe et suffixe communs)
+    function computeLineEdit(oldLines, newLines) {
+        let start = 0;
+        const maxStart = Math.min(oldLines.length, newLines.length);
+        while (start < maxStart && oldLines[start] === newLines[start]) {
+            start++;
+        }
+        
+        let suffix = 0;
+        const maxSuffix = maxStart - start;
+        while (suffix < maxSuffix && oldLines[oldLines.length - 1 - suffix] === newLines[newLines.length - 1 - suffix]) {
+            suffix++;
+        }
+        
+        return {
+            start_line: start,
+            end_line: oldLines.length - suffix,
+            lines: newLines.slice(start, newLines.length - suffix)
+        };
+    }
+    
     // Sauvegarder sur le serveur
     function saveToServer() {
+        // Une seule sauvegarde à la fois: les modifications suivantes partiront ensuite
+        if (saveInProgress) {
+            savePending = true;
+            return;
+        }
+        saveInProgress = true;
         updateStatus('saving');
         
+        const lines = editor.value.split('\n');
+        let payload;
+        if (savedLines !== null && savedRevision !== null) {
+            payload = {
+                document_id: documentId,
+                base_revision: savedRevision,
+                edits: [computeLineEdit(savedLines, lines)],
+                line_count: lines.length
+            };
+        } else {
+            payload = {
+                document_id: documentId,
+                markdown: editor.value
+            };
+        }
+        
         fetch('/update', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/x-www-form-urlencoded',
+                'Content-Type': 'application/json',
             },
-            body: `markdown=${encodeURIComponent(editor.value)}`
+            body: JSON.stringify(payload)
         })
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`Erreur serveur: ${response.status}`);
+        .then(response => response.json().then(data => ({ status: response.status, data: data })))
+        .then(({ status, data }) => {
+            // Le serveur ne connaît pas notre révision: renvoyer le texte complet
+            if (status === 409 && data.resync) {
+                savedLines = null;
+                savedRevision = null;
+                savePending = true;
+                return;
             }
-            return response.json();
-        })
-        .then(data => {
-            if (data.error) {
-                throw new Error(data.error);
+            
+            // La révision est enregistrée même si le YAML est invalide
+            if (data.revision !== undefined) {
+                savedLines = lines;
+                savedRevision = data.revision;
+            }
+            
+            if (status !== 200 || data.error) {
+                throw new Error(data.error || `Erreur serveur: ${status}`);
             }
             updateStatus('saved');
         })
@@ -418,6 +478,13 @@ document.addEventListener('DOMContentLoaded', function() {
             console.error('Erreur lors de la sauvegarde:', error);
             updateStatus('error', error.message);
             showNotification(`Erreur lors de la sauvegarde: ${error.message}`, 'error');
+        })
+        .finally(() => {
+            saveInProgress = false;
+            if (savePending) {
+                savePending = false;
+                saveToServer();
+            }
         });
     }
 
@@ -0,0 +1,161 @@
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+from chunking import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Taille de la fenêtre de contexte (prompt + réponse, en tokens) par modèle; le préfixe le plus long l'emporte
+CONTEXT_WINDOWS = {
+    "mistral:7b": 32768,
+    "mistral-tiny": 32768,
+    "mistral-small": 32768,
+    "mistral-medium": 131072,
+    "mistral-large": 131072,
+    "open-mistral-7b": 32768,
+    "open-mixtral-8x7b": 32768,
+    "open-mixtral-8x22b": 65536,
+    "open-mistral-nemo": 131072,
+    "ministral": 131072,
+    "codestral": 262144,
+    "codestral-2405": 32768,
+    "llama3": 8192,
+    "llama3.1": 131072,
+    "llama3.2": 131072,
+    "qwen2.5": 32768,
+    "gemma2": 8192,
+}
+
+# Fenêtre supposée pour un modèle absent de la table
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Part de la fenêtre laissée libre pour absorber l'erreur d'estimation du nombre de tokens
+SAFETY_MARGIN = 0.05
+
+# Tokens ajoutés par message par le gabarit de conversation du modèle (rôle, séparateurs)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Réponse demandée par défaut (suggestions, plans des morceaux) et réponse minimale conservée lors d'un ajustement
+DEFAULT_COMPLETION_TOKENS = 2000
+MIN_COMPLETION_TOKENS = 512
+
+# Estimation de la taille du JSON d'un chatbot: un bloc de réponse (déclencheurs, contenu, choix) et l'en-tête
+TOKENS_PER_BLOCK = 150
+CHATBOT_OVERHEAD_TOKENS = 300
+
+_TRIM_MARKER = "\n\n[...]\n\n"
+
+# Fonctions de comptage enregistrées par préfixe de nom de modèle ("" : tous les modèles)
+_TOKENIZERS: Dict[str, Callable[[str], int]] = {}
+
+
+def _longest_prefix(table: Dict[str, object], model: Optional[str]) -> Optional[str]:
+    model = (model or "").lower()
+    matches = [prefix for prefix in table if model.startswith(prefix)]
+    return max(matches, key=len) if matches else None
+
+
+def register_tokenizer(model_prefix: str, count: Callable[[str], int]) -> None:
+    """Enregistre une fonction de comptage des tokens pour les modèles dont le nom commence par model_prefix
+
+    Sans fonction enregistrée, le nombre de tokens est estimé à partir du
+    nombre de caractères (chunking.estimate_tokens).
+    """
+    _TOKENIZERS[model_prefix.lower()] = count
+
+
+def use_tiktoken(model_prefix: str = "", encoding: str = "cl100k_base") -> bool:
+    """Compte les tokens avec tiktoken (optionnel) pour les modèles de ce préfixe, si le paquet est installé"""
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken n'est pas installé, estimation du nombre de tokens par le nombre de caractères")
+        return False
+    tokenizer = tiktoken.get_encoding(encoding)
+    register_tokenizer(model_prefix, lambda text: len(tokenizer.encode(text, disallowed_special=())))
+    return True
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Nombre de tokens d'un texte pour un modèle (compté ou estimé)"""
+    prefix = _longest_prefix(_TOKENIZERS, model)
+    return _TOKENIZERS[prefix](text) if prefix is not None else estimate_tokens(text)
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: Optional[str] = None) -> int:
+    """Nombre de tokens d'une liste de messages, gabarit de conversation compris"""
+    return sum(count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def context_window(model: Optional[str], override: Optional[int] = None) -> int:
+    """Fenêtre de contexte d'un modèle: valeur configurée, sinon table CONTEXT_WINDOWS"""
+    if override:
+        return override
+    prefix = _longest_prefix(CONTEXT_WINDOWS, model)
+    return CONTEXT_WINDOWS[prefix] if prefix is not None else DEFAULT_CONTEXT_WINDOW
+
+
+def blocks_completion_tokens(blocks: int) -> int:
+    """Taille de réponse nécessaire pour générer un nombre donné de blocs de réponse en JSON"""
+    return CHATBOT_OVERHEAD_TOKENS + blocks * TOKENS_PER_BLOCK
+
+
+def chatbot_completion_tokens(max_depth: int, choices_per_level: int) -> int:
+    """Taille de réponse nécessaire pour un chatbot complet
+
+    L'arbre demandé compte choices_per_level blocs au premier niveau, puis
+    choices_per_level fois plus à chaque niveau, jusqu'à max_depth.
+    """
+    max_depth = max(1, int(max_depth))
+    choices_per_level = max(1, int(choices_per_level))
+    blocks = sum(choices_per_level ** depth for depth in range(1, max_depth + 1))
+    return blocks_completion_tokens(blocks)
+
+
+def trim_text(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """Réduit un texte à max_tokens tokens en retirant son milieu
+
+    Le début (consignes, présentation du document) et la fin (consignes
+    placées après le document) sont conservés.
+    """
+    tokens = count_tokens(text, model)
+    if tokens <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+
+    keep = len(text) * max_tokens // tokens
+    # Le comptage n'est pas proportionnel aux caractères: quelques réductions supplémentaires au besoin
+    for _ in range(5):
+        half = max(0, (keep - len(_TRIM_MARKER)) // 2)
+        trimmed = text[:half] + _TRIM_MARKER + (text[-half:] if half else "")
+        if count_tokens(trimmed, model) <= max_tokens:
+            return trimmed
+        keep = keep * 9 // 10
+    return trimmed
+
+
+def fit_messages(messages: List[Dict[str, str]], model: Optional[str], window: int,
+                 completion_tokens: int) -> Tuple[List[Dict[str, str]], int]:
+    """Ajuste une requête à la fenêtre de contexte: retourne (messages, max_tokens)
+
+    La réponse demandée est d'abord réduite à la place restante après le
+    prompt; s'il reste moins de MIN_COMPLETION_TOKENS, le plus long message
+    non système est raccourci par son milieu (trim_text).
+    """
+    budget = int(window * (1 - SAFETY_MARGIN))
+    prompt_tokens = count_message_tokens(messages, model)
+    floor = min(completion_tokens, MIN_COMPLETION_TOKENS)
+    if budget - prompt_tokens >= floor:
+        return messages, min(completion_tokens, budget - prompt_tokens)
+
+    candidates = [index for index, message in enumerate(messages) if message["role"] != "system"] or list(range(len(messages)))
+    index = max(candidates, key=lambda i: len(messages[i]["content"]))
+    content = messages[index]["content"]
+    excess = prompt_tokens + floor - budget
+    trimmed = trim_text(content, count_tokens(content, model) - excess, model)
+    logger.warning(f"Requête trop longue pour la fenêtre de contexte de {model} ({window} tokens): "
+                   f"{excess} tokens retirés du message {index}, réponse limitée à {floor} tokens")
+
+    fitted = list(messages)
+    fitted[index] = {**messages[index], "content": trimmed}
+    return fitted, floor
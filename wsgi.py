@@ -1,12 +1,26 @@
-from flask import Flask, render_template, request, jsonify, send_file, after_this_request, abort, session, redirect
-import yaml
+from flask import Flask, render_template, request, jsonify, send_file, after_this_request, abort, session, redirect, Response, stream_with_context, g
+import io
 import os
 import tempfile
 import logging
 import json
+import time
+import uuid
 from werkzeug.utils import secure_filename
 from document_processor import DocumentProcessor
 from llm_service import LLMService
+from job_queue import JobQueue
+from disk_cache import DiskCache
+from batch_generator import BatchGenerator
+from chatmd_parser import parse_chatmd
+from chatmd_graph import analyze_links
+from chatmd_matcher import TriggerMatcher
+from backend_stats import backend_stats
+from metrics import metrics
+from profiling import PROFILE_HEADER, RequestProfile, profile_store, span
+from single_flight import single_flight
+from admission import AdmissionRejected, admission, rate_limiter
+from document_store import DocumentStore, RevisionConflict
 from dotenv import load_dotenv
 
 # Charger les variables d'environnement
@@ -25,13 +39,6 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Clé secrète pour les sessions
-app.secret_key = os.urandom(24)
-
-# Initialisation des services
-document_processor = DocumentProcessor()
-llm_service = LLMService(use_online=False)  # Par défaut, utiliser le LLM local
-
 # Configuration
 CONFIG_FILE = 'config_prod.json'  # Utiliser la configuration de production
 
@@ -64,7 +71,40 @@ Contenu de la réponse 2
     "host": "0.0.0.0",
     "port": 8000,
     "workers": 4,
-    "timeout": 120
+    "timeout": 120,
+    "job_workers": 2,  # Générations asynchrones simultanées par worker
+    "job_max_pending": 20,
+    "job_ttl_seconds": 3600,
+    "cache_dir": "cache",
+    "generation_cache_max_mb": 100,
+    "generation_cache_ttl_seconds": 604800,  # 7 jours
+    "extraction_cache_max_mb": 200,
+    "pdf_max_pages": None,  # Nombre maximal de pages extraites (None = illimité)
+    "pdf_max_chars": None,  # Nombre maximal de caractères extraits (None = illimité)
+    "pdf_parallel_min_pages": 50,
+    "pdf_max_processes": 4,
+    "batch_max_documents": 50,
+    "batch_extraction_workers": 4,
+    "batch_local_concurrency": 1,  # Générations simultanées envoyées au LLM local
+    "batch_online_concurrency": 4,  # Générations simultanées envoyées à l'API en ligne
+    "simulation_max_utterances": 10000,
+    "metrics_dir": None,  # Répertoire des mesures partagé entre les workers (None = répertoire temporaire)
+    "profiling_enabled": False,  # Profiler toutes les requêtes (sinon seulement celles avec l'en-tête X-ChatMD-Profile)
+    "profiling_dir": None,  # Répertoire des rapports de profilage (None = répertoire temporaire)
+    "profiling_max_reports": 100,
+    "single_flight_dir": None,  # Répertoire des verrous de regroupement des générations identiques (None = répertoire temporaire)
+    "document_cache_max_mb": 50,  # Journaux des documents en cours d'édition, partagés entre les workers
+    "document_cache_ttl_seconds": 86400,  # 1 jour
+    "llm_local_concurrency": 1,  # Générations simultanées envoyées au LLM local, tous workers confondus
+    "llm_online_concurrency": 4,  # Générations simultanées envoyées à l'API en ligne, tous workers confondus
+    "llm_queue_max_waiting": 20,  # Demandes en attente par backend; au-delà, refus immédiat (429)
+    "llm_queue_timeout_seconds": 60,  # Attente maximale d'une place (sinon 503)
+    "llm_job_queue_timeout_seconds": 3600,  # Attente maximale d'une place pour les tâches asynchrones et les lots
+    "rate_limit_per_minute": 10,  # Demandes au LLM par client et par minute (0 = illimité)
+    "rate_limit_burst": 5,  # Demandes consécutives autorisées avant d'appliquer le débit
+    "rate_limit_key": "ip",  # Client: "ip" ou "session" (cookie de session, à défaut adresse IP)
+    "rate_limit_trust_proxy": False,  # Adresse du client lue dans l'en-tête X-Real-IP (derrière Nginx)
+    "admission_dir": None  # Répertoire des places et des compteurs par client partagé entre les workers (None = répertoire temporaire)
 }
 
 # Charger la configuration
@@ -86,6 +126,203 @@ def load_config():
 # Charger la configuration
 config = load_config()
 
+def load_secret_key(directory):
+    """Clé de signature des sessions, commune à tous les workers
+
+    SECRET_KEY (fichier .env) si elle est définie, sinon une clé générée au
+    premier démarrage et conservée dans directory/secret_key.
+    """
+    key = os.getenv('SECRET_KEY')
+    if key:
+        return key
+    
+    path = os.path.join(directory, 'secret_key')
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(24).hex())
+        try:
+            # Lien atomique: si plusieurs workers démarrent ensemble, la première clé écrite l'emporte
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+# Clé secrète pour les sessions: une clé par worker invaliderait les sessions d'un worker à l'autre
+app.secret_key = load_secret_key(config.get('cache_dir', DEFAULT_CONFIG['cache_dir']))
+
+# Mesures exposées sur /metrics, agrégées entre les workers
+metrics.configure(config.get('metrics_dir', DEFAULT_CONFIG['metrics_dir']))
+
+# Rapports de profilage des requêtes, consultables sur /api/profiles
+profile_store.configure(
+    config.get('profiling_dir', DEFAULT_CONFIG['profiling_dir']),
+    config.get('profiling_max_reports', DEFAULT_CONFIG['profiling_max_reports'])
+)
+
+# Générations identiques simultanées regroupées, y compris entre les workers
+single_flight.configure(config.get('single_flight_dir', DEFAULT_CONFIG['single_flight_dir']))
+
+# Contrôle d'admission des appels au LLM (concurrence par backend, file d'attente bornée) et limite par client
+admission.configure(
+    config.get('admission_dir', DEFAULT_CONFIG['admission_dir']),
+    concurrency={
+        'local': config.get('llm_local_concurrency', DEFAULT_CONFIG['llm_local_concurrency']),
+        'online': config.get('llm_online_concurrency', DEFAULT_CONFIG['llm_online_concurrency'])
+    },
+    max_waiting=config.get('llm_queue_max_waiting', DEFAULT_CONFIG['llm_queue_max_waiting']),
+    queue_timeout=config.get('llm_queue_timeout_seconds', DEFAULT_CONFIG['llm_queue_timeout_seconds']),
+    job_queue_timeout=config.get('llm_job_queue_timeout_seconds', DEFAULT_CONFIG['llm_job_queue_timeout_seconds'])
+)
+rate_limiter.configure(
+    config.get('admission_dir', DEFAULT_CONFIG['admission_dir']),
+    per_minute=config.get('rate_limit_per_minute', DEFAULT_CONFIG['rate_limit_per_minute']),
+    burst=config.get('rate_limit_burst', DEFAULT_CONFIG['rate_limit_burst'])
+)
+
+# Initialisation des services
+# Cache du texte extrait des documents, partagé entre les workers
+extraction_cache = DiskCache(
+    os.path.join(config.get('cache_dir', DEFAULT_CONFIG['cache_dir']), 'extractions'),
+    max_size_bytes=config.get('extraction_cache_max_mb', DEFAULT_CONFIG['extraction_cache_max_mb']) * 1024 * 1024
+)
+document_processor = DocumentProcessor(
+    cache=extraction_cache,
+    max_pages=config.get('pdf_max_pages', DEFAULT_CONFIG['pdf_max_pages']),
+    max_chars=config.get('pdf_max_chars', DEFAULT_CONFIG['pdf_max_chars']),
+    parallel_min_pages=config.get('pdf_parallel_min_pages', DEFAULT_CONFIG['pdf_parallel_min_pages']),
+    max_processes=config.get('pdf_max_processes', DEFAULT_CONFIG['pdf_max_processes'])
+)
+
+# Cache des chatbots générés, partagé entre les workers
+generation_cache = DiskCache(
+    os.path.join(config.get('cache_dir', DEFAULT_CONFIG['cache_dir']), 'generations'),
+    max_size_bytes=config.get('generation_cache_max_mb', DEFAULT_CONFIG['generation_cache_max_mb']) * 1024 * 1024,
+    ttl_seconds=config.get('generation_cache_ttl_seconds', DEFAULT_CONFIG['generation_cache_ttl_seconds'])
+)
+llm_service = LLMService(use_online=False, cache=generation_cache)  # Par défaut, utiliser le LLM local
+offline_llm_service = LLMService(use_offline=True)  # Génération extractive, sans LLM
+
+# Derniers documents analysés par session d'édition (réanalyse incrémentale), journaux partagés entre les workers
+document_store = DocumentStore(
+    shared_dir=os.path.join(config.get('cache_dir', DEFAULT_CONFIG['cache_dir']), 'documents'),
+    max_size_bytes=config.get('document_cache_max_mb', DEFAULT_CONFIG['document_cache_max_mb']) * 1024 * 1024,
+    ttl_seconds=config.get('document_cache_ttl_seconds', DEFAULT_CONFIG['document_cache_ttl_seconds'])
+)
+
+def session_document_key(document_id):
+    """Clé d'un document dans document_store, liée à la session: un document_id ne désigne que les documents de sa session"""
+    return f"{session.setdefault('editor_id', uuid.uuid4().hex)}:{document_id}"
+
+# Génération par lots, avec une concurrence bornée par backend
+batch_generator = BatchGenerator(
+    document_processor,
+    llm_service,
+    extraction_workers=config.get('batch_extraction_workers', DEFAULT_CONFIG['batch_extraction_workers']),
+    backend_concurrency={
+        'local': config.get('batch_local_concurrency', DEFAULT_CONFIG['batch_local_concurrency']),
+        'online': config.get('batch_online_concurrency', DEFAULT_CONFIG['batch_online_concurrency'])
+    }
+)
+
+# File de tâches pour la génération asynchrone
+job_queue = JobQueue(
+    max_workers=config.get('job_workers', DEFAULT_CONFIG['job_workers']),
+    max_pending=config.get('job_max_pending', DEFAULT_CONFIG['job_max_pending']),
+    ttl_seconds=config.get('job_ttl_seconds', DEFAULT_CONFIG['job_ttl_seconds'])
+)
+
+def profiling_requested():
+    """Indique si la requête doit être profilée (en-tête X-ChatMD-Profile ou profiling_enabled)"""
+    if request.endpoint in ('static', 'prometheus_metrics') or request.path.startswith('/api/profiles'):
+        return False
+    if config.get('profiling_enabled', DEFAULT_CONFIG['profiling_enabled']):
+        return True
+    return request.headers.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'on')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if profiling_requested():
+        g.profile = RequestProfile(f"{request.method} {request.path}")
+        g.profile.start()
+
+# Routes qui appellent le LLM, soumises à la limite de débit par client
+RATE_LIMITED_ENDPOINTS = {
+    'generate_from_document',
+    'batch_generate_from_documents',
+    'submit_generation_job',
+    'suggest_improvements',
+    'stream_suggest_improvements',
+    'stream_generate_from_document'
+}
+
+def rate_limit_client(req, client_session):
+    """Identifie le client pour la limite de débit: identifiant de session ou adresse IP"""
+    if config.get('rate_limit_key', DEFAULT_CONFIG['rate_limit_key']) == 'session' and client_session.get('client_id'):
+        return f"session:{client_session['client_id']}"
+    if config.get('rate_limit_trust_proxy', DEFAULT_CONFIG['rate_limit_trust_proxy']):
+        return f"ip:{req.headers.get('X-Real-IP') or req.remote_addr}"
+    return f"ip:{req.remote_addr}"
+
+def admission_error(error):
+    """Réponse d'une demande refusée par le contrôle d'admission ou la limite de débit"""
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status
+
+@app.before_request
+def limit_llm_requests():
+    """Applique la limite de débit par client aux routes qui appellent le LLM (429 au-delà)"""
+    if request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    client = rate_limit_client(request, session)
+    if config.get('rate_limit_key', DEFAULT_CONFIG['rate_limit_key']) == 'session':
+        # Sans cookie, la première demande est comptée sur l'adresse IP
+        session.setdefault('client_id', uuid.uuid4().hex)
+    try:
+        rate_limiter.check(client)
+    except AdmissionRejected as e:
+        return admission_error(e)
+    return None
+
+@app.after_request
+def record_request_duration(response):
+    """Mesure la durée de chaque requête par route (jusqu'à l'envoi des en-têtes pour les flux SSE)"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('chatmd_http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def save_request_profile(response):
+    """Enregistre le profil de la requête; pour une réponse en flux, à la fin de l'envoi"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    
+    response.headers['X-ChatMD-Profile-Id'] = profile.id
+    status = response.status_code
+    
+    def save():
+        profile.stop()
+        try:
+            profile_store.save(profile, status)
+        except OSError as e:
+            logger.warning(f"Impossible d'enregistrer le profil {profile.id}: {str(e)}")
+    
+    if response.is_streamed:
+        response.call_on_close(save)
+    else:
+        save()
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html', markdown=config.get('base_template', DEFAULT_CONFIG['base_template']))
@@ -100,29 +337,46 @@ def serve_model(filename):
 
 @app.route('/update', methods=['POST'])
 def update():
-    markdown = request.form.get('markdown', '')
-    if not markdown:
-        logger.warning("Tentative de mise à jour avec un markdown vide")
-        return jsonify({'error': 'Le contenu markdown est vide'}), 400
+    """Valide le document en cours d'édition
+
+    Accepte soit le texte complet (champ markdown), soit des modifications de
+    lignes par rapport à une révision déjà enregistrée (JSON: base_revision,
+    edits, line_count). Seul le résultat de la validation est renvoyé.
+    """
+    data = request.get_json(silent=True) or {}
+    document_id = data.get('document_id') or session.setdefault('document_id', uuid.uuid4().hex)
+    if not isinstance(document_id, str) or len(document_id) > 64:
+        return jsonify({'error': 'Identifiant de document invalide'}), 400
+    document_key = session_document_key(document_id)
     
     try:
+        if 'edits' in data:
+            # Appliquer les modifications à la révision connue du client
+            try:
+                document, revision = document_store.apply_edits(document_key, data.get('base_revision'), data['edits'])
+            except RevisionConflict as e:
+                return jsonify({'error': str(e), 'resync': True}), 409
+            
+            if 'line_count' in data and data['line_count'] != len(document.lines):
+                document_store.discard(document_key)
+                return jsonify({'error': 'Document désynchronisé, renvoyer le texte complet', 'resync': True}), 409
+        else:
+            markdown = data.get('markdown') or request.form.get('markdown', '')
+            if not markdown:
+                logger.warning("Tentative de mise à jour avec un markdown vide")
+                return jsonify({'error': 'Le contenu markdown est vide'}), 400
+            
+            # Seuls les blocs modifiés depuis le dernier enregistrement sont réanalysés
+            document, revision = document_store.replace(document_key, markdown)
+        
         # Valider le YAML
-        if '---' in markdown:
-            parts = markdown.split('---')
-            if len(parts) >= 3:
-                yaml_part = parts[1]
-                try:
-                    yaml.safe_load(yaml_part)
-                except yaml.YAMLError as e:
-                    logger.warning(f"Erreur de validation YAML: {e}")
-                    return jsonify({'error': f'Erreur de syntaxe YAML: {str(e)}'}), 400
+        if document.yaml_error:
+            logger.warning(f"Erreur de validation YAML: {document.yaml_error}")
+            return jsonify({'error': f'Erreur de syntaxe YAML: {document.yaml_error}', 'revision': revision}), 400
         
-        # Convertir le Markdown en HTML (sera fait côté client avec Showdown.js)
-        return jsonify({
-            'markdown': markdown,
-            'html': '<div>Prévisualisation sera générée côté client</div>',
-            'status': 'success'
-        })
+        return jsonify({'status': 'success', 'revision': revision})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Erreur lors de la mise à jour du markdown: {e}")
         return jsonify({'error': f'Erreur lors de la mise à jour: {str(e)}'}), 500
@@ -192,16 +446,11 @@ def upload():
             logger.warning("Le fichier n'est pas un fichier texte valide")
             return jsonify({'error': 'Le fichier n\'est pas un fichier texte valide'}), 400
         
-        # Vérifier si le contenu contient du markdown valide (vérification basique)
-        if '---' in markdown:
-            parts = markdown.split('---')
-            if len(parts) >= 3:
-                yaml_part = parts[1]
-                try:
-                    yaml.safe_load(yaml_part)
-                except yaml.YAMLError as e:
-                    logger.warning(f"Erreur de validation YAML dans le fichier uploadé: {e}")
-                    return jsonify({'error': f'Erreur de syntaxe YAML dans le fichier: {str(e)}'}), 400
+        # Vérifier si le contenu contient du markdown valide
+        document = parse_chatmd(markdown)
+        if document.yaml_error:
+            logger.warning(f"Erreur de validation YAML dans le fichier uploadé: {document.yaml_error}")
+            return jsonify({'error': f'Erreur de syntaxe YAML dans le fichier: {document.yaml_error}'}), 400
         
         return jsonify({'markdown': markdown, 'status': 'success'})
     except Exception as e:
@@ -274,6 +523,44 @@ def ai_generation_page():
     """Affiche la page de génération par IA"""
     return render_template('ai_generation.html')
 
+def get_generation_params(form):
+    """Récupère les paramètres de génération depuis le formulaire"""
+    return {
+        'doc_type': form.get('doc_type', 'custom'),
+        'tone': form.get('tone', 'conversational'),
+        'complexity': form.get('complexity', 'intermediate'),
+        'max_depth': int(form.get('max_depth', 3)),
+        'choices_per_level': int(form.get('choices_per_level', 3))
+    }
+
+def use_cache_requested(form):
+    """Indique si le cache des générations doit être utilisé (désactivable avec bypass_cache)"""
+    return form.get('bypass_cache', '').lower() not in ('1', 'true', 'on')
+
+def offline_requested(form):
+    """Indique si la génération doit se faire sans LLM (champ offline), quel que soit le mode courant"""
+    return form.get('offline', '').lower() in ('1', 'true', 'on')
+
+def validate_generated_chatmd(markdown, params):
+    """Analyse les liens d'un chatbot généré (cibles inexistantes, blocs inaccessibles, profondeur)"""
+    with span('validation'):
+        validation = analyze_links(parse_chatmd(markdown), params.get('max_depth'))
+    if not validation['valid']:
+        logger.warning(f"Chatbot généré avec des liens invalides: {validation['summary']}")
+    return validation
+
+def run_generation(data, filename, params, use_cache=True, background=False):
+    """Traite le contenu du document, génère le chatbot et valide ses liens (background: tâche asynchrone)"""
+    content = document_processor.process_bytes(data, filename, params)
+    if not content:
+        raise ValueError('Impossible de traiter le document')
+    
+    markdown = llm_service.generate_chatmd(content, params, use_cache=use_cache, background=background)
+    if not markdown:
+        raise RuntimeError('Erreur lors de la génération du chatbot')
+    
+    return {'markdown': markdown, 'validation': validate_generated_chatmd(markdown, params)}
+
 @app.route('/api/generate-from-document', methods=['POST'])
 def generate_from_document():
     """Génère un chatbot à partir d'un document uploadé"""
@@ -285,37 +572,204 @@ def generate_from_document():
         return jsonify({'error': 'Aucun fichier sélectionné'}), 400
     
     # Récupération des paramètres
-    params = {
-        'doc_type': request.form.get('doc_type', 'custom'),
-        'tone': request.form.get('tone', 'conversational'),
-        'complexity': request.form.get('complexity', 'intermediate'),
-        'max_depth': int(request.form.get('max_depth', 3)),
-        'choices_per_level': int(request.form.get('choices_per_level', 3))
-    }
+    params = get_generation_params(request.form)
     
     try:
-        # Sauvegarder le fichier temporairement
-        temp_dir = tempfile.mkdtemp()
-        file_path = os.path.join(temp_dir, secure_filename(file.filename))
-        file.save(file_path)
+        result = run_generation(file.read(), secure_filename(file.filename), params, use_cache_requested(request.form))
+        return jsonify({**result, 'status': 'success'})
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Erreur lors de la génération du chatbot: {str(e)}")
+        return jsonify({'error': f'Erreur: {str(e)}'}), 500
+
+def run_batch(documents, params, use_cache=True, offline=False):
+    """Génère les chatbots d'un lot; le rapport de chaque document (et son chatbot) est le résultat de la tâche"""
+    results = batch_generator.generate(documents, params, use_cache=use_cache,
+                                       llm_service=offline_llm_service if offline else None)
+    return {'documents': results}
+
+@app.route('/api/batch/generate-from-documents', methods=['POST'])
+def batch_generate_from_documents():
+    """Soumet une génération par lots asynchrone et retourne l'identifiant de la tâche
+
+    Un lot peut durer bien plus que le timeout de Gunicorn: il s'exécute
+    dans la file de tâches, et l'archive zip est téléchargée ensuite sur
+    /api/batch/<job_id>/download.
+    """
+    files = [file for file in request.files.getlist('documents') if file.filename]
+    if not files:
+        return jsonify({'error': 'Aucun fichier fourni'}), 400
+    
+    max_documents = config.get('batch_max_documents', DEFAULT_CONFIG['batch_max_documents'])
+    if len(files) > max_documents:
+        return jsonify({'error': f'Trop de documents (max: {max_documents})'}), 400
+    
+    params = get_generation_params(request.form)
+    
+    try:
+        documents = [(secure_filename(file.filename), file.read()) for file in files]
+        job_args = (run_batch, documents, params, use_cache_requested(request.form), offline_requested(request.form))
+        if 'profile' in g:
+            job_id = job_queue.submit(profile_store.call, f"batch ({len(documents)} documents)", *job_args)
+        else:
+            job_id = job_queue.submit(*job_args)
+        if not job_id:
+            return jsonify({'error': 'Trop de générations en cours, veuillez réessayer plus tard'}), 503
         
-        # Traiter le document
-        content = document_processor.process(file_path, params)
-        if not content:
-            return jsonify({'error': 'Impossible de traiter le document'}), 400
+        return jsonify({'job_id': job_id, 'status': 'queued', 'download_url': f'/api/batch/{job_id}/download'}), 202
+    except Exception as e:
+        logger.error(f"Erreur lors de la soumission de la génération par lots: {str(e)}")
+        return jsonify({'error': f'Erreur: {str(e)}'}), 500
+
+@app.route('/api/batch/<job_id>/download', methods=['GET'])
+def download_batch(job_id):
+    """Télécharge l'archive d'un lot terminé: un fichier .md par document et rapport.json"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Tâche inconnue'}), 404
+    
+    if job['status'] == 'error':
+        return jsonify({'error': job['error'], 'status': 'error'}), 500
+    if job['status'] != 'done':
+        return jsonify({'status': job['status']}), 202
+    if not isinstance(job['result'], dict) or 'documents' not in job['result']:
+        return jsonify({'error': "Cette tâche n'est pas une génération par lots"}), 404
+    
+    return send_file(
+        io.BytesIO(BatchGenerator.to_zip(job['result']['documents'])),
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name='chatbots.zip'
+    )
+
+@app.route('/api/jobs/generate-from-document', methods=['POST'])
+def submit_generation_job():
+    """Soumet une génération de chatbot asynchrone et retourne l'identifiant de la tâche"""
+    if 'document' not in request.files:
+        return jsonify({'error': 'Aucun fichier fourni'}), 400
+    
+    file = request.files['document']
+    if file.filename == '':
+        return jsonify({'error': 'Aucun fichier sélectionné'}), 400
+    
+    params = get_generation_params(request.form)
+    
+    try:
+        admission.check(llm_service.mode)
+        filename = secure_filename(file.filename)
+        job_args = (run_generation, file.read(), filename, params, use_cache_requested(request.form), True)
+        if 'profile' in g:
+            # La génération s'exécute dans un autre thread: elle a son propre profil
+            job_id = job_queue.submit(profile_store.call, f"job {filename}", *job_args)
+        else:
+            job_id = job_queue.submit(*job_args)
+        if not job_id:
+            return jsonify({'error': 'Trop de générations en cours, veuillez réessayer plus tard'}), 503
         
-        # Générer le chatbot
-        markdown = llm_service.generate_chatmd(content, params)
-        if not markdown:
-            return jsonify({'error': 'Erreur lors de la génération du chatbot'}), 500
+        return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+    except AdmissionRejected as e:
+        return admission_error(e)
+    except Exception as e:
+        logger.error(f"Erreur lors de la soumission de la génération: {str(e)}")
+        return jsonify({'error': f'Erreur: {str(e)}'}), 500
+
+@app.route('/api/jobs/stats', methods=['GET'])
+def job_stats():
+    """Retourne la profondeur de la file de tâches et les temps moyens"""
+    return jsonify(job_queue.stats())
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Retourne le statut et les temps d'une tâche de génération"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Tâche inconnue'}), 404
+    
+    job.pop('result', None)
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """Retourne le chatbot généré par une tâche terminée"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Tâche inconnue'}), 404
+    
+    if job['status'] == 'error':
+        return jsonify({'error': job['error'], 'status': 'error'}), 500
+    if job['status'] != 'done':
+        return jsonify({'status': job['status']}), 202
+    
+    return jsonify({**job['result'], 'status': 'success'})
+
+@app.route('/api/validate-links', methods=['POST'])
+def validate_links():
+    """Analyse le graphe des choix d'un chatbot: cibles inexistantes, blocs inaccessibles, profondeur, cycles
+
+    Le chatbot est fourni en entier (markdown) ou désigné par l'identifiant
+    du document en cours d'édition (document_id), déjà analysé par /update.
+    """
+    data = request.json
+    if not data or ('markdown' not in data and 'document_id' not in data):
+        return jsonify({'error': 'Aucun contenu fourni'}), 400
+    
+    max_depth = data.get('max_depth')
+    if max_depth is not None and not isinstance(max_depth, int):
+        return jsonify({'error': 'max_depth doit être un entier'}), 400
+    
+    try:
+        if 'markdown' in data:
+            document = parse_chatmd(data['markdown'])
+        else:
+            entry = document_store.get(session_document_key(data['document_id']))
+            if entry is None:
+                return jsonify({'error': 'Document inconnu, renvoyer le texte complet', 'resync': True}), 409
+            document = entry[0]
         
-        # Nettoyer
-        os.remove(file_path)
-        os.rmdir(temp_dir)
+        return jsonify({'validation': analyze_links(document, max_depth), 'status': 'success'})
+    except Exception as e:
+        logger.error(f"Erreur lors de la validation des liens: {str(e)}")
+        return jsonify({'error': f'Erreur: {str(e)}'}), 500
+
+@app.route('/api/simulate-conversation', methods=['POST'])
+def simulate_conversation():
+    """Rejoue des messages d'utilisateur contre les déclencheurs d'un chatbot
+
+    Le chatbot est fourni en entier (markdown) ou désigné par document_id.
+    utterances est une liste de messages (chaînes ou {text, expected}).
+    """
+    data = request.json
+    if not data or ('markdown' not in data and 'document_id' not in data):
+        return jsonify({'error': 'Aucun contenu fourni'}), 400
+    
+    utterances = data.get('utterances')
+    if not isinstance(utterances, list) or not utterances:
+        return jsonify({'error': 'Aucun message fourni'}), 400
+    
+    max_utterances = config.get('simulation_max_utterances', DEFAULT_CONFIG['simulation_max_utterances'])
+    if len(utterances) > max_utterances:
+        return jsonify({'error': f'Trop de messages (maximum {max_utterances})'}), 400
+    
+    top_k = data.get('top_k', 3)
+    if not isinstance(top_k, int) or top_k < 1:
+        return jsonify({'error': 'top_k doit être un entier positif'}), 400
+    
+    try:
+        if 'markdown' in data:
+            document = parse_chatmd(data['markdown'])
+        else:
+            entry = document_store.get(session_document_key(data['document_id']))
+            if entry is None:
+                return jsonify({'error': 'Document inconnu, renvoyer le texte complet', 'resync': True}), 409
+            document = entry[0]
         
-        return jsonify({'markdown': markdown, 'status': 'success'})
+        report = TriggerMatcher(document).replay(utterances, top_k)
+        return jsonify({**report, 'status': 'success'})
     except Exception as e:
-        logger.error(f"Erreur lors de la génération du chatbot: {str(e)}")
+        logger.error(f"Erreur lors de la simulation de conversation: {str(e)}")
         return jsonify({'error': f'Erreur: {str(e)}'}), 500
 
 @app.route('/api/suggest-improvements', methods=['POST'])
@@ -334,46 +788,186 @@ def suggest_improvements():
             return jsonify({'error': 'Erreur lors de la génération des suggestions'}), 500
         
         return jsonify({'suggestions': suggestions, 'status': 'success'})
+    except AdmissionRejected as e:
+        return admission_error(e)
     except Exception as e:
         logger.error(f"Erreur lors de la génération des suggestions: {str(e)}")
         return jsonify({'error': f'Erreur: {str(e)}'}), 500
 
+def sse_event(event, data):
+    """Formate un événement server-sent events"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    """Construit une réponse SSE à partir d'un générateur d'événements"""
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Désactiver la mise en tampon de Nginx
+    })
+
+@app.route('/api/stream/suggest-improvements', methods=['POST'])
+def stream_suggest_improvements():
+    """Suggère des améliorations en relayant les tokens du LLM au fil de l'eau (SSE)"""
+    data = request.json
+    if not data or 'markdown' not in data:
+        return jsonify({'error': 'Aucun contenu fourni'}), 400
+    
+    markdown = data.get('markdown')
+    section = data.get('section')
+    service = llm_service
+    
+    # Refus immédiat si la file est pleine: après l'envoi des en-têtes, seul un événement d'erreur est possible
+    try:
+        admission.check(service.mode)
+    except AdmissionRejected as e:
+        return admission_error(e)
+    
+    def events():
+        try:
+            for fragment in service.stream_suggestions(markdown, section):
+                yield sse_event('token', {'content': fragment})
+            yield sse_event('done', {'status': 'success'})
+        except Exception as e:
+            logger.error(f"Erreur lors du streaming des suggestions: {str(e)}")
+            yield sse_event('error', {'error': f'Erreur: {str(e)}'})
+    
+    return sse_response(events())
+
+@app.route('/api/stream/generate-from-document', methods=['POST'])
+def stream_generate_from_document():
+    """Génère un chatbot en relayant les tokens du LLM au fil de l'eau (SSE)"""
+    if 'document' not in request.files:
+        return jsonify({'error': 'Aucun fichier fourni'}), 400
+    
+    file = request.files['document']
+    if file.filename == '':
+        return jsonify({'error': 'Aucun fichier sélectionné'}), 400
+    
+    params = get_generation_params(request.form)
+    
+    try:
+        content = document_processor.process_bytes(file.read(), secure_filename(file.filename), params)
+        if not content:
+            return jsonify({'error': 'Impossible de traiter le document'}), 400
+    except Exception as e:
+        logger.error(f"Erreur lors du traitement du document: {str(e)}")
+        return jsonify({'error': f'Erreur: {str(e)}'}), 500
+    
+    service = llm_service
+    use_cache = use_cache_requested(request.form)
+    
+    try:
+        admission.check(service.mode)
+    except AdmissionRejected as e:
+        return admission_error(e)
+    
+    def events():
+        try:
+            for event, payload in service.stream_chatmd(content, params, use_cache=use_cache):
+                if event == 'token':
+                    yield sse_event('token', {'content': payload})
+                elif event == 'response':
+                    yield sse_event('response', {'title': payload})
+                elif payload:
+                    yield sse_event('result', {
+                        'markdown': payload,
+                        'validation': validate_generated_chatmd(payload, params),
+                        'status': 'success'
+                    })
+                else:
+                    yield sse_event('error', {'error': 'Erreur lors de la génération du chatbot'})
+            yield sse_event('done', {'status': 'success'})
+        except Exception as e:
+            logger.error(f"Erreur lors du streaming de la génération: {str(e)}")
+            yield sse_event('error', {'error': f'Erreur: {str(e)}'})
+    
+    return sse_response(events())
+
 @app.route('/api/toggle-llm-mode', methods=['POST'])
 def toggle_llm_mode():
-    """Change le mode LLM (local ou en ligne)"""
+    """Change le mode LLM (local, en ligne ou hors ligne)"""
     global llm_service
     
     data = request.json
-    if not data or 'use_online' not in data:
-        return jsonify({'error': 'Paramètre use_online manquant'}), 400
+    if not data or ('use_online' not in data and 'mode' not in data):
+        return jsonify({'error': 'Paramètre use_online ou mode manquant'}), 400
     
-    use_online = data.get('use_online', False)
+    mode = data.get('mode') or ('online' if data.get('use_online') else 'local')
+    if mode not in ('local', 'online', 'offline'):
+        return jsonify({'error': f'Mode inconnu: {mode}'}), 400
     
     try:
         # Créer une nouvelle instance du service LLM avec le mode spécifié
-        llm_service = LLMService(use_online=use_online)
+        llm_service = LLMService(use_online=mode == 'online', cache=generation_cache, use_offline=mode == 'offline')
+        batch_generator.llm_service = llm_service
         
-        mode = "en ligne (Mistral API)" if use_online else "local (Jan.ai)"
-        logger.info(f"Mode LLM changé: {mode}")
+        mode_label = {
+            'local': "local (Jan.ai)",
+            'online': "en ligne (Mistral API)",
+            'offline': "hors ligne (génération extractive, sans LLM)"
+        }[mode]
+        logger.info(f"Mode LLM changé: {mode_label}")
         
         return jsonify({
             'status': 'success',
-            'mode': mode,
-            'use_online': use_online
+            'mode': mode_label,
+            'use_online': llm_service.use_online,
+            'use_offline': llm_service.use_offline
         })
     except Exception as e:
         logger.error(f"Erreur lors du changement de mode LLM: {str(e)}")
         return jsonify({'error': f'Erreur: {str(e)}'}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Retourne les statistiques des caches d'extraction et de génération"""
+    return jsonify({
+        'extractions': extraction_cache.stats(),
+        'generations': generation_cache.stats()
+    })
+
 @app.route('/api/llm-status', methods=['GET'])
 def llm_status():
-    """Retourne le statut du LLM"""
+    """Retourne le statut du LLM: configuration, file d'attente, santé de chaque backend et requêtes doublées"""
     return jsonify({
         'use_online': llm_service.use_online,
-        'model': llm_service.model,
-        'api_url': llm_service.api_url if not llm_service.use_online else llm_service.online_api_url
+        'use_offline': llm_service.use_offline,
+        'mode': llm_service.mode,
+        'model': None if llm_service.use_offline else llm_service.model,
+        'api_url': None if llm_service.use_offline else (llm_service.api_url if not llm_service.use_online else llm_service.online_api_url),
+        'hedge': llm_service.hedge,
+        'queue_length': admission.queue_length(llm_service.mode),
+        'admission': admission.snapshot(),
+        **backend_stats.snapshot()
     })
 
+@app.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    """Liste les rapports de profilage enregistrés, du plus récent au plus ancien"""
+    return jsonify({'profiles': profile_store.list()})
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Retourne un rapport de profilage: durée de chaque étape et fonctions les plus coûteuses"""
+    report = profile_store.get(profile_id)
+    if not report:
+        return jsonify({'error': 'Profil inconnu'}), 404
+    return jsonify(report)
+
+@app.route('/api/profiles/<profile_id>/download', methods=['GET'])
+def download_profile(profile_id):
+    """Télécharge les statistiques cProfile d'un profil (fichier .prof pour pstats ou snakeviz)"""
+    path = profile_store.stats_path(profile_id)
+    if not path:
+        return jsonify({'error': 'Profil inconnu'}), 404
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{profile_id}.prof')
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Retourne les mesures de tous les workers au format texte de Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Créer les répertoires nécessaires
 os.makedirs('static/js', exist_ok=True)
 os.makedirs('static/css', exist_ok=True)